@@ -1,11 +1,35 @@
 import streamlit as st
 import gspread
+from gspread.utils import rowcol_to_a1, absolute_range_name
+from gspread.http_client import HTTPClient
 from google.oauth2.service_account import Credentials
 import pandas as pd
+import numpy as np
+import xlsxwriter
+import requests
+from PIL import Image, ImageOps
 from datetime import datetime, timedelta
 import time
 import json
+import re
+import uuid
+import hashlib
+import random
+import threading
+import queue
 import io
+import base64
+import bisect
+import operator
+import os
+import sqlite3
+import sys
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import deque
+from urllib.parse import unquote
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -196,6 +220,318 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+# ==================== COTA DA API ====================
+
+class BaldeCota:
+    """
+    Limita as requisições de uma conta a N por minuto (janela deslizante).
+    Cada requisição gasta uma ficha do balde e a ficha volta exatamente 60 s depois;
+    sem fichas, quem chama espera a próxima voltar. Assim o ritmo fica no máximo
+    permitido sem nunca passar da cota.
+    """
+    
+    JANELA = 60.0
+    
+    def __init__(self, por_minuto=60):
+        self.por_minuto = max(1, int(por_minuto))
+        self.esperas = 0  # quantas requisições tiveram de esperar por ficha
+        self._gastas = []  # instantes (monotonic) das fichas em uso, em ordem
+        self._lock = threading.Lock()
+    
+    def consumir(self):
+        """Gasta uma ficha, esperando se necessário; retorna o tempo de espera em segundos"""
+        esperou = 0.0
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                while self._gastas and agora - self._gastas[0] >= self.JANELA:
+                    self._gastas.pop(0)
+                
+                if len(self._gastas) < self.por_minuto:
+                    self._gastas.append(agora)
+                    if esperou:
+                        self.esperas += 1
+                    return esperou
+                
+                espera = self.JANELA - (agora - self._gastas[0])
+            
+            time.sleep(espera)
+            esperou += espera
+    
+    def esgotar(self):
+        """Depois de um 429, considera o balde vazio pelo resto da janela"""
+        with self._lock:
+            agora = time.monotonic()
+            self._gastas = [agora] * self.por_minuto
+
+
+# Baldes compartilhados por todas as sessões do processo, por conta de serviço
+_baldes_cota = {}
+_lock_baldes = threading.Lock()
+
+
+def obter_balde_cota(conta, por_minuto):
+    with _lock_baldes:
+        if conta not in _baldes_cota:
+            _baldes_cota[conta] = BaldeCota(por_minuto)
+        return _baldes_cota[conta]
+
+
+class ClienteHTTPCota(HTTPClient):
+    """
+    Cliente HTTP do gspread que respeita a cota da conta:
+    - toda requisição passa pelo balde da conta (por_minuto em [armazenamento] requisicoes_por_minuto)
+    - leituras iguais feitas ao mesmo tempo por sessões diferentes viram uma única requisição
+    - 429, 408 e 5xx são repetidos com espera exponencial aleatória
+    """
+    
+    TENTATIVAS = 5
+    ESPERA_MAXIMA = 32
+    CODIGOS_REPETIR = (408, 429)
+    
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        conta = getattr(auth, 'service_account_email', None) or 'padrao'
+        por_minuto = configuracao_armazenamento().get('requisicoes_por_minuto', 60)
+        self.balde = obter_balde_cota(conta, por_minuto)
+        self._leituras = {}  # chave -> [evento, resposta, erro]
+        self._lock_leituras = threading.Lock()
+    
+    def request(self, method, endpoint, params=None, **kwargs):
+        if method.lower() != 'get' or kwargs.get('data') or kwargs.get('json'):
+            return self._com_repeticao(method, endpoint, params, **kwargs)
+        
+        # Leitura: se a mesma já está em andamento, espera por ela em vez de repetir a chamada
+        chave = (endpoint, json.dumps(params, sort_keys=True, default=str))
+        with self._lock_leituras:
+            em_andamento = self._leituras.get(chave)
+            if em_andamento is None:
+                em_andamento = self._leituras[chave] = [threading.Event(), None, None]
+                dono = True
+            else:
+                dono = False
+        
+        if not dono:
+            inicio = time.perf_counter()
+            em_andamento[0].wait()
+            registrar_chamada_api(method, endpoint, em_andamento[1], time.perf_counter() - inicio, agrupada=True)
+            if em_andamento[2] is not None:
+                raise em_andamento[2]
+            return em_andamento[1]
+        
+        try:
+            em_andamento[1] = self._com_repeticao(method, endpoint, params, **kwargs)
+            return em_andamento[1]
+        except Exception as e:
+            em_andamento[2] = e
+            raise
+        finally:
+            with self._lock_leituras:
+                self._leituras.pop(chave, None)
+            em_andamento[0].set()
+    
+    def _com_repeticao(self, method, endpoint, params=None, **kwargs):
+        inicio = time.perf_counter()
+        espera_cota = 0.0
+        resposta = None
+        try:
+            for tentativa in range(self.TENTATIVAS):
+                espera_cota += self.balde.consumir()
+                try:
+                    resposta = super().request(method, endpoint, params=params, **kwargs)
+                    return resposta
+                except gspread.exceptions.APIError as e:
+                    resposta = e.response
+                    codigo = e.code if isinstance(e.code, int) else -1
+                    if tentativa == self.TENTATIVAS - 1 or not (codigo in self.CODIGOS_REPETIR or codigo >= 500):
+                        raise
+                    if codigo == 429:
+                        self.balde.esgotar()
+                    time.sleep(min(2 ** tentativa, self.ESPERA_MAXIMA) * random.uniform(0.5, 1.5))
+        finally:
+            registrar_chamada_api(
+                method, endpoint, resposta, time.perf_counter() - inicio,
+                tentativas=tentativa + 1, espera_cota=espera_cota,
+                bytes_enviados=_tamanho_envio(kwargs)
+            )
+
+
+# ==================== DIAGNÓSTICO DE CHAMADAS ====================
+
+def configuracao_diagnostico():
+    """
+    Lê a seção [diagnostico] dos secrets:
+    painel = true mostra o painel de chamadas na barra lateral;
+    arquivo_log = arquivo (rotativo) onde cada chamada é registrada em JSON
+    """
+    try:
+        if "diagnostico" in st.secrets:
+            return dict(st.secrets["diagnostico"])
+    except Exception:
+        pass
+    return {}
+
+
+# Sessão, execução (rerun) e página em andamento na thread; vazio nas threads de segundo plano
+_contexto_chamadas = threading.local()
+
+
+def iniciar_contexto_chamadas(pagina):
+    """Marca o início de uma execução do script, para agrupar as chamadas por rerun e por página"""
+    if 'diagnostico_sessao' not in st.session_state:
+        st.session_state.diagnostico_sessao = uuid.uuid4().hex[:8]
+        st.session_state.diagnostico_execucao = 0
+    st.session_state.diagnostico_execucao += 1
+    
+    _contexto_chamadas.sessao = st.session_state.diagnostico_sessao
+    _contexto_chamadas.execucao = st.session_state.diagnostico_execucao
+    _contexto_chamadas.pagina = pagina
+
+
+def _tamanho_envio(kwargs):
+    if kwargs.get('data'):
+        return len(kwargs['data'])
+    if kwargs.get('json') is not None:
+        return len(json.dumps(kwargs['json']))
+    return 0
+
+
+def _operacao_api(method, endpoint):
+    """Descrição curta da chamada: 'GET values/Produtos!A2:C', 'POST batchUpdate', 'GET metadados'..."""
+    endpoint = unquote(endpoint.split('?')[0])
+    if '/spreadsheets/' in endpoint:
+        caminho = endpoint.split('/spreadsheets/', 1)[1]
+        if '/' in caminho:
+            caminho = caminho.split('/', 1)[1]
+        else:
+            caminho = caminho.partition(':')[2] or 'metadados'
+    else:
+        caminho = 'drive ' + endpoint.rsplit('/', 1)[-1]
+    return f"{method.upper()} {caminho}"
+
+
+# Funções que só repassam a chamada; o chamador é a primeira função fora delas
+_FUNCOES_INTERMEDIARIAS = {
+    'request', '_com_repeticao', 'registrar_chamada_api', '_chamador_api', '_cronometrar',
+}
+
+
+def _chamador_api():
+    """Função do app que originou a chamada (ignorando cliente HTTP, gspread e armazenamento)"""
+    quadro = sys._getframe(1)
+    metodo_armazenamento = None
+    while quadro is not None:
+        codigo = quadro.f_code
+        if codigo.co_filename == __file__ and codigo.co_name not in _FUNCOES_INTERMEDIARIAS:
+            if isinstance(quadro.f_locals.get('self'), Armazenamento):
+                metodo_armazenamento = metodo_armazenamento or codigo.co_name
+            else:
+                return codigo.co_name
+        quadro = quadro.f_back
+    return metodo_armazenamento or '?'
+
+
+class RegistroChamadas:
+    """Últimas chamadas à API do processo (para o painel) e, se configurado, o arquivo de log rotativo"""
+    
+    def __init__(self, maximo=5000):
+        self._chamadas = deque(maxlen=maximo)
+        self._lock = threading.Lock()
+        self._log = None
+        
+        arquivo = configuracao_diagnostico().get('arquivo_log')
+        if arquivo:
+            self._log = logging.getLogger('sistema_compras.chamadas_api')
+            self._log.setLevel(logging.INFO)
+            self._log.propagate = False
+            if not self._log.handlers:
+                self._log.addHandler(RotatingFileHandler(arquivo, maxBytes=1024 * 1024, backupCount=3, encoding='utf-8'))
+    
+    def adicionar(self, chamada):
+        with self._lock:
+            self._chamadas.append(chamada)
+        if self._log is not None:
+            self._log.info(json.dumps(chamada, ensure_ascii=False))
+    
+    def da_sessao(self, sessao):
+        with self._lock:
+            return [c for c in self._chamadas if c['sessao'] == sessao]
+
+
+_registro_chamadas = None
+_lock_registro_chamadas = threading.Lock()
+
+
+def obter_registro_chamadas():
+    global _registro_chamadas
+    with _lock_registro_chamadas:
+        if _registro_chamadas is None:
+            _registro_chamadas = RegistroChamadas()
+        return _registro_chamadas
+
+
+def registrar_chamada_api(method, endpoint, resposta, duracao, agrupada=False, tentativas=1,
+                          espera_cota=0.0, bytes_enviados=0):
+    """Registra uma chamada feita pelo ClienteHTTPCota (chamada na própria thread que a fez)"""
+    try:
+        obter_registro_chamadas().adicionar({
+            'instante': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'sessao': getattr(_contexto_chamadas, 'sessao', None),
+            'execucao': getattr(_contexto_chamadas, 'execucao', None),
+            'pagina': getattr(_contexto_chamadas, 'pagina', 'segundo plano'),
+            'chamador': _chamador_api(),
+            'operacao': _operacao_api(method, endpoint),
+            'status': getattr(resposta, 'status_code', None),
+            'ms': round(duracao * 1000, 1),
+            'espera_cota_ms': round(espera_cota * 1000, 1),
+            'tentativas': tentativas,
+            'agrupada': agrupada,
+            'bytes_enviados': bytes_enviados,
+            'bytes_recebidos': 0 if agrupada else len(getattr(resposta, 'content', b'') or b''),
+        })
+    except Exception:
+        pass  # O diagnóstico nunca deve derrubar uma chamada
+
+
+def mostrar_diagnostico():
+    """Painel da barra lateral com as chamadas à API desta sessão, por execução e por página"""
+    sessao = st.session_state.get('diagnostico_sessao')
+    chamadas = obter_registro_chamadas().da_sessao(sessao)
+    
+    with st.expander("🩺 Diagnóstico de chamadas", expanded=False):
+        if not chamadas:
+            st.caption("Nenhuma chamada à API nesta sessão.")
+            return
+        
+        df = pd.DataFrame(chamadas)
+        df['kb'] = (df['bytes_enviados'] + df['bytes_recebidos']) / 1024
+        
+        execucao = st.session_state.get('diagnostico_execucao')
+        atual = df[df['execucao'] == execucao]
+        st.caption(
+            f"Esta execução: {len(atual)} chamadas · {atual['ms'].sum():.0f} ms · {atual['kb'].sum():.1f} KB"
+        )
+        if not atual.empty:
+            st.dataframe(
+                atual.groupby(['chamador', 'operacao']).agg(chamadas=('ms', 'size'), ms=('ms', 'sum'), kb=('kb', 'sum')).round(1),
+                use_container_width=True
+            )
+        
+        st.caption("Últimas execuções")
+        por_execucao = df.groupby(['execucao', 'pagina']).agg(
+            chamadas=('ms', 'size'), ms=('ms', 'sum'), kb=('kb', 'sum')
+        ).round(1).sort_index(ascending=False).head(10)
+        st.dataframe(por_execucao, use_container_width=True)
+        
+        st.caption("Por página (média por execução)")
+        por_pagina = df.groupby('pagina').agg(
+            execucoes=('execucao', 'nunique'), chamadas=('ms', 'size'), ms=('ms', 'sum'), kb=('kb', 'sum')
+        )
+        for coluna in ['chamadas', 'ms', 'kb']:
+            por_pagina[f'{coluna}/execução'] = por_pagina[coluna] / por_pagina['execucoes']
+        st.dataframe(por_pagina.round(1), use_container_width=True)
+
+
 # ==================== CONEXÃO COM GOOGLE SHEETS ====================
 
 @st.cache_resource
@@ -205,6 +541,7 @@ def conectar_gsheets():
     Suporta:
     - Streamlit Cloud: usa st.secrets
     - Desenvolvimento local: usa credentials.json ou .streamlit/secrets.toml
+    As requisições passam pelo ClienteHTTPCota (limite por minuto e repetição em 429).
     """
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
@@ -216,7 +553,7 @@ def conectar_gsheets():
         if "gcp_service_account" in st.secrets:
             creds_dict = dict(st.secrets["gcp_service_account"])
             creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-            client = gspread.authorize(creds)
+            client = gspread.authorize(creds, http_client=ClienteHTTPCota)
             return client
     except Exception:
         pass  # Continua para tentar o arquivo local
@@ -224,7 +561,7 @@ def conectar_gsheets():
     # MÉTODO 2: Tenta usar arquivo credentials.json local
     try:
         creds = Credentials.from_service_account_file('credentials.json', scopes=scopes)
-        client = gspread.authorize(creds)
+        client = gspread.authorize(creds, http_client=ClienteHTTPCota)
         return client
     except FileNotFoundError:
         return None
@@ -247,328 +584,2666 @@ def obter_planilha(_client, spreadsheet_name):
     return spreadsheet
 
 
-def garantir_abas(spreadsheet):
-    """Garante que as abas Produtos, Compras e Movimentações existam com todas as colunas necessárias"""
-    # Verifica se já foi executado nesta sessão
-    if st.session_state.get('abas_verificadas', False):
-        return spreadsheet
+# ==================== ARMAZENAMENTO ====================
+
+# Abas do sistema e suas colunas, na ordem em que aparecem na planilha
+ESQUEMA_ABAS = {
+    'Produtos': ['ID', 'Nome', 'Categoria', 'Preço', 'Unidade', 'Estoque_Atual', 'Estoque_Minimo', 'Imagem', 'Data_Cadastro',
+                 'Codigo'],
+    # Lancamento: marca do lançamento do diário que gravou a linha (vazia nas gravações diretas)
+    'Compras': ['ID_Compra', 'Data', 'Produto', 'Quantidade', 'Preço_Unit', 'Total', 'Pagamento', 'Observação',
+                'Lancamento'],
+    'Movimentacoes': ['ID_Mov', 'Data', 'Tipo', 'Produto', 'Quantidade', 'Motivo', 'Observação', 'Lancamento'],
+    'Alertas_Config': ['ID', 'Email', 'Ativo', 'Ultima_Verificacao'],
+    # Último ID emitido de cada sequência até a linha Linha_Reserva da aba Reservas_ID (ponto de partida)
+    'Contadores': ['Chave', 'Valor', 'Token', 'Linha_Reserva'],
+    # Blocos de IDs reservados no Google Sheets, um por linha, só de acréscimo: a linha define a ordem
+    'Reservas_ID': ['Chave', 'Quantidade', 'Data'],
+    # Totais das vendas por dia × produto × pagamento, mantidos a cada venda (Produto vazio = todas);
+    # cada instância soma nas suas próprias linhas (Gravador) e os totais são a soma delas
+    'Resumo_Diario': ['Chave', 'Dia', 'Produto', 'Pagamento', 'Compras', 'Itens', 'Quantidade', 'Total', 'Gravador'],
+    # Produtos já avisados por email no mínimo atual (Notificado_Em vazio = avisa de novo)
+    'Alertas_Estado': ['Produto', 'Estoque_Minimo', 'Notificado_Em'],
+    # Estoque de cada produto somando as movimentações até a linha Linha_Mov (ponto de partida do cálculo)
+    'Estoque_Snapshot': ['Linha_Mov', 'Data', 'Produto', 'Estoque'],
+}
+
+# Chave (metadado da planilha / PRAGMA user_version no SQLite) onde fica a versão do esquema aplicado
+CHAVE_VERSAO_ESQUEMA = 'sistema_compras_esquema'
+
+
+def versao_esquema(esquema):
+    """Impressão digital do esquema: muda sozinha quando uma aba ou coluna é acrescentada"""
+    texto = json.dumps(esquema, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(texto.encode('utf-8')).hexdigest()[:12]
+
+
+# Tamanho inicial (linhas, colunas) das abas criadas no Google Sheets
+TAMANHO_ABAS = {
+    'Produtos': (1000, 15),
+    'Compras': (1000, 10),
+    'Movimentacoes': (1000, 10),
+    'Alertas_Config': (100, 10),
+    'Contadores': (20, 5),
+    'Reservas_ID': (1000, 3),
+    'Resumo_Diario': (1000, 10),
+    'Alertas_Estado': (200, 5),
+    'Estoque_Snapshot': (1000, 5),
+}
+
+
+class Armazenamento:
+    """
+    Interface de armazenamento usada por todas as funções de dados do sistema.
+    As linhas são endereçadas como na planilha: a linha 1 é o cabeçalho e os dados
+    começam na linha 2; colunas são numeradas a partir de 1.
+    """
     
-    try:
-        worksheets = [ws.title for ws in spreadsheet.worksheets()]
-        
-        # ==================== ABA PRODUTOS ====================
-        # Colunas esperadas na aba Produtos (com estoque)
-        COLUNAS_PRODUTOS = ['ID', 'Nome', 'Categoria', 'Preço', 'Unidade', 'Estoque_Atual', 'Estoque_Minimo', 'Imagem', 'Data_Cadastro']
-        
-        if 'Produtos' not in worksheets:
-            # Cria aba nova com todas as colunas
-            ws_produtos = spreadsheet.add_worksheet(title='Produtos', rows=1000, cols=15)
-            ws_produtos.append_row(COLUNAS_PRODUTOS, value_input_option='RAW')
-        else:
-            # Verifica e adiciona colunas faltantes
-            ws_produtos = spreadsheet.worksheet('Produtos')
-            headers = ws_produtos.row_values(1)
-            
-            # Se não tem headers, adiciona todos
-            if not headers:
-                ws_produtos.append_row(COLUNAS_PRODUTOS, value_input_option='RAW')
-            else:
-                # Verifica cada coluna necessária
-                for idx, coluna in enumerate(COLUNAS_PRODUTOS):
-                    if coluna not in headers:
-                        # Adiciona na posição correta ou no final
-                        pos = len(headers) + 1
-                        ws_produtos.update_cell(1, pos, coluna)
-                        headers.append(coluna)  # Atualiza lista local
-        
-        # ==================== ABA COMPRAS ====================
-        # Colunas esperadas na aba Compras
-        COLUNAS_COMPRAS = ['ID_Compra', 'Data', 'Produto', 'Quantidade', 'Preço_Unit', 'Total', 'Pagamento', 'Observação']
-        
-        if 'Compras' not in worksheets:
-            # Cria aba nova com todas as colunas
-            ws_compras = spreadsheet.add_worksheet(title='Compras', rows=1000, cols=10)
-            ws_compras.append_row(COLUNAS_COMPRAS, value_input_option='RAW')
-        else:
-            # Verifica e adiciona colunas faltantes
-            ws_compras = spreadsheet.worksheet('Compras')
-            headers = ws_compras.row_values(1)
-            
-            # Se não tem headers, adiciona todos
-            if not headers:
-                ws_compras.append_row(COLUNAS_COMPRAS, value_input_option='RAW')
-            else:
-                # Verifica cada coluna necessária
-                for idx, coluna in enumerate(COLUNAS_COMPRAS):
-                    if coluna not in headers:
-                        pos = len(headers) + 1
-                        ws_compras.update_cell(1, pos, coluna)
-                        headers.append(coluna)
-        
-        # ==================== ABA MOVIMENTAÇÕES (ESTOQUE) ====================
-        # Colunas para controle de entrada/saída de estoque
-        COLUNAS_MOVIMENTACOES = ['ID_Mov', 'Data', 'Tipo', 'Produto', 'Quantidade', 'Motivo', 'Observação']
-        
-        if 'Movimentacoes' not in worksheets:
-            ws_mov = spreadsheet.add_worksheet(title='Movimentacoes', rows=1000, cols=10)
-            ws_mov.append_row(COLUNAS_MOVIMENTACOES, value_input_option='RAW')
-        else:
-            ws_mov = spreadsheet.worksheet('Movimentacoes')
-            headers = ws_mov.row_values(1)
-            if not headers:
-                ws_mov.append_row(COLUNAS_MOVIMENTACOES, value_input_option='RAW')
-            else:
-                for coluna in COLUNAS_MOVIMENTACOES:
-                    if coluna not in headers:
-                        pos = len(headers) + 1
-                        ws_mov.update_cell(1, pos, coluna)
-                        headers.append(coluna)
-        
-        # ==================== ABA ALERTAS ====================
-        # Colunas para configuração de alertas
-        COLUNAS_ALERTAS = ['ID', 'Email', 'Ativo', 'Ultima_Verificacao']
-        
-        if 'Alertas_Config' not in worksheets:
-            ws_alertas = spreadsheet.add_worksheet(title='Alertas_Config', rows=100, cols=10)
-            ws_alertas.append_row(COLUNAS_ALERTAS, value_input_option='RAW')
-        
-        # ==================== LIMPEZA ====================
-        # Remove a Sheet1 padrão se existir e há outras abas
-        if 'Sheet1' in worksheets and len(worksheets) > 1:
-            try:
-                sheet1 = spreadsheet.worksheet('Sheet1')
-                spreadsheet.del_worksheet(sheet1)
-            except:
-                pass
-        
-        # Marca como verificado nesta sessão
-        st.session_state.abas_verificadas = True
-        
-    except Exception as e:
-        st.warning(f"⚠️ Aviso na verificação das abas: {e}")
+    id = ''
+    remoto = False  # True quando cada chamada é uma ida à rede
     
-    return spreadsheet
+    def garantir_estrutura(self, esquema):
+        """
+        Cria as abas que faltam e acrescenta as colunas que faltam ({aba: [colunas]}),
+        registrando a versão do esquema aplicado (versao_esquema) no próprio armazenamento.
+        """
+        raise NotImplementedError
+    
+    def ler_registros(self, aba):
+        """Todas as linhas da aba como lista de dicionários {coluna: valor}, na ordem das linhas"""
+        raise NotImplementedError
+    
+    def ler_coluna(self, aba, coluna):
+        """Valores de uma coluna (1 = primeira), sem o cabeçalho"""
+        raise NotImplementedError
+    
+    def ler_colunas(self, aba, primeira_linha=2, ultima_linha=None):
+        """
+        Cabeçalho e valores da aba coluna a coluna, de primeira_linha até ultima_linha
+        (inclusive; None = até o fim), numa única leitura.
+        Retorna (cabecalho, {coluna: [valores]}), listas do mesmo tamanho.
+        """
+        raise NotImplementedError
+    
+    def anexar_linhas(self, aba, linhas):
+        """Acrescenta as linhas (listas de valores na ordem do cabeçalho) ao final da aba"""
+        raise NotImplementedError
+    
+    def gravar_celulas(self, aba, celulas):
+        """Grava várias células de uma vez; celulas é uma lista de (linha, coluna, valor)"""
+        raise NotImplementedError
+    
+    def gravar_celulas_chave(self, aba, celulas):
+        """
+        Como gravar_celulas, mas cada linha é endereçada pela chave (valor da primeira coluna)
+        em vez do número: celulas é uma lista de (chave, coluna, valor). Chaves que não estão
+        na aba são ignoradas.
+        """
+        raise NotImplementedError
+    
+    def reservar_numeros(self, pedidos):
+        """
+        Reserva números nas sequências da aba Contadores de forma atômica.
+        pedidos: {chave: quantidade}. Retorna {chave: primeiro número reservado}.
+        """
+        raise NotImplementedError
 
 
-@st.cache_data(ttl=300, show_spinner=False)
-def carregar_produtos(_spreadsheet, _cache_key):
-    """Carrega todos os produtos da aba Produtos (com cache de 5 minutos)"""
-    # Colunas esperadas (incluindo estoque)
-    COLUNAS_PRODUTOS = ['ID', 'Nome', 'Categoria', 'Preço', 'Unidade', 'Estoque_Atual', 'Estoque_Minimo', 'Imagem', 'Data_Cadastro']
+class ArmazenamentoSheets(Armazenamento):
+    """Armazenamento no Google Sheets: uma aba da planilha por tabela"""
     
-    try:
-        ws = _spreadsheet.worksheet('Produtos')
-        # Usa UNFORMATTED_VALUE para obter números corretamente
-        dados = ws.get_all_records(value_render_option='UNFORMATTED_VALUE')
+    remoto = True
+    
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.id = spreadsheet.id
+        self._abas = {}
+        self._linhas_chave = {}  # aba -> {chave: linha}, conferido a cada gravar_celulas_chave
+        self._pontos_reserva = {}  # sequência -> (linha em Contadores, linha em Reservas_ID, último número)
+        self._colunas_contadores = (2, 4)  # posições de Valor e Linha_Reserva em Contadores
+    
+    def _aba(self, aba):
+        """Worksheet da aba, guardada em memória para não buscar os metadados a cada operação"""
+        if aba not in self._abas:
+            self._abas[aba] = self.spreadsheet.worksheet(aba)
+        return self._abas[aba]
+    
+    def _guardar_abas(self, propriedades):
+        """Guarda as Worksheets a partir dos metadados já lidos, sem uma busca por aba"""
+        for titulo, props in propriedades.items():
+            self._abas[titulo] = gspread.Worksheet(self.spreadsheet, props, self.spreadsheet.id, self.spreadsheet.client)
+    
+    @staticmethod
+    def _escrever_cabecalho(id_aba, primeira_coluna, colunas):
+        return {'updateCells': {
+            'start': {'sheetId': id_aba, 'rowIndex': 0, 'columnIndex': primeira_coluna},
+            'rows': [{'values': [{'userEnteredValue': {'stringValue': coluna}} for coluna in colunas]}],
+            'fields': 'userEnteredValue',
+        }}
+    
+    def garantir_estrutura(self, esquema):
+        """
+        Uma leitura de metadados (abas e versão do esquema gravada na planilha). Se a versão
+        confere, não há mais nada a fazer. Senão, uma leitura de todos os cabeçalhos e uma
+        única batch_update com o que falta: abas, colunas, remoção da Sheet1 e a nova versão.
+        """
+        versao = versao_esquema(esquema)
+        metadados = self.spreadsheet.fetch_sheet_metadata(params={'fields': 'sheets.properties,developerMetadata'})
+        propriedades = {s['properties']['title']: s['properties'] for s in metadados.get('sheets', [])}
+        registro_versao = next(
+            (m for m in metadados.get('developerMetadata', []) if m.get('metadataKey') == CHAVE_VERSAO_ESQUEMA),
+            None
+        )
         
-        if dados:
-            df = pd.DataFrame(dados)
-        else:
-            # Retorna DataFrame vazio com as colunas esperadas
-            df = pd.DataFrame(columns=COLUNAS_PRODUTOS)
+        if (registro_versao and registro_versao.get('metadataValue') == versao
+                and all(aba in propriedades for aba in esquema)):
+            self._guardar_abas(propriedades)
+            return
         
-        # Garante que todas as colunas existam
-        for col in COLUNAS_PRODUTOS:
-            if col not in df.columns:
-                df[col] = 0 if col in ['Estoque_Atual', 'Estoque_Minimo'] else ''
+        # Cabeçalhos de todas as abas existentes numa única leitura
+        existentes = [aba for aba in esquema if aba in propriedades]
+        cabecalhos = {}
+        if existentes:
+            resposta = self.spreadsheet.values_batch_get([absolute_range_name(aba, '1:1') for aba in existentes])
+            for aba, faixa in zip(existentes, resposta.get('valueRanges', [])):
+                valores = faixa.get('values', [])
+                cabecalhos[aba] = list(valores[0]) if valores else []
         
-        # Garante que colunas numéricas sejam numéricas
-        if 'Preço' in df.columns:
-            df['Preço'] = pd.to_numeric(df['Preço'], errors='coerce').fillna(0)
+        requisicoes = []
+        ids_usados = {props['sheetId'] for props in propriedades.values()}
+        for aba, colunas in esquema.items():
+            if aba not in propriedades:
+                # Cria aba nova com todas as colunas (o ID é escolhido aqui para escrever o cabeçalho no mesmo lote)
+                linhas, cols = TAMANHO_ABAS.get(aba, (1000, 10))
+                id_aba = random.randint(1, 2**31 - 1)
+                while id_aba in ids_usados:
+                    id_aba = random.randint(1, 2**31 - 1)
+                ids_usados.add(id_aba)
+                requisicoes.append({'addSheet': {'properties': {
+                    'sheetId': id_aba, 'title': aba,
+                    'gridProperties': {'rowCount': linhas, 'columnCount': max(cols, len(colunas))}
+                }}})
+                requisicoes.append(self._escrever_cabecalho(id_aba, 0, colunas))
+                continue
+            
+            # Acrescenta as colunas faltantes depois das existentes
+            atuais = cabecalhos.get(aba, [])
+            faltantes = [coluna for coluna in colunas if coluna not in atuais]
+            if not faltantes:
+                continue
+            props = propriedades[aba]
+            colunas_grade = props.get('gridProperties', {}).get('columnCount', 0)
+            if len(atuais) + len(faltantes) > colunas_grade:
+                requisicoes.append({'appendDimension': {
+                    'sheetId': props['sheetId'], 'dimension': 'COLUMNS',
+                    'length': len(atuais) + len(faltantes) - colunas_grade
+                }})
+            requisicoes.append(self._escrever_cabecalho(props['sheetId'], len(atuais), faltantes))
         
-        if 'ID' in df.columns:
-            df['ID'] = pd.to_numeric(df['ID'], errors='coerce').fillna(0).astype(int)
+        # Remove a Sheet1 padrão se existir (as abas do sistema são criadas antes, no mesmo lote)
+        if 'Sheet1' in propriedades and 'Sheet1' not in esquema:
+            requisicoes.append({'deleteSheet': {'sheetId': propriedades['Sheet1']['sheetId']}})
         
-        if 'Estoque_Atual' in df.columns:
-            df['Estoque_Atual'] = pd.to_numeric(df['Estoque_Atual'], errors='coerce').fillna(0)
+        if registro_versao:
+            requisicoes.append({'updateDeveloperMetadata': {
+                'dataFilters': [{'developerMetadataLookup': {'metadataId': registro_versao['metadataId']}}],
+                'developerMetadata': {'metadataValue': versao},
+                'fields': 'metadataValue',
+            }})
+        else:
+            requisicoes.append({'createDeveloperMetadata': {'developerMetadata': {
+                'metadataKey': CHAVE_VERSAO_ESQUEMA, 'metadataValue': versao,
+                'location': {'spreadsheet': True}, 'visibility': 'DOCUMENT',
+            }}})
         
-        if 'Estoque_Minimo' in df.columns:
-            df['Estoque_Minimo'] = pd.to_numeric(df['Estoque_Minimo'], errors='coerce').fillna(0)
+        self.spreadsheet.batch_update({'requests': requisicoes})
+        # Abas e tamanhos mudaram: as Worksheets serão buscadas de novo quando usadas
+        self._abas.clear()
+    
+    def ler_registros(self, aba):
+        # Usa UNFORMATTED_VALUE para obter números corretamente
+        return self._aba(aba).get_all_records(value_render_option='UNFORMATTED_VALUE')
+    
+    def ler_coluna(self, aba, coluna):
+        return self._aba(aba).col_values(coluna)[1:]
+    
+    def ler_colunas(self, aba, primeira_linha=2, ultima_linha=None):
+        ws = self._aba(aba)
+        ultima_coluna = re.sub(r'\d', '', rowcol_to_a1(1, ws.col_count)) + str(ultima_linha or '')
+        # majorDimension=COLUMNS: a API já devolve cada coluna como uma lista
+        resposta = self.spreadsheet.values_batch_get(
+            [absolute_range_name(aba, '1:1'), absolute_range_name(aba, f'A{primeira_linha}:{ultima_coluna}')],
+            params={'majorDimension': 'COLUMNS', 'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )
+        faixa_cabecalho, faixa_dados = [faixa.get('values', []) for faixa in resposta.get('valueRanges', [])]
+        cabecalho = [coluna[0] if coluna else '' for coluna in faixa_cabecalho]
         
-        return df
-    except Exception as e:
-        # Em caso de erro, retorna DataFrame vazio com estrutura correta
-        return pd.DataFrame(columns=COLUNAS_PRODUTOS)
-
-
-def adicionar_produto(spreadsheet, nome, categoria, preco, unidade, estoque_atual=0, estoque_minimo=5, imagem_url=""):
-    """Adiciona um novo produto com tratamento de erros"""
-    try:
-        ws = spreadsheet.worksheet('Produtos')
-        dados = ws.get_all_values()
-        novo_id = len(dados)  # ID simples baseado na linha
+        # A API corta as células vazias do fim de cada coluna: completa até o total de linhas
+        total = max((len(coluna) for coluna in faixa_dados), default=0)
+        colunas = {}
+        for posicao, nome in enumerate(cabecalho):
+            valores = list(faixa_dados[posicao]) if posicao < len(faixa_dados) else []
+            colunas[nome] = valores + [''] * (total - len(valores))
+        return cabecalho, colunas
+    
+    def anexar_linhas(self, aba, linhas):
+        # Usa value_input_option='RAW' para salvar números corretamente
+        self._aba(aba).append_rows(linhas, value_input_option='RAW')
+    
+    def gravar_celulas(self, aba, celulas):
+        # Escreve direto nos intervalos A1, sem precisar buscar a aba
+        self.spreadsheet.values_batch_update({
+            'valueInputOption': 'RAW',
+            'data': [
+                {'range': absolute_range_name(aba, rowcol_to_a1(linha, coluna)), 'values': [[valor]]}
+                for linha, coluna, valor in celulas
+            ]
+        })
+    
+    def gravar_celulas_chave(self, aba, celulas):
+        """
+        As linhas das chaves ficam em memória e são conferidas numa única leitura das células
+        da chave; se alguma chave é nova ou mudou de lugar, a primeira coluna é relida.
+        """
+        chaves = list(dict.fromkeys(str(chave) for chave, _, _ in celulas))
+        linhas = self._linhas_chave.get(aba, {})
         
-        # Garante que preço seja float
-        preco_float = float(preco) if preco else 0.0
-        estoque_atual_float = float(estoque_atual) if estoque_atual else 0.0
-        estoque_minimo_float = float(estoque_minimo) if estoque_minimo else 5.0
+        conferidas = {}
+        if all(chave in linhas for chave in chaves):
+            resposta = self.spreadsheet.values_batch_get(
+                [absolute_range_name(aba, f'A{linhas[chave]}') for chave in chaves],
+                params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+            )
+            for chave, faixa in zip(chaves, resposta.get('valueRanges', [])):
+                valores = faixa.get('values', [])
+                if valores and valores[0] and str(valores[0][0]) == chave:
+                    conferidas[chave] = linhas[chave]
         
-        # Garante que valores não sejam None
-        nome = str(nome or "").strip()
-        categoria = str(categoria or "").strip()
-        unidade = str(unidade or "un").strip()
-        imagem_url = str(imagem_url or "").strip()
+        if len(conferidas) < len(chaves):
+            linhas = {}
+            for linha, valor in enumerate(self.ler_coluna(aba, 1), start=2):
+                linhas.setdefault(str(valor), linha)
+            self._linhas_chave[aba] = linhas
+            conferidas = {chave: linhas[chave] for chave in chaves if chave in linhas}
         
-        # Usa value_input_option='RAW' para salvar números corretamente
-        ws.append_row([
-            novo_id,
-            nome,
-            categoria,
-            preco_float,
-            unidade,
-            estoque_atual_float,
-            estoque_minimo_float,
-            imagem_url,
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ], value_input_option='RAW')
-        return True
-    except Exception as e:
-        st.error(f"❌ Erro ao adicionar produto: {e}")
-        return False
+        celulas = [(conferidas[str(chave)], coluna, valor) for chave, coluna, valor in celulas if str(chave) in conferidas]
+        if celulas:
+            self.gravar_celulas(aba, celulas)
+    
+    def _ler_contadores(self, chaves):
+        """
+        Ponto de partida de cada sequência na aba Contadores: {chave: (linha, valor, linha_reserva)}.
+        As sequências que ainda não existem são criadas (migração) e a aba é relida; se duas
+        instâncias criarem a mesma, vale a primeira linha, a mesma para todas.
+        """
+        for _ in range(2):
+            linhas = self._aba('Contadores').get_values('A1:Z', value_render_option='UNFORMATTED_VALUE')
+            cabecalho = linhas[0] if linhas else ESQUEMA_ABAS['Contadores']
+            pos_valor, pos_reserva = cabecalho.index('Valor'), cabecalho.index('Linha_Reserva')
+            self._colunas_contadores = (pos_valor + 1, pos_reserva + 1)
+            
+            contadores = {}
+            for idx, linha in enumerate(linhas[1:], start=2):
+                linha = list(linha) + [''] * len(cabecalho)
+                if linha[0]:
+                    contadores.setdefault(str(linha[0]), (
+                        idx, _inteiro_celula(linha[pos_valor]), _inteiro_celula(linha[pos_reserva]) or 1
+                    ))
+            
+            faltantes = [chave for chave in chaves if chave not in contadores]
+            if not faltantes:
+                return contadores
+            novos = []
+            for chave in faltantes:
+                novo = [''] * len(cabecalho)
+                novo[0], novo[pos_valor], novo[pos_reserva] = chave, _migrar_contador(self, chave), 1
+                novos.append(novo)
+            self._aba('Contadores').append_rows(novos, value_input_option='RAW')
+        return contadores
+    
+    def reservar_numeros(self, pedidos):
+        """
+        Cada reserva é um acréscimo atômico de uma linha por sequência na aba Reservas_ID: a
+        planilha nunca dá a mesma linha a duas instâncias, e a linha devolvida define a ordem.
+        O bloco de uma linha começa depois do ponto de partida (Valor até Linha_Reserva, na aba
+        Contadores) somado às quantidades das linhas da mesma sequência entre os dois, que só
+        são lidas depois do acréscimo. Como essas linhas nunca mudam, todas as instâncias chegam
+        aos mesmos blocos, sem sobreposição. O ponto de partida é então avançado até a linha
+        reservada (qualquer ponto gravado é correto; só encurta a leitura das próximas reservas).
+        """
+        with _lock_contadores:
+            pontos = self._pontos_reserva
+            if any(chave not in pontos for chave in pedidos):
+                contadores = self._ler_contadores(list(pedidos))
+                for chave, (idx, valor, linha_reserva) in contadores.items():
+                    if chave not in pontos or pontos[chave][1] < linha_reserva:
+                        pontos[chave] = (idx, linha_reserva, valor)
+            
+            data = datetime.now().strftime(FORMATO_DATA)
+            resposta = self._aba('Reservas_ID').append_rows(
+                [[chave, qtd, data] for chave, qtd in pedidos.items()], value_input_option='RAW'
+            )
+            faixa = (resposta or {}).get('updates', {}).get('updatedRange', '')
+            encontrado = re.search(r'![A-Z]+(\d+)', faixa)
+            if not encontrado:
+                raise RuntimeError(f"Não foi possível reservar IDs: resposta inesperada da planilha ({faixa!r})")
+            minhas = {chave: int(encontrado.group(1)) + i for i, chave in enumerate(pedidos)}
+            
+            # Linhas entre o ponto de partida mais antigo e a última reserva desta chamada
+            inicio = min(pontos[chave][1] for chave in pedidos) + 1
+            fim = max(minhas.values())
+            reservas = self._aba('Reservas_ID').get_values(
+                f'A{inicio}:B{fim}', value_render_option='UNFORMATTED_VALUE'
+            ) if inicio <= fim else []
+            
+            primeiros = {}
+            atualizacoes = []
+            pos_valor, pos_reserva = self._colunas_contadores
+            for chave, qtd in pedidos.items():
+                idx, linha_reserva, valor = pontos[chave]
+                anteriores = sum(
+                    _inteiro_celula(linha[1])
+                    for linha in reservas[linha_reserva + 1 - inicio:minhas[chave] - inicio]
+                    if len(linha) > 1 and str(linha[0]) == chave
+                )
+                primeiros[chave] = valor + anteriores + 1
+                pontos[chave] = (idx, minhas[chave], valor + anteriores + qtd)
+                atualizacoes.append((idx, pos_valor, valor + anteriores + qtd))
+                atualizacoes.append((idx, pos_reserva, minhas[chave]))
+            
+            try:
+                self.gravar_celulas('Contadores', atualizacoes)
+            except Exception:
+                pass  # Só encurta as próximas leituras: os blocos já estão garantidos pelas linhas
+            return primeiros
 
 
-@st.cache_data(ttl=300, show_spinner=False)
-def carregar_compras(_spreadsheet, _cache_key):
-    """Carrega todas as compras (com cache de 5 minutos)"""
-    # Colunas esperadas
-    COLUNAS_COMPRAS = ['ID_Compra', 'Data', 'Produto', 'Quantidade', 'Preço_Unit', 'Total', 'Pagamento', 'Observação']
+class ArmazenamentoSQLite(Armazenamento):
+    """
+    Armazenamento local em SQLite: uma tabela por aba, com a coluna `linha` no papel do
+    número da linha da planilha. Responde em milissegundos e serve também como
+    substituto offline do Google Sheets para testes.
+    """
     
-    try:
-        ws = _spreadsheet.worksheet('Compras')
-        # Usa UNFORMATTED_VALUE para obter números corretamente
-        dados = ws.get_all_records(value_render_option='UNFORMATTED_VALUE')
-        
-        if dados:
-            df = pd.DataFrame(dados)
-        else:
-            # Retorna DataFrame vazio com as colunas esperadas
-            df = pd.DataFrame(columns=COLUNAS_COMPRAS)
+    remoto = False
+    
+    # Índices para as buscas mais comuns (produto por nome, itens de uma compra, períodos)
+    INDICES = {
+        'Produtos': ['Nome', 'Codigo'],
+        'Compras': ['ID_Compra', 'Data'],
+        'Movimentacoes': ['Data', 'Produto'],
+        'Contadores': ['Chave'],
+        'Resumo_Diario': ['Chave', 'Dia'],
+        'Alertas_Estado': ['Produto'],
+        'Estoque_Snapshot': ['Linha_Mov'],
+    }
+    
+    COLUNAS_INTEIRAS = {'ID', 'Valor', 'Compras', 'Itens', 'Linha_Mov'}
+    COLUNAS_REAIS = {'Preço', 'Estoque_Atual', 'Estoque_Minimo', 'Quantidade', 'Preço_Unit', 'Total', 'Estoque'}
+    
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.id = f"sqlite:{os.path.abspath(caminho)}"
+        self._lock = threading.RLock()
+        self._colunas = {}
+        # Uma conexão por processo, compartilhada entre as sessões (protegida pelo lock)
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._conexao.execute('PRAGMA journal_mode=WAL')
+        self._conexao.execute('PRAGMA synchronous=NORMAL')
+    
+    @staticmethod
+    def _nome(identificador):
+        """Identificador SQL entre aspas (as colunas têm acentos)"""
+        return '"' + str(identificador).replace('"', '""') + '"'
+    
+    def _tipo(self, coluna):
+        if coluna in self.COLUNAS_INTEIRAS:
+            return 'INTEGER'
+        if coluna in self.COLUNAS_REAIS:
+            return 'REAL'
+        return 'TEXT'
+    
+    def _cabecalho(self, aba):
+        if aba not in self._colunas:
+            info = self._conexao.execute(f'PRAGMA table_info({self._nome(aba)})').fetchall()
+            self._colunas[aba] = [col[1] for col in info if col[1] != 'linha']
+        return self._colunas[aba]
+    
+    @contextmanager
+    def _transacao(self):
+        """Transação com trava de escrita imediata (também entre processos)"""
+        with self._lock:
+            self._conexao.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conexao
+            except BaseException:
+                self._conexao.execute('ROLLBACK')
+                raise
+            else:
+                self._conexao.execute('COMMIT')
+    
+    def garantir_estrutura(self, esquema):
+        # A versão do esquema fica no cabeçalho do arquivo (PRAGMA user_version)
+        versao = int(versao_esquema(esquema)[:7], 16)
+        if self._conexao.execute('PRAGMA user_version').fetchone()[0] == versao:
+            return
         
-        # Garante que todas as colunas existam
-        for col in COLUNAS_COMPRAS:
-            if col not in df.columns:
-                df[col] = ''
+        with self._transacao() as conexao:
+            conexao.execute(f'PRAGMA user_version = {versao}')
+            for aba, colunas in esquema.items():
+                self._colunas.pop(aba, None)
+                existentes = self._cabecalho(aba)
+                
+                if not existentes:
+                    definicoes = ', '.join(f'{self._nome(c)} {self._tipo(c)}' for c in colunas)
+                    conexao.execute(f'CREATE TABLE {self._nome(aba)} (linha INTEGER PRIMARY KEY, {definicoes})')
+                else:
+                    for coluna in colunas:
+                        if coluna not in existentes:
+                            conexao.execute(
+                                f'ALTER TABLE {self._nome(aba)} ADD COLUMN {self._nome(coluna)} {self._tipo(coluna)}'
+                            )
+                
+                for coluna in self.INDICES.get(aba, []):
+                    conexao.execute(
+                        f'CREATE INDEX IF NOT EXISTS {self._nome(f"idx_{aba}_{coluna}")} '
+                        f'ON {self._nome(aba)} ({self._nome(coluna)})'
+                    )
+                self._colunas.pop(aba, None)
+    
+    def ler_registros(self, aba):
+        with self._lock:
+            colunas = self._cabecalho(aba)
+            if not colunas:
+                return []
+            cursor = self._conexao.execute(
+                f'SELECT {", ".join(self._nome(c) for c in colunas)} FROM {self._nome(aba)} ORDER BY linha'
+            )
+            return [
+                {coluna: ('' if valor is None else valor) for coluna, valor in zip(colunas, linha)}
+                for linha in cursor
+            ]
+    
+    def ler_coluna(self, aba, coluna):
+        with self._lock:
+            nome_coluna = self._cabecalho(aba)[coluna - 1]
+            cursor = self._conexao.execute(
+                f'SELECT {self._nome(nome_coluna)} FROM {self._nome(aba)} ORDER BY linha'
+            )
+            return ['' if linha[0] is None else linha[0] for linha in cursor]
+    
+    def ler_colunas(self, aba, primeira_linha=2, ultima_linha=None):
+        with self._lock:
+            colunas = self._cabecalho(aba)
+            if not colunas:
+                return [], {}
+            # Células vazias voltam como '' (como no Sheets) já pelo SQLite
+            selecao = ", ".join("COALESCE(" + self._nome(c) + ", '')" for c in colunas)
+            linhas = self._conexao.execute(
+                f'SELECT {selecao} FROM {self._nome(aba)} WHERE linha >= ? AND linha <= ? ORDER BY linha',
+                (primeira_linha, ultima_linha if ultima_linha is not None else sys.maxsize)
+            ).fetchall()
         
-        # Garante que colunas numéricas sejam numéricas
-        for col in ['Quantidade', 'Preço_Unit', 'Total']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        if not linhas:
+            return list(colunas), {coluna: [] for coluna in colunas}
         
-        return df
-    except Exception as e:
-        # Em caso de erro, retorna DataFrame vazio com estrutura correta
-        return pd.DataFrame(columns=COLUNAS_COMPRAS)
+        # Transpõe pelo numpy: bem mais rápido que zip(*linhas) com centenas de milhares de linhas
+        matriz = np.array(linhas, dtype=object)
+        return list(colunas), {coluna: matriz[:, posicao].tolist() for posicao, coluna in enumerate(colunas)}
+    
+    def _inserir(self, conexao, aba, linhas):
+        colunas = self._cabecalho(aba)
+        proxima = conexao.execute(f'SELECT COALESCE(MAX(linha), 1) + 1 FROM {self._nome(aba)}').fetchone()[0]
+        registros = [
+            (proxima + offset, *(list(linha) + [''] * len(colunas))[:len(colunas)])
+            for offset, linha in enumerate(linhas)
+        ]
+        conexao.executemany(
+            f'INSERT INTO {self._nome(aba)} (linha, {", ".join(self._nome(c) for c in colunas)}) '
+            f'VALUES ({", ".join("?" * (len(colunas) + 1))})',
+            registros
+        )
+    
+    def anexar_linhas(self, aba, linhas):
+        with self._transacao() as conexao:
+            self._inserir(conexao, aba, linhas)
+    
+    def gravar_celulas(self, aba, celulas):
+        with self._transacao() as conexao:
+            colunas = self._cabecalho(aba)
+            for linha, coluna, valor in celulas:
+                conexao.execute(
+                    f'UPDATE {self._nome(aba)} SET {self._nome(colunas[coluna - 1])} = ? WHERE linha = ?',
+                    (valor, linha)
+                )
+    
+    def gravar_celulas_chave(self, aba, celulas):
+        with self._transacao() as conexao:
+            colunas = self._cabecalho(aba)
+            for chave, coluna, valor in celulas:
+                conexao.execute(
+                    f'UPDATE {self._nome(aba)} SET {self._nome(colunas[coluna - 1])} = ? '
+                    f'WHERE {self._nome(colunas[0])} = ?',
+                    (valor, chave)
+                )
+    
+    def reservar_numeros(self, pedidos):
+        # BEGIN IMMEDIATE garante a atomicidade, inclusive entre processos
+        with self._transacao() as conexao:
+            primeiros = {}
+            for chave, qtd in pedidos.items():
+                linha = conexao.execute('SELECT Valor FROM Contadores WHERE Chave = ?', (chave,)).fetchone()
+                if linha is None:
+                    ultimo = _migrar_contador(self, chave)
+                    self._inserir(conexao, 'Contadores', [[chave, ultimo, '']])
+                else:
+                    ultimo = _numero_do_id(linha[0])
+                conexao.execute('UPDATE Contadores SET Valor = ? WHERE Chave = ?', (ultimo + qtd, chave))
+                primeiros[chave] = ultimo + 1
+            return primeiros
 
 
-def registrar_compra(spreadsheet, itens, metodo_pagamento, observacao=""):
-    """Registra uma nova compra/venda com múltiplos itens, desconta do estoque e verifica alertas"""
+def configuracao_armazenamento():
+    """
+    Lê a seção [armazenamento] dos secrets:
+    motor = "sheets" (padrão) ou "sqlite"; caminho = arquivo do banco SQLite
+    """
     try:
-        ws_compras = spreadsheet.worksheet('Compras')
-        ws_produtos = spreadsheet.worksheet('Produtos')
-        
-        dados = ws_compras.get_all_values()
-        id_compra = f"CMP{len(dados):04d}"
-        data_atual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Garante valores válidos
-        metodo_pagamento = str(metodo_pagamento or "Não informado").strip()
-        observacao = str(observacao or "").strip()
-        
-        # Carrega dados dos produtos para atualizar estoque
-        produtos_dados = ws_produtos.get_all_records()
-        headers_produtos = ws_produtos.row_values(1)
-        col_estoque = headers_produtos.index('Estoque_Atual') + 1 if 'Estoque_Atual' in headers_produtos else None
-        
-        produtos_criticos = []
+        if "armazenamento" in st.secrets:
+            return dict(st.secrets["armazenamento"])
+    except Exception:
+        pass
+    return {}
+
+
+@st.cache_resource(ttl=600)
+def obter_armazenamento_sheets(_client, spreadsheet_name):
+    """Armazenamento no Google Sheets da planilha informada (com cache de 10 minutos)"""
+    return ArmazenamentoSheets(obter_planilha(_client, spreadsheet_name))
+
+
+@st.cache_resource
+def obter_armazenamento_sqlite(caminho):
+    """Armazenamento SQLite local (uma conexão por processo)"""
+    return ArmazenamentoSQLite(caminho)
+
+
+def _cronometrar(latencias, nome, funcao, *args, **kwargs):
+    """Executa uma chamada à API registrando sua latência (em ms) na lista informada"""
+    inicio = time.perf_counter()
+    try:
+        return funcao(*args, **kwargs)
+    finally:
+        latencias.append((nome, (time.perf_counter() - inicio) * 1000))
+
+
+# Armazenamentos com a estrutura já conferida neste processo (novas sessões não repetem a verificação)
+_estruturas_verificadas = set()
+_lock_estruturas = threading.Lock()
+
+
+def garantir_abas(banco):
+    """Garante que todas as abas do sistema existam com todas as colunas necessárias"""
+    with _lock_estruturas:
+        # Verifica se já foi executado neste processo
+        if banco.id in _estruturas_verificadas:
+            return banco
         
+        try:
+            banco.garantir_estrutura(ESQUEMA_ABAS)
+            
+            # Marca como verificado para todas as sessões
+            _estruturas_verificadas.add(banco.id)
+            
+        except Exception as e:
+            st.warning(f"⚠️ Aviso na verificação das abas: {e}")
+    
+    return banco
+
+
+def invalidar_estruturas():
+    """Faz a próxima sessão conferir de novo a estrutura das abas"""
+    with _lock_estruturas:
+        _estruturas_verificadas.clear()
+
+
+# ==================== CONTADORES DE ID ====================
+
+# Sequências de ID: prefixo e largura do número (sem prefixo = ID numérico)
+SEQUENCIAS_ID = {
+    'Produtos': ('', 0),
+    'Compras': ('CMP', 4),
+    'Movimentacoes': ('MOV', 5),
+    'Alertas_Config': ('', 0),
+}
+
+# Serializa as reservas de todas as sessões do processo (o Streamlit atende todas na mesma instância)
+_lock_contadores = threading.Lock()
+
+# Quantos números reservar por ida ao armazenamento remoto nas sequências de maior volume.
+# A venda recebe o ID sem esperar a rede; a sobra de um bloco se perde se o processo
+# reiniciar (a numeração pula, mas nunca repete).
+LOTE_RESERVA_ID = {'Compras': 20, 'Movimentacoes': 100}
+
+# Blocos já reservados: (banco.id, chave) -> [próximo número, limite exclusivo]
+_blocos_ids = {}
+_lock_blocos_ids = threading.Lock()
+
+
+def formatar_id(chave, numero):
+    """Formata o número de uma sequência no padrão da aba (ex: CMP0042, MOV00042 ou 42)"""
+    prefixo, largura = SEQUENCIAS_ID[chave]
+    if not prefixo:
+        return int(numero)
+    return f"{prefixo}{int(numero):0{largura}d}"
+
+
+def _numero_do_id(valor):
+    """Extrai o número de um ID existente ('CMP0042' -> 42, 7 -> 7)"""
+    digitos = re.sub(r'\D', '', str(valor))
+    return int(digitos) if digitos else 0
+
+
+def _inteiro_celula(valor):
+    """Número inteiro de uma célula lida (20, 20.0 ou '20'); IDs formatados viram o seu número"""
+    try:
+        return int(float(valor))
+    except (TypeError, ValueError):
+        return _numero_do_id(valor)
+
+
+def _migrar_contador(banco, chave):
+    """
+    Calcula o último ID emitido de uma aba pela numeração antiga.
+    Executado uma única vez por sequência, quando ela ainda não existe na aba Contadores.
+    """
+    ids = banco.ler_coluna(chave, 1)
+    maior = max((_numero_do_id(v) for v in ids), default=0)
+    # O esquema antigo usava o número de linhas da aba como próximo ID
+    return max(maior, len(ids))
+
+
+def alocar_ids(banco, pedidos, latencias=None):
+    """
+    Reserva IDs em uma ou mais sequências de uma só vez, sem nunca ler as abas de dados.
+    pedidos: {chave: quantidade}. Retorna {chave: [ids formatados]}.
+    Em armazenamento remoto, as sequências de LOTE_RESERVA_ID são servidas de blocos
+    reservados antecipadamente, então a maioria das chamadas não vai à rede.
+    """
+    if latencias is None:
+        latencias = []
+    
+    pedidos = {chave: int(qtd) for chave, qtd in pedidos.items() if qtd and int(qtd) > 0}
+    if not pedidos:
+        return {}
+    
+    if not banco.remoto:
+        primeiros = _cronometrar(latencias, f"reservar_numeros ({', '.join(pedidos)})", banco.reservar_numeros, pedidos)
+        return {
+            chave: [formatar_id(chave, n) for n in range(primeiros[chave], primeiros[chave] + qtd)]
+            for chave, qtd in pedidos.items()
+        }
+    
+    with _lock_blocos_ids:
+        # Sequências cujo bloco local não cobre o pedido: renova todas numa única reserva
+        renovar = {}
+        for chave, qtd in pedidos.items():
+            proximo, limite = _blocos_ids.get((banco.id, chave), (0, 0))
+            if limite - proximo < qtd:
+                renovar[chave] = max(qtd - (limite - proximo), LOTE_RESERVA_ID.get(chave, 0))
+        
+        novos_blocos = {}
+        if renovar:
+            primeiros = _cronometrar(latencias, f"reservar_numeros ({', '.join(renovar)})",
+                                     banco.reservar_numeros, renovar)
+            novos_blocos = {chave: (primeiros[chave], primeiros[chave] + qtd) for chave, qtd in renovar.items()}
+        
+        resultado = {}
+        for chave, qtd in pedidos.items():
+            # Usa primeiro a sobra do bloco atual e depois o bloco novo
+            proximo, limite = _blocos_ids.get((banco.id, chave), (0, 0))
+            numeros = list(range(proximo, limite))[:qtd]
+            if len(numeros) < qtd:
+                inicio_novo, limite = novos_blocos[chave]
+                proximo = inicio_novo + (qtd - len(numeros))
+                numeros += list(range(inicio_novo, proximo))
+            else:
+                proximo += qtd
+            _blocos_ids[(banco.id, chave)] = (proximo, limite)
+            resultado[chave] = [formatar_id(chave, n) for n in numeros]
+        
+        return resultado
+
+
+def alocar_id(banco, chave, latencias=None):
+    """Reserva um único ID da sequência informada"""
+    return alocar_ids(banco, {chave: 1}, latencias)[chave][0]
+
+
+# ==================== VERSÕES DOS DADOS ====================
+
+# Versão de cada tabela por armazenamento, compartilhada por todas as sessões do processo.
+# Toda gravação avança a versão das tabelas alteradas; as leituras em cache usam a versão
+# como chave, então qualquer sessão passa a ver o dado novo logo após a gravação de outra.
+_versoes_dados = {}
+_epoca_dados = 0  # avança em "Recarregar Dados" e invalida todas as tabelas
+_lock_versoes = threading.Lock()
+
+
+def versao_dados(banco, tabela):
+    """Chave de cache da versão atual da tabela: (armazenamento, tabela, época, versão)"""
+    with _lock_versoes:
+        return (banco.id, tabela, _epoca_dados, _versoes_dados.get((banco.id, tabela), 0))
+
+
+def nova_versao(banco, *tabelas):
+    """Marca as tabelas como alteradas; sem banco, invalida todas as tabelas de todos os armazenamentos"""
+    global _epoca_dados
+    with _lock_versoes:
+        if banco is None:
+            _epoca_dados += 1
+            return
+        for tabela in tabelas:
+            _versoes_dados[(banco.id, tabela)] = _versoes_dados.get((banco.id, tabela), 0) + 1
+
+
+# ==================== CARREGAMENTO TIPADO ====================
+
+# Tipo final de cada coluna: cada coluna é montada direto nesse tipo a partir da lista lida
+TIPOS_COLUNAS = {
+    'ID': 'inteiro',
+    'Compras': 'inteiro',
+    'Itens': 'inteiro',
+    'Linha_Mov': 'inteiro',
+    'Preço': 'numero',
+    'Preço_Unit': 'numero',
+    'Total': 'numero',
+    'Quantidade': 'numero',
+    'Estoque_Atual': 'numero',
+    'Estoque_Minimo': 'numero',
+    'Estoque': 'numero',
+    'Categoria': 'categoria',
+    'Unidade': 'categoria',
+    'Pagamento': 'categoria',
+    'Produto': 'categoria',
+    'Tipo': 'categoria',
+    'Data': 'data',
+    'Dia': 'data',
+    'Codigo': 'codigo',
+}
+
+FORMATO_DATA = '%Y-%m-%d %H:%M:%S'
+
+
+def _coluna_data(valores):
+    """Datas gravadas pelo sistema (FORMATO_DATA); outras datas digitadas e números de série do Sheets também são aceitos"""
+    # Caminho rápido: só textos em formato ISO, convertidos direto pelo numpy ('' vira NaT)
+    if all(isinstance(v, str) for v in valores):
+        try:
+            return pd.Series(np.array(valores, dtype='datetime64[s]').astype('datetime64[ns]'))
+        except ValueError:
+            pass
+    
+    serie = pd.Series(valores, dtype=object)
+    datas = pd.to_datetime(serie, format=FORMATO_DATA, errors='coerce')
+    
+    faltantes = datas.isna() & serie.ne('') & serie.notna()
+    if faltantes.any():
+        numeros = pd.to_numeric(serie[faltantes], errors='coerce')
+        seriais = numeros.notna()
+        datas[faltantes] = pd.to_datetime(serie[faltantes].astype(str), format='ISO8601', errors='coerce')
+        datas[numeros[seriais].index] = pd.Timestamp('1899-12-30') + pd.to_timedelta(numeros[seriais], unit='D')
+    return datas
+
+
+def _coluna_tipada(nome, valores):
+    """Series já no tipo final da coluna (números sem valor viram 0)"""
+    tipo = TIPOS_COLUNAS.get(nome)
+    if tipo in ('numero', 'inteiro'):
+        try:
+            serie = pd.Series(np.array(valores, dtype='float64'))  # só números: conversão direta
+        except (ValueError, TypeError):
+            serie = pd.to_numeric(pd.Series(valores, dtype=object), errors='coerce')
+        return serie.fillna(0).astype('int64' if tipo == 'inteiro' else 'float64')
+    if tipo == 'categoria':
+        codigos, categorias = pd.factorize(np.array(valores, dtype=object), sort=True)
+        if not all(isinstance(c, str) for c in categorias):
+            codigos, categorias = pd.factorize(np.array([str(v) for v in valores], dtype=object), sort=True)
+        return pd.Series(pd.Categorical.from_codes(codigos, categorias))
+    if tipo == 'data':
+        return _coluna_data(valores)
+    if tipo == 'codigo':
+        return pd.Series([normalizar_codigo(v) for v in valores], dtype=object)
+    return pd.Series(valores, dtype=object)
+
+
+def montar_tabela(cabecalho, colunas, esperadas):
+    """
+    DataFrame tipado a partir das colunas lidas (ler_colunas), na ordem do cabeçalho,
+    com as colunas esperadas que faltarem. A ordem real do cabeçalho fica em attrs['cabecalho'].
+    """
+    total = len(next(iter(colunas.values()), []))
+    dados = {nome: _coluna_tipada(nome, colunas[nome]) for nome in cabecalho if nome}
+    for nome in esperadas:
+        if nome not in dados:
+            dados[nome] = _coluna_tipada(nome, [''] * total)
+    
+    df = pd.DataFrame(dados)
+    df.attrs['cabecalho'] = list(cabecalho)
+    return df
+
+
+def concatenar_tabelas(anterior, novas):
+    """Junta duas tabelas tipadas sem perder as colunas categóricas (as categorias são unidas)"""
+    if anterior.empty:
+        return novas
+    if novas.empty:
+        return anterior
+    
+    anterior = anterior.copy(deep=False)
+    novas = novas.copy(deep=False)
+    for coluna in anterior.columns:
+        if (coluna in novas.columns and isinstance(anterior[coluna].dtype, pd.CategoricalDtype)
+                and isinstance(novas[coluna].dtype, pd.CategoricalDtype)):
+            categorias = anterior[coluna].cat.categories.union(novas[coluna].cat.categories)
+            anterior[coluna] = anterior[coluna].cat.set_categories(categorias)
+            novas[coluna] = novas[coluna].cat.set_categories(categorias)
+    
+    df = pd.concat([anterior, novas], ignore_index=True)
+    df.attrs = dict(novas.attrs)
+    return df
+
+
+def _ler_produtos(banco):
+    """Lê a aba Produtos diretamente do armazenamento (sem cache)"""
+    try:
+        cabecalho, colunas = banco.ler_colunas('Produtos')
+        return montar_tabela(cabecalho, colunas, ESQUEMA_ABAS['Produtos'])
+    except Exception as e:
+        # Em caso de erro, retorna DataFrame vazio com estrutura correta
+        return pd.DataFrame(columns=ESQUEMA_ABAS['Produtos'])
+
+
+@st.cache_data(ttl=300, max_entries=8, show_spinner=False)
+def carregar_produtos(_banco, versao):
+    """
+    Carrega todos os produtos da aba Produtos (com cache de 5 minutos).
+    versao = versao_dados(banco, 'Produtos'): uma cópia em cache por versão, para todas as sessões.
+    """
+    return _ler_produtos(_banco)
+
+
+# ==================== ÍNDICE DE PRODUTOS ====================
+
+def normalizar_codigo(valor):
+    """Código de barras como texto, sem espaços (um código lido como número perde o '.0')"""
+    if valor is None or (isinstance(valor, float) and np.isnan(valor)):
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+
+class IndiceProdutos:
+    """
+    Índice em memória da aba Produtos: nome do produto <-> linha da planilha,
+    cabeçalho -> posição da coluna e código de barras -> produto. Permite gravar uma
+    célula de um produto com uma única escrita direcionada, sem ler a aba antes, e achar
+    o produto de um código lido no caixa sem percorrer o catálogo. O estoque atual não
+    fica aqui: vem das movimentações (SaldosEstoque).
+    """
+    
+    def __init__(self, df_produtos):
+        self.criado_em = time.monotonic()
+        self.linha_por_nome = {}
+        self.nome_por_linha = {}
+        self.minimo = {}  # nome -> estoque mínimo
+        self.registros = {}  # nome -> linha do produto como dicionário {coluna: valor}
+        self.nome_por_codigo = {}  # código de barras -> nome
+        self.posicao_coluna = {
+            coluna: pos for pos, coluna in enumerate(df_produtos.attrs.get('cabecalho', []), start=1)
+        }
+        
+        # A ordem do DataFrame é a ordem das linhas da planilha (linha 1 é o cabeçalho)
+        for linha, prod in enumerate(df_produtos.to_dict('records'), start=2):
+            nome = prod.get('Nome')
+            if nome:
+                self.nome_por_linha[linha] = nome
+            if nome and nome not in self.linha_por_nome:
+                self.linha_por_nome[nome] = linha
+                self.minimo[nome] = float(prod.get('Estoque_Minimo', 0) or 0)
+                self.registros[nome] = prod
+                codigo = normalizar_codigo(prod.get('Codigo'))
+                if codigo:
+                    self.nome_por_codigo.setdefault(codigo, nome)
+    
+    def expirado(self, ttl=300):
+        return time.monotonic() - self.criado_em > ttl
+    
+    def celula(self, nome, coluna):
+        """Posição (linha, coluna) da célula do produto, ou None se não existir"""
+        if nome not in self.linha_por_nome or coluna not in self.posicao_coluna:
+            return None
+        return self.linha_por_nome[nome], self.posicao_coluna[coluna]
+    
+    def produto_por_codigo(self, codigo):
+        """Registro do produto com o código de barras, ou None"""
+        nome = self.nome_por_codigo.get(normalizar_codigo(codigo))
+        return self.registros.get(nome) if nome else None
+
+
+# Índices compartilhados por todas as sessões do processo, por planilha
+_indices_produtos = {}
+_lock_indices = threading.Lock()
+
+
+def obter_indice_produtos(banco, nomes_necessarios=()):
+    """
+    Retorna o índice de produtos da planilha, construído a partir do cache de carregar_produtos.
+    Se algum dos nomes necessários não estiver no índice (produto cadastrado por outra sessão),
+    reconstrói com uma leitura nova da aba.
+    """
+    with _lock_indices:
+        indice = _indices_produtos.get(banco.id)
+        
+        if indice is None or indice.expirado():
+            df = carregar_produtos(banco, versao_dados(banco, 'Produtos'))
+            indice = IndiceProdutos(df)
+            _indices_produtos[banco.id] = indice
+        
+        if any(nome not in indice.linha_por_nome for nome in nomes_necessarios):
+            indice = IndiceProdutos(_ler_produtos(banco))
+            _indices_produtos[banco.id] = indice
+        
+        return indice
+
+
+def invalidar_indice_produtos(banco=None):
+    """Descarta o índice de uma planilha (ou de todas) para forçar a reconstrução"""
+    with _lock_indices:
+        if banco is None:
+            _indices_produtos.clear()
+        else:
+            _indices_produtos.pop(banco.id, None)
+
+
+def adicionar_produto(banco, nome, categoria, preco, unidade, estoque_atual=0, estoque_minimo=5, imagem_url="",
+                      codigo=""):
+    """Adiciona um novo produto com tratamento de erros; o estoque inicial entra como movimentação de entrada"""
+    try:
+        codigo = normalizar_codigo(codigo)
+        if codigo and obter_indice_produtos(banco).produto_por_codigo(codigo) is not None:
+            st.error(f"❌ O código {codigo} já é de outro produto")
+            return False
+        
+        # Estoque calculado antes do cadastro: o snapshot inicial não pode contar o estoque inicial duas vezes
+        obter_saldos_estoque(banco)
+        novo_id = alocar_id(banco, 'Produtos')
+        
+        # Garante que preço seja float
+        preco_float = float(preco) if preco else 0.0
+        estoque_atual_float = float(estoque_atual) if estoque_atual else 0.0
+        estoque_minimo_float = float(estoque_minimo) if estoque_minimo else 5.0
+        
+        # Garante que valores não sejam None
+        nome = str(nome or "").strip()
+        categoria = str(categoria or "").strip()
+        unidade = str(unidade or "un").strip()
+        imagem_url = str(imagem_url or "").strip()
+        
+        banco.anexar_linhas('Produtos', [[
+            novo_id,
+            nome,
+            categoria,
+            preco_float,
+            unidade,
+            estoque_atual_float,
+            estoque_minimo_float,
+            imagem_url,
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            codigo
+        ]])
+        invalidar_indice_produtos(banco)
+        nova_versao(banco, 'Produtos')
+        
+        if estoque_atual_float > 0:
+            registrar_movimentacao(banco, "Entrada", nome, estoque_atual_float, "Estoque inicial")
+        return True
+    except Exception as e:
+        st.error(f"❌ Erro ao adicionar produto: {e}")
+        return False
+
+
+# ==================== IMPORTAÇÃO DE PRODUTOS ====================
+
+UNIDADES = ["un", "kg", "L", "cx", "pct"]
+
+# Grafias aceitas no arquivo para cada unidade (já sem acento e em minúsculas)
+SINONIMOS_UNIDADE = {
+    'un': 'un', 'und': 'un', 'unid': 'un', 'unidade': 'un', 'pc': 'un', 'peca': 'un',
+    'kg': 'kg', 'quilo': 'kg', 'l': 'L', 'lt': 'L', 'litro': 'L',
+    'cx': 'cx', 'caixa': 'cx', 'pct': 'pct', 'pacote': 'pct',
+}
+
+# Nomes aceitos no cabeçalho do arquivo para cada coluna da aba Produtos (sem acento, minúsculas)
+COLUNAS_IMPORTACAO = {
+    'Nome': ['nome', 'produto', 'descricao'],
+    'Categoria': ['categoria'],
+    'Preço': ['preco', 'valor', 'preco_venda'],
+    'Unidade': ['unidade', 'un'],
+    'Estoque_Atual': ['estoque_atual', 'estoque', 'estoque_inicial'],
+    'Estoque_Minimo': ['estoque_minimo', 'minimo'],
+    'Imagem': ['imagem', 'url_imagem', 'imagem_url', 'foto'],
+    'Codigo': ['codigo', 'codigo_de_barras', 'ean', 'gtin', 'sku'],
+}
+
+# Linhas por gravação na importação (uma chamada à API por parte)
+LINHAS_POR_GRAVACAO_IMPORTACAO = 500
+
+
+def normalizar_textos(serie):
+    """Textos sem acento, em minúsculas e com espaços simples, para comparar nomes ('Açúcar ' == 'acucar')"""
+    return (serie.astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+            .str.casefold().str.strip().str.replace(r'\s+', ' ', regex=True))
+
+
+def _numeros_importados(serie):
+    """Números escritos como no Brasil ('R$ 1.234,50') ou como no Excel ('1234.5'); o resto vira NaN"""
+    texto = serie.astype(str).str.replace(r'[R$\s]', '', regex=True)
+    virgula = texto.str.contains(',', regex=False)
+    texto = texto.where(~virgula, texto.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(texto, errors='coerce')
+
+
+def colunas_do_arquivo(df_arquivo, nomes_aceitos):
+    """Coluna do arquivo para cada coluna do sistema ({destino: [nomes aceitos]}), ou None se faltar"""
+    apelidos = {}
+    for apelido, coluna in zip(normalizar_textos(pd.Series(df_arquivo.columns)).str.replace(' ', '_'), df_arquivo.columns):
+        apelidos.setdefault(apelido, coluna)
+    return {
+        destino: next((apelidos[nome] for nome in nomes if nome in apelidos), None)
+        for destino, nomes in nomes_aceitos.items()
+    }
+
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def ler_arquivo_produtos(conteudo, nome_arquivo):
+    """Tabela do arquivo enviado (CSV com qualquer separador ou XLSX), com todas as células como texto"""
+    if nome_arquivo.lower().endswith(('.xlsx', '.xls')):
+        return pd.read_excel(io.BytesIO(conteudo), dtype=str, keep_default_na=False)
+    
+    # CSV salvo pelo Excel em português costuma vir com ';' e em Windows-1252
+    try:
+        texto = conteudo.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        texto = conteudo.decode('cp1252')
+    return pd.read_csv(io.StringIO(texto), sep=None, engine='python', dtype=str, keep_default_na=False)
+
+
+def preparar_importacao(df_arquivo, df_produtos):
+    """
+    Valida e normaliza de uma vez todas as linhas do arquivo contra o catálogo atual.
+    Retorna (produtos válidos nas colunas da aba Produtos, linhas recusadas com Linha e Motivo).
+    Nomes repetidos no arquivo ou já cadastrados (sem diferenciar acento e caixa) são recusados,
+    assim como códigos de barras repetidos ou já usados por outro produto.
+    """
+    origem = colunas_do_arquivo(df_arquivo, COLUNAS_IMPORTACAO)
+    if origem['Nome'] is None:
+        raise ValueError("O arquivo precisa de uma coluna Nome (ou Produto)")
+    
+    vazia = pd.Series('', index=df_arquivo.index)
+    texto = {destino: (df_arquivo[col].astype(str).str.strip() if col is not None else vazia)
+             for destino, col in origem.items()}
+    
+    nomes = texto['Nome'].str.replace(r'\s+', ' ', regex=True)
+    precos = _numeros_importados(texto['Preço']).round(2)
+    estoques = _numeros_importados(texto['Estoque_Atual'].replace('', '0'))
+    minimos = _numeros_importados(texto['Estoque_Minimo'].replace('', '5'))
+    unidades = normalizar_textos(texto['Unidade'].replace('', 'un')).map(SINONIMOS_UNIDADE)
+    
+    codigos = texto['Codigo'].str.replace(r'\.0$', '', regex=True)
+    
+    chaves = normalizar_textos(nomes)
+    cadastrados = set(normalizar_textos(df_produtos['Nome'])) if not df_produtos.empty else set()
+    codigos_usados = set(df_produtos['Codigo'].map(normalizar_codigo)) - {''} if 'Codigo' in df_produtos.columns else set()
+    
+    motivo = pd.Series(np.select(
+        [
+            nomes.eq(''),
+            precos.isna() | precos.le(0),
+            unidades.isna(),
+            estoques.isna() | estoques.lt(0),
+            minimos.isna() | minimos.lt(0),
+            chaves.isin(cadastrados),
+            chaves.duplicated(),
+            codigos.isin(codigos_usados) | (codigos.ne('') & codigos.duplicated()),
+        ],
+        [
+            "Nome vazio",
+            "Preço inválido",
+            "Unidade desconhecida",
+            "Estoque inválido",
+            "Estoque mínimo inválido",
+            "Já cadastrado",
+            "Repetido no arquivo",
+            "Código de barras já usado",
+        ],
+        default=''
+    ), index=df_arquivo.index)
+    
+    validos = pd.DataFrame({
+        'Nome': nomes,
+        'Categoria': texto['Categoria'].replace('', 'Outros'),
+        'Preço': precos,
+        'Unidade': unidades,
+        'Estoque_Atual': estoques,
+        'Estoque_Minimo': minimos,
+        'Imagem': texto['Imagem'],
+        'Codigo': codigos,
+    })[motivo.eq('')].reset_index(drop=True)
+    
+    recusados = df_arquivo[motivo.ne('')].copy()
+    recusados.insert(0, 'Motivo', motivo[motivo.ne('')])
+    recusados.insert(0, 'Linha', recusados.index + 2)  # linha 1 do arquivo é o cabeçalho
+    return validos, recusados.reset_index(drop=True)
+
+
+def _anexar_repetindo(banco, aba, linhas, tentativas=3):
+    """
+    Anexa as linhas e, se a gravação falhar (cota esgotada, por exemplo), espera a cota
+    renovar e tenta de novo só com as linhas cujo ID (primeira coluna) ainda não está na aba.
+    """
+    for tentativa in range(tentativas):
+        try:
+            banco.anexar_linhas(aba, linhas)
+            return
+        except Exception:
+            if tentativa == tentativas - 1:
+                raise
+            time.sleep(BaldeCota.JANELA * random.uniform(0.5, 1.0))
+            existentes = {str(v) for v in banco.ler_coluna(aba, 1)}
+            linhas = [linha for linha in linhas if str(linha[0]) not in existentes]
+            if not linhas:
+                return
+
+
+def importar_produtos(banco, df_validos, progresso=None):
+    """
+    Cadastra os produtos validados por preparar_importacao em bloco: todos os IDs (produtos e
+    entradas de estoque inicial) reservados numa única ida à aba Contadores e as linhas gravadas
+    em partes de LINHAS_POR_GRAVACAO_IMPORTACAO, cada parte seguida das suas entradas de estoque.
+    progresso(gravados, total) é chamado depois de cada parte. Retorna quantos produtos foram gravados.
+    """
+    # Estoque calculado antes do cadastro, como em adicionar_produto
+    obter_saldos_estoque(banco)
+    
+    total = len(df_validos)
+    com_estoque = int(df_validos['Estoque_Atual'].gt(0).sum())
+    ids = alocar_ids(banco, {'Produtos': total, 'Movimentacoes': com_estoque})
+    ids_movimentacoes = iter(ids.get('Movimentacoes', []))
+    
+    data_atual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    linhas = [
+        [id_produto, nome, categoria, float(preco), unidade, float(estoque), float(minimo), imagem, data_atual, codigo]
+        for id_produto, (nome, categoria, preco, unidade, estoque, minimo, imagem, codigo) in zip(
+            ids.get('Produtos', []),
+            df_validos[['Nome', 'Categoria', 'Preço', 'Unidade', 'Estoque_Atual', 'Estoque_Minimo', 'Imagem', 'Codigo']]
+            .itertuples(index=False, name=None)
+        )
+    ]
+    
+    gravados = 0
+    novos_estoques = {}
+    for inicio in range(0, total, LINHAS_POR_GRAVACAO_IMPORTACAO):
+        parte = linhas[inicio:inicio + LINHAS_POR_GRAVACAO_IMPORTACAO]
+        _anexar_repetindo(banco, 'Produtos', parte)
+        gravados += len(parte)
+        invalidar_indice_produtos(banco)
+        nova_versao(banco, 'Produtos')
+        
+        entradas = [("Entrada", linha[1], linha[5], "Estoque inicial", "Importação") for linha in parte if linha[5] > 0]
+        if entradas:
+            linhas_mov = _linhas_movimentacao([next(ids_movimentacoes) for _ in entradas], entradas)
+            novos_estoques.update(movimentar_estoque(banco, _movimentos_das_linhas(linhas_mov)))
+            try:
+                _anexar_repetindo(banco, 'Movimentacoes', linhas_mov)
+            except Exception:
+                invalidar_saldos_estoque(banco)  # Recalculado pelas movimentações gravadas
+                raise
+            nova_versao(banco, 'Movimentacoes')
+        
+        if progresso is not None:
+            progresso(gravados, total)
+    
+    _informar_estoques(banco, novos_estoques)
+    return gravados
+
+
+# ==================== EDIÇÃO DO CATÁLOGO ====================
+
+# Colunas da aba Produtos editáveis na tabela: o Nome identifica o produto nas compras e
+# movimentações, e o estoque vem das movimentações
+COLUNAS_EDITAVEIS_PRODUTOS = ['Categoria', 'Preço', 'Unidade', 'Estoque_Minimo', 'Imagem', 'Codigo']
+
+# Colunas que não podem ficar vazias (as demais podem ser apagadas na tabela)
+COLUNAS_OBRIGATORIAS_PRODUTOS = ['Nome', 'Preço', 'Unidade', 'Estoque_Minimo']
+
+
+def _texto_celulas(serie):
+    """Células como texto sem espaços nas pontas; vazias (None/NaN) viram ''"""
+    serie = serie.astype(object)
+    return serie.where(serie.notna(), '').astype(str).str.strip()
+
+
+def alteracoes_catalogo(df_original, df_editado):
+    """
+    Células que mudaram entre a tabela carregada e a editada, comparadas coluna a coluna.
+    As linhas são casadas pelo índice, que é a posição do produto na aba (linha = posição + 2):
+    planilhas antigas podem ter IDs repetidos ou ilegíveis. Uma célula apagada conta como
+    alteração: texto vazio vira '' e número vazio fica NaN (recusado depois nas colunas
+    obrigatórias). Dois números vazios ou ilegíveis são iguais.
+    Retorna um DataFrame com Linha, ID, Nome, Coluna, Antes e Depois.
+    """
+    original = df_original
+    editado = df_editado.reindex(original.index)
+    
+    partes = []
+    for coluna in COLUNAS_EDITAVEIS_PRODUTOS:
+        if coluna not in original.columns or coluna not in editado.columns:
+            continue
+        antes, depois = original[coluna], editado[coluna]
+        if TIPOS_COLUNAS.get(coluna) == 'numero':
+            antes = pd.to_numeric(antes, errors='coerce')
+            depois = pd.to_numeric(depois, errors='coerce')
+            iguais = np.isclose(antes.fillna(0), depois.fillna(0), rtol=0, atol=1e-9)
+            mudou = antes.isna().ne(depois.isna()) | (antes.notna() & depois.notna() & ~iguais)
+        else:
+            antes, depois = _texto_celulas(antes), _texto_celulas(depois)
+            mudou = antes.ne(depois)
+        if mudou.any():
+            partes.append(pd.DataFrame({
+                'Linha': original.index[mudou.values] + 2,
+                'ID': original.loc[mudou.values, 'ID'].values,
+                'Nome': original.loc[mudou.values, 'Nome'].astype(str).values,
+                'Coluna': coluna,
+                'Antes': antes[mudou].astype(object).values,
+                'Depois': depois[mudou].astype(object).values,
+            }))
+    
+    if not partes:
+        return pd.DataFrame(columns=['Linha', 'ID', 'Nome', 'Coluna', 'Antes', 'Depois'])
+    return pd.concat(partes, ignore_index=True)
+
+
+def validar_alteracoes_catalogo(alteracoes, df_produtos=None):
+    """
+    Separa as alterações válidas das recusadas (coluna obrigatória vazia, preço não positivo,
+    mínimo negativo, unidade desconhecida e, com o catálogo em df_produtos, código de barras
+    que ficaria repetido)
+    """
+    coluna, depois = alteracoes['Coluna'], alteracoes['Depois']
+    numero = pd.to_numeric(depois, errors='coerce')
+    vazia = _texto_celulas(depois).eq('')
+    invalida = (
+        (coluna.isin(COLUNAS_OBRIGATORIAS_PRODUTOS) & vazia)
+        | (coluna.eq('Preço') & ~numero.gt(0))
+        | (coluna.eq('Estoque_Minimo') & ~numero.ge(0))
+        | (coluna.eq('Unidade') & ~depois.isin(UNIDADES))
+    )
+    
+    if df_produtos is not None and coluna.eq('Codigo').any():
+        # Códigos como ficariam depois de gravar: repetidos entre produtos diferentes são recusados
+        codigos = pd.Series(df_produtos['Codigo'].map(normalizar_codigo).values, index=df_produtos.index + 2)
+        mudancas = alteracoes[coluna.eq('Codigo')]
+        codigos.update(pd.Series(mudancas['Depois'].map(normalizar_codigo).values, index=mudancas['Linha'].values))
+        repetidos = set(codigos[codigos.ne('') & codigos.duplicated(keep=False)])
+        invalida |= coluna.eq('Codigo') & depois.map(normalizar_codigo).isin(repetidos)
+    return alteracoes[~invalida].reset_index(drop=True), alteracoes[invalida].reset_index(drop=True)
+
+
+def reajustar_precos(df_produtos, percentual, categoria=None):
+    """Tabela com os preços da categoria (ou de todos os produtos) reajustados em percentual, arredondados ao centavo"""
+    if categoria:
+        selecionados = df_produtos['Categoria'].astype(str).eq(categoria)
+    else:
+        selecionados = pd.Series(True, index=df_produtos.index)
+    precos = df_produtos['Preço'].where(~selecionados, (df_produtos['Preço'] * (1 + percentual / 100)).round(2))
+    return df_produtos.assign(Preço=precos)
+
+
+def gravar_alteracoes_catalogo(banco, alteracoes):
+    """
+    Grava só as células alteradas (alteracoes_catalogo), todas numa única gravação, na linha
+    de cada alteração. Se o índice de produtos mostra outro produto nessa linha (a aba mudou
+    desde a leitura), o produto é procurado pelo nome. Retorna o número de células gravadas.
+    """
+    if alteracoes.empty:
+        return 0
+    
+    indice = obter_indice_produtos(banco, alteracoes['Nome'].unique())
+    celulas = []
+    for linha, nome, coluna, valor in alteracoes[['Linha', 'Nome', 'Coluna', 'Depois']].itertuples(index=False, name=None):
+        linha = int(linha)
+        if indice.nome_por_linha.get(linha) != nome:
+            linha = indice.linha_por_nome.get(nome)
+        if linha is None or coluna not in indice.posicao_coluna:
+            raise ValueError(f"Produto {nome} não encontrado na planilha")
+        if TIPOS_COLUNAS.get(coluna) == 'numero':
+            valor = round(float(valor), 2)
+        elif TIPOS_COLUNAS.get(coluna) == 'codigo':
+            valor = normalizar_codigo(valor)
+        else:
+            valor = '' if pd.isna(valor) else str(valor).strip()
+        celulas.append((linha, indice.posicao_coluna[coluna], valor))
+    
+    banco.gravar_celulas('Produtos', celulas)
+    invalidar_indice_produtos(banco)  # O estoque mínimo e os códigos de barras podem ter mudado
+    nova_versao(banco, 'Produtos')
+    return len(celulas)
+
+
+# ==================== BUSCA DE PRODUTOS ====================
+
+class IndiceBusca:
+    """
+    Índice de busca pelos nomes dos produtos, sem diferenciar acentos e maiúsculas.
+    
+    Cada nome vira palavras normalizadas ('Açúcar Refinado' -> acucar, refinado). As palavras
+    ficam em ordem alfabética, cada uma com a lista dos seus produtos, e as listas ficam
+    contíguas: as palavras que começam com um prefixo são uma faixa achada por busca binária.
+    Um termo de 3 letras ou mais também é procurado pelos trigramas: as palavras que têm
+    todos os trigramas do termo e o contêm de fato casam como pedaço do meio ('ucar' em
+    açúcar); se o termo não é prefixo de nenhuma palavra, as parecidas o bastante casam como
+    erro de digitação. Um termo com dígitos
+    também casa com os códigos de barras que o contêm. Todo termo da consulta precisa casar
+    com alguma palavra do nome (ou com o código); a pontuação soma a qualidade de cada
+    casamento (palavra inteira, prefixo, pedaço, trigramas) e o empate vai para o nome mais
+    curto. Uma consulta igual a um código de barras cadastrado devolve só esse produto.
+    """
+    
+    SIMILARIDADE_MINIMA = 0.5  # fração dos trigramas em comum para aceitar um termo aproximado
+    TAMANHO_MINIMO_PEDACO = 3  # letras para procurar um termo no meio das palavras e dos códigos
+    
+    def __init__(self, df_produtos):
+        total = len(df_produtos)
+        self.nomes = df_produtos['Nome'].astype(str).to_numpy() if total else np.array([], dtype=object)
+        if 'Categoria' in df_produtos.columns:
+            self.categorias = df_produtos['Categoria'].astype(str).to_numpy()
+        else:
+            self.categorias = np.full(total, '', dtype=object)
+        self.tamanhos = np.array([len(nome) for nome in self.nomes], dtype=np.int32)
+        codigos = df_produtos['Codigo'] if 'Codigo' in df_produtos.columns else []
+        codigos = pd.Series([normalizar_codigo(codigo).lower() for codigo in codigos], dtype=object)
+        self.posicao_por_codigo = {codigo: i for i, codigo in enumerate(codigos) if codigo}
+        self._indexar_codigos(codigos)
+        
+        # Uma linha por (palavra, produto), agrupadas por palavra em ordem alfabética
+        palavras = normalizar_textos(pd.Series(self.nomes, dtype=object)).str.findall(r'[a-z0-9]+').explode().dropna()
+        codigos, unicas = pd.factorize(palavras, sort=True)
+        pares = np.unique(np.column_stack([codigos, palavras.index.to_numpy(dtype=np.int64)]), axis=0)
+        
+        # Palavras em ordem; os produtos da palavra i são produtos[inicio[i]:inicio[i + 1]]
+        pares = pares.reshape(-1, 2)
+        self.palavras = list(unicas)
+        self.produtos = pares[:, 1].copy()
+        self.inicio = np.searchsorted(pares[:, 0], np.arange(len(self.palavras) + 1))
+        
+        trigramas = [self._trigramas(palavra) for palavra in self.palavras]
+        por_trigrama = {}
+        for indice, trigramas_palavra in enumerate(trigramas):
+            for trigrama in trigramas_palavra:
+                por_trigrama.setdefault(trigrama, []).append(indice)
+        self.por_trigrama = {trigrama: np.array(indices, dtype=np.int64) for trigrama, indices in por_trigrama.items()}
+        self.total_trigramas = np.array([len(t) for t in trigramas], dtype=np.int64)
+    
+    def _indexar_codigos(self, codigos):
+        """
+        Sufixos dos códigos de barras (a partir de TAMANHO_MINIMO_PEDACO caracteres) em ordem,
+        cada um com a posição do seu produto: os códigos que contêm um termo são os donos da
+        faixa de sufixos que começam com ele, achada por busca binária como as palavras.
+        """
+        bytes_codigos = np.array([codigo.encode('utf-8') for codigo in codigos] or [b''])
+        largura = bytes_codigos.dtype.itemsize
+        if largura < self.TAMANHO_MINIMO_PEDACO:
+            self.sufixos_codigo = np.array([], dtype='S1')
+            self.dono_sufixo = np.array([], dtype=np.int64)
+            return
+        
+        # Matriz de bytes com zeros à direita: o sufixo que começa em k é matriz[:, k:k + largura]
+        matriz = np.zeros((len(bytes_codigos), 2 * largura), dtype=np.uint8)
+        matriz[:, :largura] = bytes_codigos.view(np.uint8).reshape(len(bytes_codigos), largura)
+        inicios = np.arange(largura - self.TAMANHO_MINIMO_PEDACO + 1)
+        sufixos = np.stack([matriz[:, k:k + largura] for k in inicios])
+        tamanhos = np.char.str_len(bytes_codigos)
+        validos = (tamanhos[None, :] - inicios[:, None]) >= self.TAMANHO_MINIMO_PEDACO
+        
+        sufixos = np.ascontiguousarray(sufixos[validos]).view(f'S{largura}').ravel()
+        donos = np.broadcast_to(np.arange(len(bytes_codigos), dtype=np.int64), validos.shape)[validos]
+        ordem = np.argsort(sufixos, kind='stable')
+        self.sufixos_codigo = sufixos[ordem]
+        self.dono_sufixo = donos[ordem]
+    
+    def _produtos_com_codigo(self, termo):
+        """Posições dos produtos cujo código de barras contém o termo"""
+        chave = termo.encode('utf-8')
+        if not len(self.sufixos_codigo) or len(chave) > self.sufixos_codigo.dtype.itemsize:
+            return self.dono_sufixo[:0]
+        
+        # Faixa dos sufixos que começam com a chave: de chave até a chave com o último byte + 1
+        limite = chave[:-1] + bytes([chave[-1] + 1])
+        primeira, depois = np.searchsorted(self.sufixos_codigo, [chave, limite])
+        return self.dono_sufixo[primeira:depois]
+    
+    @staticmethod
+    def _trigramas(palavra):
+        texto = f"  {palavra} "
+        return {texto[i:i + 3] for i in range(len(texto) - 2)}
+    
+    def _pontuar(self, termo):
+        """
+        Pontos de cada produto para um termo: 3 palavra inteira, 2 prefixo, 1,5 pedaço do meio
+        da palavra ou do código de barras, até 1 por trigramas
+        """
+        pontos = np.zeros(len(self.nomes), dtype=np.float64)
+        
+        primeira = bisect.bisect_left(self.palavras, termo)
+        depois = bisect.bisect_left(self.palavras, termo + '\uffff')
+        if primeira < depois:
+            pontos[self.produtos[self.inicio[primeira]:self.inicio[depois]]] = 2.0
+            if self.palavras[primeira] == termo:
+                pontos[self.produtos[self.inicio[primeira]:self.inicio[primeira + 1]]] = 3.0
+        
+        if len(termo) < self.TAMANHO_MINIMO_PEDACO:
+            return pontos
+        
+        if any(letra.isdigit() for letra in termo):
+            no_codigo = self._produtos_com_codigo(termo)
+            pontos[no_codigo] = np.maximum(pontos[no_codigo], 1.5)
+        
+        consulta = self._trigramas(termo)
+        listas = {trigrama: self.por_trigrama[trigrama] for trigrama in consulta if trigrama in self.por_trigrama}
+        if not listas:
+            return pontos
+        
+        # Pedaço do meio: candidatas com todos os trigramas internos do termo, conferidas por texto
+        internos = {termo[i:i + 3] for i in range(len(termo) - 2)}
+        if internos.issubset(listas):
+            vezes = np.bincount(np.concatenate([listas[trigrama] for trigrama in internos]), minlength=len(self.palavras))
+            for indice in np.flatnonzero(vezes == len(internos)):
+                if termo in self.palavras[indice]:
+                    faixa = self.produtos[self.inicio[indice]:self.inicio[indice + 1]]
+                    pontos[faixa] = np.maximum(pontos[faixa], 1.5)
+        
+        if primeira < depois:
+            return pontos  # Com prefixo achado, sem aproximação por erro de digitação
+        
+        comuns = np.bincount(np.concatenate(list(listas.values())), minlength=len(self.palavras))
+        similaridade = comuns / np.maximum(len(consulta), self.total_trigramas)
+        for indice in np.flatnonzero(similaridade >= self.SIMILARIDADE_MINIMA):
+            faixa = self.produtos[self.inicio[indice]:self.inicio[indice + 1]]
+            pontos[faixa] = np.maximum(pontos[faixa], similaridade[indice])
+        return pontos
+    
+    def buscar(self, consulta, categoria=None, limite=None):
+        """Posições (linhas da tabela de produtos) que casam com a consulta, das mais relevantes às menos"""
+        posicao = self.posicao_por_codigo.get(normalizar_codigo(consulta).lower())
+        if posicao is not None and (not categoria or self.categorias[posicao] == categoria):
+            return np.array([posicao], dtype=np.int64)
+        
+        termos = normalizar_textos(pd.Series([consulta or ''])).iloc[0]
+        termos = list(dict.fromkeys(re.findall(r'[a-z0-9]+', termos)))
+        
+        encontrados = np.ones(len(self.nomes), dtype=bool)
+        pontos = np.zeros(len(self.nomes), dtype=np.float64)
+        for termo in termos:
+            pontos_termo = self._pontuar(termo)
+            encontrados &= pontos_termo > 0
+            pontos += pontos_termo
+        if categoria:
+            encontrados &= self.categorias == categoria
+        
+        posicoes = np.flatnonzero(encontrados)
+        if termos:
+            posicoes = posicoes[np.lexsort((self.tamanhos[posicoes], -pontos[posicoes]))]
+        return posicoes[:limite] if limite else posicoes
+    
+    def categorias_encontradas(self, posicoes):
+        """Quantos produtos de cada categoria há entre as posições (facetas da busca)"""
+        return pd.Series(self.categorias[posicoes], dtype=object).value_counts()
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def indice_busca_produtos(_banco, versao):
+    """Índice de busca do catálogo, montado uma vez por versão da tabela de produtos"""
+    return IndiceBusca(carregar_produtos(_banco, versao))
+
+
+# ==================== SINCRONIZAÇÃO INCREMENTAL ====================
+
+class SincronizacaoIncremental:
+    """
+    Cópia em memória de uma aba só de acréscimo (Compras, Movimentacoes).
+    
+    Cada atualização lê apenas as linhas a partir da última já conhecida. Se essa linha
+    mudou ou sumiu, ou se o cabeçalho mudou, a aba foi editada e é relida inteira.
+    Edições em linhas mais antigas aparecem na releitura completa periódica
+    (RECARGA_COMPLETA) ou ao clicar em "Recarregar Dados".
+    """
+    
+    RECARGA_COMPLETA = 1800  # segundos
+    
+    def __init__(self, aba):
+        self.aba = aba
+        self.df = None
+        self.cabecalho = None
+        self.total = 0  # linhas já sincronizadas (linhas 2 a total + 1)
+        self.ultima_linha = None
+        self.recarregado_em = 0
+        self._lock = threading.Lock()
+    
+    def atualizar(self, banco):
+        """Traz as linhas novas e retorna o DataFrame completo"""
+        with self._lock:
+            completa = self.df is None or time.monotonic() - self.recarregado_em > self.RECARGA_COMPLETA
+            
+            if not completa:
+                try:
+                    # Relê a última linha conhecida junto com as novas, para conferir se nada mudou
+                    cabecalho, colunas = banco.ler_colunas(self.aba, self.total + 1 if self.total else 2)
+                    if self.total:
+                        primeira = tuple(valores[0] for valores in colunas.values() if valores)
+                        if not primeira or primeira != self.ultima_linha:
+                            completa = True
+                        colunas = {nome: valores[1:] for nome, valores in colunas.items()}
+                    if cabecalho != self.cabecalho:
+                        completa = True
+                except Exception:
+                    completa = True
+            
+            if completa:
+                cabecalho, colunas = banco.ler_colunas(self.aba)
+                self.df = montar_tabela(cabecalho, colunas, ESQUEMA_ABAS[self.aba])
+                self.total = 0
+                self.recarregado_em = time.monotonic()
+            elif any(colunas.values()):
+                novas = montar_tabela(cabecalho, colunas, ESQUEMA_ABAS[self.aba])
+                self.df = concatenar_tabelas(self.df, novas)
+            
+            self.cabecalho = cabecalho
+            novas_linhas = len(next(iter(colunas.values()), []))
+            if novas_linhas:
+                self.total += novas_linhas
+                self.ultima_linha = tuple(valores[-1] for valores in colunas.values())
+            return self.df
+
+
+# Uma cópia por aba e armazenamento, compartilhada por todas as sessões do processo
+_sincronizacoes = {}
+_lock_sincronizacoes = threading.Lock()
+
+
+def sincronizar_aba(banco, aba):
+    """DataFrame tipado e atualizado de uma aba só de acréscimo, lendo apenas as linhas novas"""
+    with _lock_sincronizacoes:
+        chave = (banco.id, aba)
+        if chave not in _sincronizacoes:
+            _sincronizacoes[chave] = SincronizacaoIncremental(aba)
+        sincronizacao = _sincronizacoes[chave]
+    return sincronizacao.atualizar(banco)
+
+
+def invalidar_sincronizacoes(banco=None):
+    """Descarta as cópias (de um armazenamento ou de todos) para forçar a releitura completa"""
+    with _lock_sincronizacoes:
+        for chave in list(_sincronizacoes):
+            if banco is None or chave[0] == banco.id:
+                del _sincronizacoes[chave]
+
+
+@st.cache_data(ttl=300, max_entries=8, show_spinner=False)
+def carregar_compras(_banco, versao):
+    """Carrega todas as compras (com cache de 5 minutos; só as linhas novas são lidas da planilha)"""
+    try:
+        return sincronizar_aba(_banco, 'Compras')
+    except Exception as e:
+        # Em caso de erro, retorna DataFrame vazio com estrutura correta
+        return pd.DataFrame(columns=ESQUEMA_ABAS['Compras'])
+
+
+# ==================== RESUMOS DIÁRIOS ====================
+
+def chave_resumo(dia, produto, pagamento, gravador=''):
+    """Chave de uma linha da aba Resumo_Diario (primeira coluna, única): a do gravador vem no fim"""
+    chave = f"{dia}|{produto}|{pagamento}"
+    return f"{chave}|{gravador}" if gravador else chave
+
+
+class ResumoDiario:
+    """
+    Totais das vendas por dia × produto × pagamento (aba Resumo_Diario), em memória.
+    
+    Cada instância só grava nas suas próprias linhas (coluna Gravador): uma venda soma seus
+    itens às linhas da instância nas chaves da venda, anexando as que ainda não existem e
+    regravando só as células dos totais das outras, endereçadas pela Chave. Os totais de
+    um dia × produto × pagamento são a soma das linhas de todas as instâncias, então duas
+    instâncias vendendo o mesmo produto ao mesmo tempo nunca gravam uma por cima da outra.
+    As linhas sem Gravador (montadas a partir da aba Compras) só são somadas.
+    As linhas com Produto vazio somam a venda inteira, para contar as compras sem repetir
+    as que têm vários produtos. O painel e os resumos do histórico leem daqui em vez de
+    somar todas as linhas da aba Compras.
+    """
+    
+    VALORES = ('Compras', 'Itens', 'Quantidade', 'Total')
+    
+    def __init__(self, df_resumo, gravador=''):
+        self.criado_em = time.monotonic()
+        self.gravador = gravador
+        self.cabecalho = df_resumo.attrs.get('cabecalho') or ESQUEMA_ABAS['Resumo_Diario']
+        self.posicao_coluna = {coluna: pos for pos, coluna in enumerate(self.cabecalho, start=1)}
+        self.linhas = {}  # chave -> [dia, produto, pagamento, compras, itens, quantidade, total] de todas as linhas
+        self.proprias = {}  # chave -> [compras, itens, quantidade, total] da linha desta instância
+        self.chaves_lidas = set()  # Chave das linhas já somadas
+        self._tabela = None
+        
+        for registro in df_resumo.to_dict('records'):
+            dia = registro.get('Dia')
+            if pd.isna(dia):
+                continue
+            self._somar_linha(dia.strftime('%Y-%m-%d'), registro)
+    
+    def expirado(self, ttl=300):
+        return time.monotonic() - self.criado_em > ttl
+    
+    def _somar(self, chave, dia, produto, pagamento, valores):
+        atual = self.linhas.setdefault(chave, [dia, produto, pagamento, 0, 0, 0.0, 0.0])
+        for posicao, valor in enumerate(valores, start=3):
+            atual[posicao] += valor
+        atual[6] = round(atual[6], 2)
+    
+    def _somar_linha(self, dia, registro):
+        """Soma uma linha da aba aos totais da sua chave (e à linha da instância, se for dela)"""
+        produto, pagamento = str(registro.get('Produto', '')), str(registro.get('Pagamento', ''))
+        chave = chave_resumo(dia, produto, pagamento)
+        valores = [registro.get(coluna, 0) for coluna in self.VALORES]
+        self._somar(chave, dia, produto, pagamento, valores)
+        
+        self.chaves_lidas.add(str(registro.get('Chave', '')))
+        if self.gravador and str(registro.get('Gravador', '')) == self.gravador:
+            self.proprias.setdefault(chave, valores)
+    
+    def _valores_linha(self, chave, dia, produto, pagamento, valores):
+        registro = dict(zip(('Dia', 'Produto', 'Pagamento') + self.VALORES, [dia, produto, pagamento, *valores]))
+        registro['Chave'] = chave_resumo(dia, produto, pagamento, self.gravador)
+        registro['Gravador'] = self.gravador
+        return [registro.get(coluna, '') for coluna in self.cabecalho]
+    
+    def acumular(self, linhas_compra):
+        """
+        Soma as linhas de uma venda (no formato da aba Compras) aos totais.
+        Retorna (linhas a anexar, células [(chave, coluna, valor)] das linhas desta instância a regravar).
+        """
+        incrementos = {}
+        for _, data, produto, quantidade, _, total, pagamento, _ in linhas_compra:
+            dia = data[:10]
+            for produto_chave in (produto, ''):
+                soma = incrementos.setdefault(
+                    chave_resumo(dia, produto_chave, pagamento),
+                    [dia, produto_chave, pagamento, 1, 0, 0.0, 0.0]  # a venda conta uma vez por chave
+                )
+                soma[4] += 1
+                soma[5] += quantidade
+                soma[6] += total
+        
+        novas, celulas = [], []
+        for chave, (dia, produto, pagamento, *valores) in incrementos.items():
+            valores[3] = round(valores[3], 2)
+            self._somar(chave, dia, produto, pagamento, valores)
+            
+            propria = self.proprias.get(chave)
+            if propria is None:
+                self.proprias[chave] = valores
+                novas.append(self._valores_linha(chave, dia, produto, pagamento, valores))
+                continue
+            
+            for posicao, valor in enumerate(valores):
+                propria[posicao] += valor
+            propria[3] = round(propria[3], 2)
+            chave_linha = chave_resumo(dia, produto, pagamento, self.gravador)
+            celulas.extend(
+                (chave_linha, self.posicao_coluna[coluna], valor)
+                for coluna, valor in zip(self.VALORES, propria) if coluna in self.posicao_coluna
+            )
+        
+        self._tabela = None
+        return novas, celulas
+    
+    def aplicar_pendentes(self, linhas, celulas):
+        """Sobrepõe aos totais lidos as gravações que ainda estão na fila de envio"""
+        for valores in linhas:
+            registro = dict(zip(self.cabecalho, valores))
+            if registro.get('Chave') and str(registro['Chave']) not in self.chaves_lidas:
+                self._somar_linha(registro['Dia'], registro)
+        
+        # As células regravadas são das linhas desta instância: os totais mudam pela diferença
+        por_chave_linha = {chave_resumo(*self.linhas[chave][:3], self.gravador): chave for chave in self.proprias}
+        for (chave_linha, coluna), valor in celulas.items():
+            chave = por_chave_linha.get(chave_linha)
+            nome = self.cabecalho[coluna - 1] if 0 < coluna <= len(self.cabecalho) else None
+            if chave is None or nome not in self.VALORES:
+                continue
+            posicao = self.VALORES.index(nome)
+            atual, propria = self.linhas[chave], self.proprias[chave]
+            atual[3 + posicao] += valor - propria[posicao]
+            atual[6] = round(atual[6], 2)
+            propria[posicao] = valor
+        self._tabela = None
+    
+    def tabela(self):
+        """DataFrame dos totais: Dia (data), Produto, Pagamento, Compras, Itens, Quantidade, Total, Ano, Mes"""
+        if self._tabela is None:
+            df = pd.DataFrame(
+                list(self.linhas.values()),
+                columns=['Dia', 'Produto', 'Pagamento', *self.VALORES]
+            )
+            df['Dia'] = pd.to_datetime(df['Dia'], format='%Y-%m-%d')
+            self._tabela = colunas_derivadas_data(df, 'Dia')
+        return self._tabela
+
+
+def resumir_compras(df_compras):
+    """Linhas da aba Resumo_Diario calculadas a partir de todas as linhas da aba Compras"""
+    df = df_compras[df_compras['Data'].notna()]
+    df = pd.DataFrame({
+        'ID_Compra': df['ID_Compra'].astype(str),
+        'Dia': df['Data'].dt.strftime('%Y-%m-%d'),
+        'Produto': df['Produto'].astype(str),
+        'Pagamento': df['Pagamento'].astype(str),
+        'Quantidade': df['Quantidade'],
+        'Total': df['Total'],
+    })
+    
+    grupos = [df, df.assign(Produto='')]  # a segunda cópia soma as vendas inteiras
+    resumo = pd.concat([
+        grupo.groupby(['Dia', 'Produto', 'Pagamento'], sort=True).agg(
+            Compras=('ID_Compra', 'nunique'),
+            Itens=('ID_Compra', 'size'),
+            Quantidade=('Quantidade', 'sum'),
+            Total=('Total', 'sum'),
+        ).reset_index()
+        for grupo in grupos
+    ], ignore_index=True).sort_values(['Dia', 'Produto', 'Pagamento'], kind='stable')
+    
+    return [
+        [chave_resumo(dia, produto, pagamento), dia, produto, pagamento,
+         int(compras), int(itens), float(quantidade), round(float(total), 2), '']
+        for dia, produto, pagamento, compras, itens, quantidade, total in resumo.itertuples(index=False)
+    ]
+
+
+# Resumos compartilhados por todas as sessões do processo, por armazenamento
+_resumos = {}
+_lock_resumos = threading.Lock()
+
+
+def obter_resumo_diario(banco):
+    """
+    Resumo diário do armazenamento, lido da aba Resumo_Diario e relido a cada 5 minutos
+    (para ver as vendas de outras instâncias), mas só quando não há vendas na fila de envio.
+    Se a aba estiver vazia e já houver compras, é montado uma vez a partir da aba Compras.
+    As linhas desta instância são as do gravador do diário (ou do processo, sem diário).
+    """
+    diario = obter_diario(banco)
+    with _lock_resumos:
+        resumo = _resumos.get(banco.id)
+        
+        if resumo is None or (resumo.expirado() and (diario is None or not diario.pendentes())):
+            cabecalho, colunas = banco.ler_colunas('Resumo_Diario')
+            df = montar_tabela(cabecalho, colunas, ESQUEMA_ABAS['Resumo_Diario'])
+            
+            if df.empty:
+                df_compras = sincronizar_aba(banco, 'Compras')
+                linhas = resumir_compras(df_compras) if not df_compras.empty else []
+                if linhas:
+                    banco.anexar_linhas('Resumo_Diario', linhas)
+                    nova_versao(banco, 'Resumo_Diario')
+                    cabecalho = ESQUEMA_ABAS['Resumo_Diario']
+                    df = montar_tabela(cabecalho, dict(zip(cabecalho, map(list, zip(*linhas)))), cabecalho)
+            
+            resumo = ResumoDiario(df, diario.gravador if diario is not None else _gravador_local)
+            if diario is not None:
+                resumo.aplicar_pendentes(
+                    diario.linhas_pendentes('Resumo_Diario'),
+                    diario.celulas_pendentes('Resumo_Diario', 'celulas_chave')
+                )
+            _resumos[banco.id] = resumo
+        
+        return resumo
+
+
+def invalidar_resumos(banco=None):
+    """Descarta o resumo de um armazenamento (ou de todos) para forçar a releitura da aba"""
+    with _lock_resumos:
+        if banco is None:
+            _resumos.clear()
+        else:
+            _resumos.pop(banco.id, None)
+
+
+def carregar_resumo_diario(banco):
+    """Totais por dia × produto × pagamento (ResumoDiario.tabela), ou tabela vazia em caso de erro"""
+    try:
+        resumo = obter_resumo_diario(banco)
+        with _lock_resumos:
+            return resumo.tabela()
+    except Exception:
+        return ResumoDiario(pd.DataFrame()).tabela()
+
+
+# ==================== COMPRAS POR PERÍODO ====================
+
+def faixa_do_periodo(df_resumo, inicio, fim):
+    """
+    Linhas (primeira, ultima) da aba Compras com as vendas entre as datas inicio e fim,
+    contadas pelos itens de cada dia do resumo diário (as compras são anexadas em ordem de data).
+    ultima None = até o fim da aba (o período chega ao último dia conhecido).
+    """
+    itens_por_dia = df_resumo[df_resumo['Produto'] == ''].groupby('Dia')['Itens'].sum()
+    dias = itens_por_dia.index.date
+    primeira = 2 + int(itens_por_dia[dias < inicio].sum())
+    if not len(dias) or fim >= dias.max():
+        return primeira, None
+    return primeira, 1 + int(itens_por_dia[dias <= fim].sum())
+
+
+def _no_periodo(df, inicio, fim):
+    """Linhas do período, com as colunas Ano e Mes já calculadas (ficam no cache com a carga)"""
+    mascara = mascara_filtros(df, condicoes_historico('Data', inicio=inicio, fim=fim))
+    return colunas_derivadas_data(df[mascara].reset_index(drop=True))
+
+
+@st.cache_data(ttl=300, max_entries=8, show_spinner=False)
+def carregar_compras_periodo(_banco, versao, inicio, fim):
+    """
+    Compras entre as datas inicio e fim (inclusive), lendo só a faixa de linhas do período.
+    A linha antes e a linha depois da faixa são lidas junto e conferidas; se não estiverem
+    fora do período (aba editada fora de ordem), as compras são filtradas da aba inteira.
+    """
+    try:
+        primeira, ultima = faixa_do_periodo(carregar_resumo_diario(_banco), inicio, fim)
+        if ultima is not None and ultima < primeira:
+            return _no_periodo(montar_tabela([], {}, ESQUEMA_ABAS['Compras']), inicio, fim)
+
+        inicio_leitura = max(2, primeira - 1)
+        cabecalho, colunas = _banco.ler_colunas('Compras', inicio_leitura, ultima + 1 if ultima else None)
+        df = montar_tabela(cabecalho, colunas, ESQUEMA_ABAS['Compras'])
+        datas = df['Data'].dt.date
+
+        antes_ok = inicio_leitura == primeira or (len(df) and datas.iloc[0] < inicio)
+        depois_ok = ultima is None or len(df) < ultima + 2 - inicio_leitura or datas.iloc[-1] > fim
+        if antes_ok and depois_ok:
+            return _no_periodo(df, inicio, fim)
+
+        return _no_periodo(sincronizar_aba(_banco, 'Compras'), inicio, fim)
+    except Exception as e:
+        # Em caso de erro, retorna DataFrame vazio com estrutura correta
+        return _no_periodo(montar_tabela([], {}, ESQUEMA_ABAS['Compras']), inicio, fim)
+
+
+# ==================== FILTROS DO HISTÓRICO ====================
+
+def colunas_derivadas_data(df, coluna='Data'):
+    """Acrescenta Ano e Mes da coluna de data (calculadas uma vez, junto com o carregamento)"""
+    datas = df[coluna]
+    df['Ano'] = datas.dt.year.fillna(0).astype('int16')
+    df['Mes'] = datas.dt.month.fillna(0).astype('int8')
+    return df
+
+
+OPERADORES_FILTRO = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<': operator.lt,
+}
+
+
+def mascara_filtros(df, condicoes):
+    """
+    Uma única máscara booleana com todas as condições [(coluna, operador, valor)];
+    condições com valor None estão desligadas. Cada condição é uma passada vetorizada
+    sobre a coluna, sem cópias do DataFrame.
+    """
+    mascara = np.ones(len(df), dtype=bool)
+    for coluna, operador, valor in condicoes:
+        if valor is not None:
+            mascara &= OPERADORES_FILTRO[operador](df[coluna], valor).to_numpy(dtype=bool)
+    return mascara
+
+
+def condicoes_historico(coluna_data, ano=None, mes=None, inicio=None, fim=None,
+                        produto=None, pagamento=None, compra=None):
+    """Condições dos filtros do histórico (None = filtro desligado) para mascara_filtros"""
+    return [
+        ('Ano', '==', ano),
+        ('Mes', '==', mes),
+        (coluna_data, '>=', pd.Timestamp(inicio) if inicio else None),
+        (coluna_data, '<', pd.Timestamp(fim) + pd.Timedelta(days=1) if fim else None),
+        ('Produto', '==', produto),
+        ('Pagamento', '==', pagamento),
+        ('ID_Compra', '==', compra),
+    ]
+
+
+def filtrar_resumo_diario(df_resumo, ano, mes, inicio, fim, produto, pagamento):
+    """
+    Linhas do resumo diário dentro dos filtros do histórico. Retorna (totais, produtos):
+    as linhas que somam as vendas filtradas e as linhas por produto.
+    """
+    periodo = mascara_filtros(df_resumo, condicoes_historico('Dia', ano, mes, inicio, fim, pagamento=pagamento))
+    if produto is not None:
+        linhas = df_resumo[periodo & mascara_filtros(df_resumo, [('Produto', '==', produto)])]
+        return linhas, linhas
+    vendas = mascara_filtros(df_resumo, [('Produto', '==', '')])
+    return df_resumo[periodo & vendas], df_resumo[periodo & ~vendas]
+
+
+def periodo_padrao(ano, mes, hoje):
+    """
+    Datas iniciais do histórico: os últimos 30 dias, ou o ano/mês escolhido (até hoje).
+    Mês sem ano = a ocorrência mais recente desse mês.
+    """
+    if ano is None and not mes:
+        return hoje - timedelta(days=30), hoje
+    if ano is None:
+        ano = hoje.year if mes <= hoje.month else hoje.year - 1
+    
+    if mes:
+        inicio = datetime(ano, mes, 1).date()
+        fim = (inicio + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        inicio, fim = datetime(ano, 1, 1).date(), datetime(ano, 12, 31).date()
+    return inicio, min(fim, hoje) if inicio <= hoje else fim
+
+
+# ==================== EXPORTAÇÃO ====================
+
+# Formato: (extensão, tipo MIME)
+FORMATOS_EXPORTACAO = {
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+LINHAS_POR_BLOCO = 10000
+
+
+def _excel_em_fluxo(df):
+    """
+    Planilha .xlsx escrita linha a linha pelo xlsxwriter em modo de memória constante
+    (cada linha vai para o disco assim que é escrita), convertendo o DataFrame em blocos.
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {
+        'constant_memory': True,
+        'default_date_format': 'dd/mm/yyyy hh:mm',
+    })
+    planilha = workbook.add_worksheet('Histórico')
+    planilha.write_row(0, 0, list(df.columns))
+    
+    for inicio in range(0, len(df), LINHAS_POR_BLOCO):
+        bloco = df.iloc[inicio:inicio + LINHAS_POR_BLOCO].astype(object)
+        bloco = bloco.where(bloco.notna(), None)  # células vazias em vez de NaN/NaT
+        for linha, valores in enumerate(bloco.itertuples(index=False, name=None), start=inicio + 1):
+            planilha.write_row(linha, 0, valores)
+    
+    workbook.close()
+    return buffer.getvalue()
+
+
+def gerar_arquivo(df, formato):
+    """Conteúdo do arquivo de exportação no formato pedido (chave de FORMATOS_EXPORTACAO)"""
+    if formato == 'Excel':
+        return _excel_em_fluxo(df)
+    if formato == 'CSV':
+        # Separadores do Excel em português; o BOM faz os acentos abrirem certo
+        return df.to_csv(index=False, sep=';', decimal=',', date_format=FORMATO_DATA).encode('utf-8-sig')
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+@st.cache_data(ttl=600, max_entries=16, show_spinner="Preparando o arquivo...")
+def exportar_historico(_banco, versao, inicio, fim, condicoes, formato):
+    """
+    Arquivo com as compras filtradas do histórico, gerado só quando pedido.
+    A assinatura (versão, período, condições dos filtros, formato) é a chave do cache:
+    baixar de novo o mesmo filtro não gera o arquivo outra vez.
+    """
+    df = carregar_compras_periodo(_banco, versao, inicio, fim)
+    df = df[mascara_filtros(df, condicoes)].drop(columns=['Ano', 'Mes', 'Lancamento'])
+    return gerar_arquivo(df, formato)
+
+
+# ==================== GRAVAÇÃO ASSÍNCRONA ====================
+
+# Gravador das linhas próprias (Resumo_Diario) quando não há diário: um por processo
+_gravador_local = uuid.uuid4().hex[:8]
+
+
+def aplicar_lancamento(banco, lancamento, latencias=None):
+    """
+    Executa as gravações de um lançamento no armazenamento, na ordem.
+    lancamento: lista de operações ('anexar', aba, linhas), ('celulas', aba, [(linha, coluna, valor)])
+    ou ('celulas_chave', aba, [(chave, coluna, valor)]).
+    """
+    if latencias is None:
+        latencias = []
+    
+    for operacao, aba, dados in lancamento:
+        if not dados:
+            continue
+        if operacao == 'anexar':
+            _cronometrar(latencias, f"{aba}.anexar_linhas ({len(dados)} linhas)", banco.anexar_linhas, aba, dados)
+        elif operacao == 'celulas_chave':
+            _cronometrar(latencias, f"{aba}.gravar_celulas_chave ({len(dados)} células)",
+                         banco.gravar_celulas_chave, aba, dados)
+        else:
+            _cronometrar(latencias, f"{aba}.gravar_celulas ({len(dados)} células)", banco.gravar_celulas, aba, dados)
+        nova_versao(banco, aba)
+
+
+class DiarioGravacao:
+    """
+    Gravação assíncrona (write-behind) para um armazenamento remoto.
+    
+    Cada lançamento é acrescentado a um arquivo local só de acréscimo (uma linha JSON,
+    com fsync) e confirmado na hora. Uma thread em segundo plano envia os pendentes ao
+    armazenamento em lotes, juntando as linhas de cada aba numa única gravação, e tenta
+    de novo com espera exponencial quando falha. O arquivo .ok guarda o último lançamento
+    enviado; ao reiniciar, os pendentes são reenviados e as linhas já gravadas são puladas,
+    para que cada lançamento entre uma única vez. Nas abas com a coluna Lancamento (Compras,
+    Movimentacoes), cada linha leva a marca do seu lançamento (gravador-seq) e são puladas
+    só as linhas cuja marca já está na aba; nas demais a primeira coluna é a chave da linha
+    (Resumo_Diario, Alertas_Estado) e as chaves já presentes são puladas.
+    O gravador (arquivo .gravador) identifica as linhas que são só desta instância e
+    continua o mesmo depois de reiniciar, para os pendentes caírem nas mesmas linhas.
+    """
+    
+    TAMANHO_LOTE = 50
+    TAMANHO_MAXIMO_ARQUIVO = 1024 * 1024  # compacta o diário quando não há pendentes
+    
+    def __init__(self, banco, caminho):
+        self.banco = banco
+        self.caminho = caminho
+        self.caminho_ok = caminho + '.ok'
+        self.gravador = self._ler_gravador(caminho + '.gravador')
+        self.ultimo_erro = None
+        self._lock = threading.Lock()
+        self._sinal = threading.Event()
+        
+        self._ultimo_enviado = self._ler_confirmado()
+        self._pendentes = [e for e in self._ler_diario() if e['seq'] > self._ultimo_enviado]
+        self._proximo_seq = max([self._ultimo_enviado] + [e['seq'] for e in self._pendentes]) + 1
+        
+        # Pendentes de uma execução anterior podem ter sido enviados em parte antes da queda
+        self._em_duvida = bool(self._pendentes)
+        
+        self._arquivo = open(self.caminho, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._trabalhar, name='diario-gravacao', daemon=True)
+        self._thread.start()
+        if self._pendentes:
+            self._sinal.set()
+    
+    def _ler_confirmado(self):
+        try:
+            with open(self.caminho_ok, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+    
+    @staticmethod
+    def _ler_gravador(caminho):
+        try:
+            with open(caminho, encoding='utf-8') as f:
+                gravador = f.read().strip()
+        except FileNotFoundError:
+            gravador = ''
+        if not gravador:
+            gravador = uuid.uuid4().hex[:8]
+            with open(caminho, 'w', encoding='utf-8') as f:
+                f.write(gravador)
+        return gravador
+    
+    def _ler_diario(self):
+        entradas = []
+        try:
+            with open(self.caminho, encoding='utf-8') as f:
+                for linha in f:
+                    try:
+                        entradas.append(json.loads(linha))
+                    except json.JSONDecodeError:
+                        pass  # Linha incompleta de uma gravação interrompida
+        except FileNotFoundError:
+            pass
+        return entradas
+    
+    def registrar(self, lancamento):
+        """Grava o lançamento no diário local (durável) e retorna seu número de sequência"""
+        with self._lock:
+            entrada = {'seq': self._proximo_seq, 'lancamento': lancamento}
+            self._arquivo.write(json.dumps(entrada, ensure_ascii=False) + '\n')
+            self._arquivo.flush()
+            os.fsync(self._arquivo.fileno())
+            self._pendentes.append(entrada)
+            self._proximo_seq += 1
+        self._sinal.set()
+        return entrada['seq']
+    
+    def pendentes(self):
+        with self._lock:
+            return len(self._pendentes)
+    
+    def celulas_pendentes(self, aba, tipo='celulas'):
+        """
+        Valores ainda não enviados das células da aba: {(linha, coluna): valor}, ou
+        {(chave, coluna): valor} com tipo='celulas_chave'
+        """
+        with self._lock:
+            return {
+                (linha, coluna): valor
+                for entrada in self._pendentes
+                for operacao, aba_op, dados in entrada['lancamento'] if operacao == tipo and aba_op == aba
+                for linha, coluna, valor in dados
+            }
+    
+    def linhas_pendentes(self, aba):
+        """Linhas ainda não enviadas para anexar à aba, na ordem"""
+        with self._lock:
+            return [
+                linha
+                for entrada in self._pendentes
+                for operacao, aba_op, dados in entrada['lancamento'] if operacao == 'anexar' and aba_op == aba
+                for linha in dados
+            ]
+
+    def marca(self, seq):
+        """Marca gravada na coluna Lancamento pelas linhas do lançamento seq"""
+        return f"{self.gravador}-{seq}"
+    
+    @staticmethod
+    def _marcar(linhas, aba, marca):
+        """Linhas com a marca do lançamento na coluna Lancamento da aba"""
+        colunas = ESQUEMA_ABAS[aba]
+        posicao = colunas.index('Lancamento')
+        marcadas = []
+        for linha in linhas:
+            linha = (list(linha) + [''] * len(colunas))[:len(colunas)]
+            linha[posicao] = marca
+            marcadas.append(linha)
+        return marcadas
+    
+    def _juntar(self, lote, conferir_existentes):
+        """Junta os lançamentos do lote numa gravação por aba, preservando a ordem das operações"""
+        operacoes = {}
+        for entrada in lote:
+            for operacao, aba, dados in entrada['lancamento']:
+                if operacao == 'anexar' and 'Lancamento' in ESQUEMA_ABAS.get(aba, []):
+                    dados = self._marcar(dados, aba, self.marca(entrada['seq']))
+                operacoes.setdefault((operacao, aba), []).extend(dados)
+        
+        lancamento = []
+        for (operacao, aba), dados in operacoes.items():
+            if operacao == 'anexar' and conferir_existentes:
+                # Só a marca do lançamento diz que a linha já foi gravada; um ID igual pode ser de outra linha
+                if 'Lancamento' in ESQUEMA_ABAS.get(aba, []):
+                    posicao = ESQUEMA_ABAS[aba].index('Lancamento')
+                    existentes = {str(v) for v in self.banco.ler_coluna(aba, posicao + 1) if v}
+                    dados = [linha for linha in dados if str(linha[posicao]) not in existentes]
+                else:
+                    existentes = {str(v) for v in self.banco.ler_coluna(aba, 1)}
+                    dados = [linha for linha in dados if str(linha[0]) not in existentes]
+            elif operacao in ('celulas', 'celulas_chave'):
+                # A última gravação de cada célula prevalece
+                ultimas = {(linha, coluna): valor for linha, coluna, valor in dados}
+                dados = [(linha, coluna, valor) for (linha, coluna), valor in ultimas.items()]
+            lancamento.append((operacao, aba, dados))
+        return lancamento
+    
+    def _confirmar(self, seq):
+        temporario = self.caminho_ok + '.tmp'
+        with open(temporario, 'w', encoding='utf-8') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, self.caminho_ok)
+        self._ultimo_enviado = seq
+    
+    def _compactar(self):
+        """Esvazia o diário quando tudo já foi enviado e o arquivo cresceu demais"""
+        with self._lock:
+            if self._pendentes or self._arquivo.tell() < self.TAMANHO_MAXIMO_ARQUIVO:
+                return
+            self._arquivo.close()
+            self._arquivo = open(self.caminho, 'w', encoding='utf-8')
+    
+    def _trabalhar(self):
+        espera = 1
+        while True:
+            self._sinal.wait(timeout=5)
+            self._sinal.clear()
+            
+            while True:
+                with self._lock:
+                    lote = self._pendentes[:self.TAMANHO_LOTE]
+                if not lote:
+                    break
+                
+                try:
+                    aplicar_lancamento(self.banco, self._juntar(lote, self._em_duvida))
+                except Exception as e:
+                    # Parte do lote pode ter sido gravada: a próxima tentativa confere os IDs
+                    self.ultimo_erro = str(e)
+                    self._em_duvida = True
+                    time.sleep(espera * random.uniform(0.5, 1.5))
+                    espera = min(espera * 2, 60)
+                    continue
+                
+                espera = 1
+                self.ultimo_erro = None
+                self._em_duvida = False
+                self._confirmar(lote[-1]['seq'])
+                with self._lock:
+                    del self._pendentes[:len(lote)]
+            
+            self._compactar()
+
+
+# Um diário por armazenamento, compartilhado por todas as sessões do processo
+_diarios = {}
+_lock_diarios = threading.Lock()
+
+
+def obter_diario(banco):
+    """
+    Diário de gravação assíncrona do armazenamento (criado e reenviando pendentes na primeira
+    chamada), ou None quando o armazenamento é local ou a opção está desligada nos secrets
+    ([armazenamento] gravacao_assincrona = false).
+    """
+    if not banco.remoto:
+        return None
+    
+    with _lock_diarios:
+        if banco.id not in _diarios:
+            config = configuracao_armazenamento()
+            if not config.get('gravacao_assincrona', True):
+                return None
+            
+            pasta = config.get('pasta_diario', '.diario_vendas')
+            os.makedirs(pasta, exist_ok=True)
+            nome_arquivo = hashlib.sha1(banco.id.encode('utf-8')).hexdigest()[:12] + '.jsonl'
+            _diarios[banco.id] = DiarioGravacao(banco, os.path.join(pasta, nome_arquivo))
+        
+        return _diarios[banco.id]
+
+
+def registrar_compra(banco, itens, metodo_pagamento, observacao=""):
+    """
+    Registra uma nova compra/venda com múltiplos itens, desconta do estoque e verifica alertas.
+    O número de chamadas à API é constante, independente do tamanho do carrinho:
+    - IDs da compra e das movimentações reservados juntos na aba Contadores
+    - todas as linhas da compra em uma única gravação
+    - todas as saídas de estoque em uma única gravação de movimentações (o estoque é calculado
+      por elas: nenhuma célula de estoque é lida ou regravada)
+    - os totais do dia (resumo diário) em uma gravação de linhas novas e outra de células,
+      só nas linhas desta instância (outra instância vendendo ao mesmo tempo não as sobrescreve)
+    Em armazenamento remoto, essas gravações vão para o diário local e são enviadas em
+    segundo plano: a venda é confirmada sem esperar a rede.
+    As latências de cada chamada ficam em st.session_state.latencias_checkout.
+    """
+    latencias = []
+    try:
+        data_atual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        # Garante valores válidos
+        metodo_pagamento = str(metodo_pagamento or "Não informado").strip()
+        observacao = str(observacao or "").strip()
+        
+        # Normaliza os itens e soma as quantidades por produto
+        itens_validos = []
+        quantidade_por_produto = {}
         for item in itens:
             quantidade = float(item.get('quantidade', 0))
             preco = float(item.get('preco', 0))
-            total = quantidade * preco
             produto = str(item.get('produto', '')).strip()
-            
-            # Registra a venda na aba Compras
-            ws_compras.append_row([
-                id_compra,
-                data_atual,
-                produto,
-                quantidade,
-                preco,
-                total,
-                metodo_pagamento,
-                observacao
-            ], value_input_option='RAW')
-            
-            # Desconta do estoque do produto
-            if col_estoque:
-                for idx, prod in enumerate(produtos_dados, start=2):
-                    if prod.get('Nome') == produto:
-                        estoque_atual = float(prod.get('Estoque_Atual', 0) or 0)
-                        novo_estoque = max(0, estoque_atual - quantidade)  # Não deixa ficar negativo
-                        estoque_minimo = float(prod.get('Estoque_Minimo', 0) or 0)
-                        
-                        # Atualiza estoque na planilha
-                        ws_produtos.update_cell(idx, col_estoque, novo_estoque)
-                        
-                        # Verifica se ficou crítico
-                        if novo_estoque <= estoque_minimo:
-                            produtos_criticos.append({
-                                'Nome': produto,
-                                'Estoque_Atual': novo_estoque,
-                                'Estoque_Minimo': estoque_minimo
-                            })
-                        
-                        # Registra movimentação de saída
-                        try:
-                            registrar_movimentacao(spreadsheet, "Saída", produto, quantidade, "Venda", f"Compra {id_compra}")
-                        except:
-                            pass  # Não falha se não conseguir registrar movimentação
-                        
-                        break
+            itens_validos.append((produto, quantidade, preco))
+            quantidade_por_produto[produto] = quantidade_por_produto.get(produto, 0) + quantidade
+        
+        # Estoque mínimo de cada produto vem do índice em memória (sem leitura da aba Produtos)
+        indice = obter_indice_produtos(banco, quantidade_por_produto.keys())
+        minimos = indice.minimo
+        
+        # Uma saída por item vendido, apenas para produtos encontrados no cadastro
+        itens_com_estoque = [item for item in itens_validos if item[0] in minimos]
+        
+        # Reserva o ID da compra e os IDs das movimentações numa única ida à aba Contadores
+        ids = alocar_ids(banco, {'Compras': 1, 'Movimentacoes': len(itens_com_estoque)}, latencias)
+        id_compra = ids['Compras'][0]
+        
+        linhas_compra = [
+            [id_compra, data_atual, produto, quantidade, preco, quantidade * preco, metodo_pagamento, observacao]
+            for produto, quantidade, preco in itens_validos
+        ]
+        
+        # Uma saída de estoque por item vendido
+        linhas_movimentacao = _linhas_movimentacao(ids.get('Movimentacoes', []), [
+            ("Saída", produto, quantidade, "Venda", f"Compra {id_compra}")
+            for produto, quantidade, _ in itens_com_estoque
+        ])
+        
+        # Desconta do estoque em memória (a mesma linha pode aparecer várias vezes no carrinho)
+        novos_estoques = movimentar_estoque(banco, _movimentos_das_linhas(linhas_movimentacao))
+        
+        # Verifica os que ficaram críticos
+        produtos_criticos = [
+            {'Nome': produto, 'Estoque_Atual': novo_estoque, 'Estoque_Minimo': minimos[produto]}
+            for produto, novo_estoque in novos_estoques.items() if novo_estoque <= minimos[produto]
+        ]
+        
+        # Totais do dia: só as linhas do resumo diário das chaves desta venda
+        linhas_resumo, celulas_resumo = [], []
+        try:
+            resumo = obter_resumo_diario(banco)
+            with _lock_resumos:
+                linhas_resumo, celulas_resumo = resumo.acumular(linhas_compra)
+        except Exception:
+            invalidar_resumos(banco)  # Refeito a partir da aba na próxima leitura
+        
+        # Venda, saídas de estoque e totais: uma gravação cada, todas só de acréscimo
+        lancamento = [
+            ('anexar', 'Compras', linhas_compra),
+            ('anexar', 'Movimentacoes', linhas_movimentacao),
+            ('anexar', 'Resumo_Diario', linhas_resumo),
+            ('celulas_chave', 'Resumo_Diario', celulas_resumo),
+        ]
+        
+        diario = obter_diario(banco)
+        if diario is not None:
+            _cronometrar(latencias, "diario.registrar", diario.registrar, lancamento)
+        else:
+            aplicar_lancamento(banco, lancamento[:1], latencias)
+            try:
+                aplicar_lancamento(banco, lancamento[1:2], latencias)
+            except Exception:
+                invalidar_saldos_estoque(banco)  # Recalculado pelas movimentações gravadas
+            try:
+                aplicar_lancamento(banco, lancamento[2:], latencias)
+            except Exception:
+                invalidar_resumos(banco)  # Relido da aba na próxima leitura
         
         return id_compra, produtos_criticos
     except Exception as e:
+        invalidar_resumos(banco)  # Os totais e o estoque podem já ter somado esta venda
+        invalidar_saldos_estoque(banco)
         st.error(f"❌ Erro ao registrar compra: {e}")
         return None, []
+    finally:
+        st.session_state.latencias_checkout = latencias
 
 
-# ==================== FUNÇÕES DE ESTOQUE ====================
+# ==================== ESTOQUE POR MOVIMENTAÇÕES ====================
+
+# Efeito de cada tipo de movimentação no estoque (outros tipos não mexem no estoque)
+SINAL_MOVIMENTACAO = {'Entrada': 1.0, 'Saída': -1.0}
+
+# Movimentações lidas depois do último snapshot a partir das quais um snapshot novo é gravado
+MOVIMENTACOES_POR_SNAPSHOT = 5000
 
-@st.cache_data(ttl=300, show_spinner=False)
-def carregar_movimentacoes(_spreadsheet, _cache_key):
-    """Carrega todas as movimentações de estoque"""
-    COLUNAS_MOV = ['ID_Mov', 'Data', 'Tipo', 'Produto', 'Quantidade', 'Motivo', 'Observação']
+
+def dobrar_movimentacoes(saldos, df_mov):
+    """
+    Estoque de cada produto depois das movimentações, partindo de saldos ({nome: estoque}).
+    As movimentações são somadas sem deixar o estoque negativo, como nas vendas, sempre na
+    ordem de Data e ID_Mov (e não na ordem das linhas, que depende de quando cada instância
+    gravou): com o acumulado C de cada produto, o estoque final é C - min(0, menor C).
+    """
+    saldos = dict(saldos)
+    if df_mov.empty:
+        return saldos
     
-    try:
-        ws = _spreadsheet.worksheet('Movimentacoes')
-        dados = ws.get_all_records(value_render_option='UNFORMATTED_VALUE')
-        
-        if dados:
-            df = pd.DataFrame(dados)
-        else:
-            df = pd.DataFrame(columns=COLUNAS_MOV)
+    chaves = pd.DataFrame({'Data': df_mov['Data'].to_numpy(), 'ID_Mov': df_mov['ID_Mov'].astype(str).to_numpy()})
+    df_mov = df_mov.iloc[chaves.sort_values(['Data', 'ID_Mov'], kind='stable', na_position='last').index]
+    produto = df_mov['Produto'].astype(str).to_numpy()
+    sinal = df_mov['Tipo'].astype(str).map(SINAL_MOVIMENTACAO).fillna(0).to_numpy()
+    delta = pd.to_numeric(df_mov['Quantidade'], errors='coerce').fillna(0).to_numpy() * sinal
+    validas = produto != ''
+    produto, delta = produto[validas], delta[validas]
+    if not len(produto):
+        return saldos
+    
+    inicio = pd.Series(produto).map(saldos).fillna(0.0).to_numpy()
+    acumulado = pd.Series(delta).groupby(produto).cumsum().to_numpy() + inicio
+    grupos = pd.Series(acumulado).groupby(produto, sort=False)
+    finais = grupos.last() - np.minimum(0.0, grupos.min())
+    saldos.update((nome, round(float(valor), 6)) for nome, valor in finais.items())
+    return saldos
+
+
+class SaldosEstoque:
+    """
+    Estoque atual de cada produto, calculado pelas movimentações (aba Movimentacoes).
+    
+    O ponto de partida é o último snapshot (aba Estoque_Snapshot); as movimentações gravadas
+    depois dele são somadas por cima e, a cada releitura, só as linhas novas são lidas.
+    Vendas e entradas apenas anexam movimentações e somam aqui em memória: o estoque nunca
+    é lido de uma célula para ser regravado, então duas sessões não perdem a baixa uma da outra.
+    As movimentações deste processo ficam em `locais` até aparecerem na aba, para não serem
+    somadas duas vezes quando a releitura já as encontra gravadas. Cada uma é reconhecida pela
+    linha inteira (ID_Mov, tipo, produto e quantidade), com contagem, e não só pelo ID_Mov.
+    Cada leitura é somada na ordem de Data e ID_Mov (dobrar_movimentacoes); uma movimentação
+    que chega à aba depois de outras mais novas entra na leitura em que aparecer.
+    """
+    
+    def __init__(self, saldos, linha_mov, linha_snapshot):
+        self.base = dict(saldos)  # estoque até linha_mov, só com o que já está no armazenamento
+        self.linha_mov = linha_mov
+        self.linha_snapshot = linha_snapshot
+        self.locais = {}  # (ID_Mov, tipo, produto, quantidade) -> quantas ainda não lidas da aba
+        self.saldo = dict(saldos)
+        self.criado_em = time.monotonic()
+    
+    def expirado(self, ttl=300):
+        return time.monotonic() - self.criado_em > ttl
+    
+    def _somar(self, tipo, produto, quantidade):
+        atual = self.saldo.get(produto, 0.0) + SINAL_MOVIMENTACAO.get(tipo, 0.0) * float(quantidade)
+        self.saldo[produto] = max(0.0, round(atual, 6))
+        return self.saldo[produto]
+    
+    def avancar(self, df_mov):
+        """Soma à base as movimentações gravadas depois de linha_mov"""
+        self.base = dobrar_movimentacoes(self.base, df_mov)
+        self.linha_mov += len(df_mov)
+        if not df_mov.empty:
+            gravados = zip(
+                df_mov['ID_Mov'].astype(str), df_mov['Tipo'].astype(str), df_mov['Produto'].astype(str),
+                pd.to_numeric(df_mov['Quantidade'], errors='coerce').fillna(0).astype(float)
+            )
+            for movimento in gravados:
+                if self.locais.get(movimento, 0) > 1:
+                    self.locais[movimento] -= 1
+                else:
+                    self.locais.pop(movimento, None)
         
-        for col in COLUNAS_MOV:
-            if col not in df.columns:
-                df[col] = ''
+        self.saldo = dict(self.base)
+        for (_, tipo, produto, quantidade), vezes in self.locais.items():
+            for _ in range(vezes):
+                self._somar(tipo, produto, quantidade)
+        self.criado_em = time.monotonic()
+    
+    def aplicar(self, movimentos):
+        """
+        Soma movimentos (id_mov, tipo, produto, quantidade) ao estoque atual, antes de serem
+        gravados. Retorna {produto: novo estoque}.
+        """
+        novos = {}
+        for id_mov, tipo, produto, quantidade in movimentos:
+            movimento = (str(id_mov), str(tipo), str(produto), float(quantidade))
+            self.locais[movimento] = self.locais.get(movimento, 0) + 1
+            novos[produto] = self._somar(tipo, produto, quantidade)
+        return novos
+    
+    def linhas_snapshot(self):
+        data = datetime.now().strftime(FORMATO_DATA)
+        return [[self.linha_mov, data, nome, estoque] for nome, estoque in sorted(self.base.items())]
+
+
+def _movimentos_das_linhas(linhas):
+    """(id_mov, tipo, produto, quantidade) das linhas no formato da aba Movimentacoes"""
+    cabecalho = ESQUEMA_ABAS['Movimentacoes']
+    movimentos = []
+    for valores in linhas:
+        registro = dict(zip(cabecalho, valores))
+        movimentos.append((
+            registro['ID_Mov'], registro['Tipo'], str(registro['Produto']), float(registro['Quantidade'] or 0)
+        ))
+    return movimentos
+
+
+def _gravar_snapshot(banco, saldos):
+    """
+    Grava o estoque da base como snapshot novo. O Estoque_Atual da aba Produtos é regravado
+    junto, só para consulta na planilha (o sistema sempre calcula pelas movimentações).
+    """
+    banco.anexar_linhas('Estoque_Snapshot', saldos.linhas_snapshot())
+    saldos.linha_snapshot = saldos.linha_mov
+    
+    indice = obter_indice_produtos(banco)
+    celulas = [
+        (*indice.celula(nome, 'Estoque_Atual'), estoque)
+        for nome, estoque in saldos.base.items() if indice.celula(nome, 'Estoque_Atual')
+    ]
+    if celulas:
+        banco.gravar_celulas('Produtos', celulas)
+        nova_versao(banco, 'Produtos')
+
+
+def ler_saldos_estoque(banco):
+    """
+    Estoques a partir do último snapshot e das movimentações seguintes. Sem snapshot (primeiro
+    uso), o Estoque_Atual da aba Produtos vira o snapshot inicial, na última linha de movimentações.
+    """
+    cabecalho, colunas = banco.ler_colunas('Estoque_Snapshot')
+    df_snapshot = montar_tabela(cabecalho, colunas, ESQUEMA_ABAS['Estoque_Snapshot'])
+    
+    if df_snapshot.empty:
+        linha_mov = 1 + len(banco.ler_coluna('Movimentacoes', 1))
+        df_produtos = _ler_produtos(banco)
+        iniciais = {
+            str(nome): float(estoque)
+            for nome, estoque in zip(df_produtos['Nome'], df_produtos['Estoque_Atual']) if str(nome)
+        }
+        saldos = SaldosEstoque(iniciais, linha_mov, linha_mov)
+        _gravar_snapshot(banco, saldos)
+        return saldos
+    
+    linha_mov = int(df_snapshot['Linha_Mov'].max())
+    ultimo = df_snapshot[df_snapshot['Linha_Mov'] == linha_mov]
+    return SaldosEstoque(
+        dict(zip(ultimo['Produto'].astype(str), ultimo['Estoque'].astype(float))), linha_mov, linha_mov
+    )
+
+
+# Estoques compartilhados por todas as sessões do processo, por armazenamento
+_saldos_estoque = {}
+_lock_saldos = threading.Lock()
+
+
+def obter_saldos_estoque(banco):
+    """
+    Estoque atual do armazenamento, mantido em memória a cada movimentação. A cada 5 minutos
+    lê só as movimentações gravadas desde a última leitura, para ver as de outras instâncias,
+    e grava um snapshot novo quando elas passam de MOVIMENTACOES_POR_SNAPSHOT desde o anterior.
+    Na primeira leitura, as movimentações ainda na fila de envio do diário entram como locais.
+    """
+    with _lock_saldos:
+        saldos = _saldos_estoque.get(banco.id)
         
-        if 'Quantidade' in df.columns:
-            df['Quantidade'] = pd.to_numeric(df['Quantidade'], errors='coerce').fillna(0)
+        if saldos is None or saldos.expirado():
+            novo = saldos is None
+            if novo:
+                saldos = ler_saldos_estoque(banco)
+                diario = _diarios.get(banco.id)
+                if diario is not None:
+                    saldos.aplicar(_movimentos_das_linhas(diario.linhas_pendentes('Movimentacoes')))
+            
+            cabecalho, colunas = banco.ler_colunas('Movimentacoes', primeira_linha=saldos.linha_mov + 1)
+            saldos.avancar(montar_tabela(cabecalho, colunas, ESQUEMA_ABAS['Movimentacoes']))
+            if saldos.linha_mov - saldos.linha_snapshot >= MOVIMENTACOES_POR_SNAPSHOT:
+                _gravar_snapshot(banco, saldos)
+            _saldos_estoque[banco.id] = saldos
         
-        return df
+        return saldos
+
+
+def movimentar_estoque(banco, movimentos):
+    """
+    Soma os movimentos (id_mov, tipo, produto, quantidade) ao estoque em memória, antes de
+    gravá-los. Retorna {produto: novo estoque}.
+    """
+    saldos = obter_saldos_estoque(banco)
+    with _lock_saldos:
+        return saldos.aplicar(movimentos)
+
+
+def estoque_atual(banco, nome):
+    saldos = obter_saldos_estoque(banco)
+    with _lock_saldos:
+        return saldos.saldo.get(nome, 0.0)
+
+
+def com_estoque_atual(banco, df_produtos):
+    """Produtos com o Estoque_Atual calculado pelas movimentações no lugar do gravado na aba"""
+    if df_produtos.empty or 'Nome' not in df_produtos.columns:
+        return df_produtos
+    try:
+        saldos = obter_saldos_estoque(banco)
+        with _lock_saldos:
+            estoques = dict(saldos.saldo)
+    except Exception:
+        return df_produtos
+    return df_produtos.assign(Estoque_Atual=df_produtos['Nome'].astype(str).map(estoques).fillna(0.0).astype('float64'))
+
+
+def invalidar_saldos_estoque(banco=None):
+    """Descarta o estoque em memória de um armazenamento (ou de todos) para recalcular do último snapshot"""
+    with _lock_saldos:
+        if banco is None:
+            _saldos_estoque.clear()
+        else:
+            _saldos_estoque.pop(banco.id, None)
+
+
+# ==================== FUNÇÕES DE ESTOQUE ====================
+
+@st.cache_data(ttl=300, max_entries=8, show_spinner=False)
+def carregar_movimentacoes(_banco, versao):
+    """Carrega todas as movimentações de estoque (só as linhas novas são lidas da planilha)"""
+    try:
+        return sincronizar_aba(_banco, 'Movimentacoes')
     except:
-        return pd.DataFrame(columns=COLUNAS_MOV)
+        return pd.DataFrame(columns=ESQUEMA_ABAS['Movimentacoes'])
 
 
-def registrar_movimentacao(spreadsheet, tipo, produto, quantidade, motivo="", observacao=""):
-    """Registra uma movimentação de estoque (Entrada ou Saída)"""
+def registrar_movimentacao(banco, tipo, produto, quantidade, motivo="", observacao=""):
+    """
+    Registra uma movimentação de estoque (Entrada ou Saída): só anexa a linha e soma ao
+    estoque em memória. Retorna o ID da movimentação.
+    """
     try:
-        ws = spreadsheet.worksheet('Movimentacoes')
-        dados = ws.get_all_values()
-        id_mov = f"MOV{len(dados):05d}"
+        id_mov = alocar_id(banco, 'Movimentacoes')
         data_atual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
-        ws.append_row([
+        linha = [
             id_mov,
             data_atual,
             tipo,  # "Entrada" ou "Saída"
@@ -576,155 +3251,850 @@ def registrar_movimentacao(spreadsheet, tipo, produto, quantidade, motivo="", ob
             float(quantidade),
             str(motivo or ""),
             str(observacao or "")
-        ], value_input_option='RAW')
+        ]
+        novos_estoques = movimentar_estoque(banco, _movimentos_das_linhas([linha]))
+        try:
+            banco.anexar_linhas('Movimentacoes', [linha])
+        except Exception:
+            invalidar_saldos_estoque(banco)  # Recalculado pelas movimentações gravadas
+            raise
+        nova_versao(banco, 'Movimentacoes')
+        _informar_estoques(banco, novos_estoques)
+        
+        return id_mov
+    except Exception as e:
+        st.error(f"❌ Erro ao registrar movimentação: {e}")
+        return None
+
+
+def _linhas_movimentacao(ids, movimentos):
+    """Linhas da aba Movimentacoes para os movimentos (tipo, produto, quantidade, motivo, observacao)"""
+    data_atual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    linhas = []
+    for id_mov, (tipo, produto, quantidade, motivo, observacao) in zip(ids, movimentos):
+        linhas.append([
+            id_mov,
+            data_atual,
+            tipo,
+            str(produto),
+            float(quantidade),
+            str(motivo or ""),
+            str(observacao or "")
+        ])
+    return linhas
+
+
+def registrar_movimentacoes_lote(banco, movimentos, latencias=None, ids=None):
+    """
+    Registra várias movimentações de estoque com uma única gravação.
+    Cada movimento é uma tupla (tipo, produto, quantidade, motivo, observacao).
+    Os IDs podem vir já reservados (ids); senão são reservados aqui.
+    Retorna a lista de IDs gerados.
+    """
+    if latencias is None:
+        latencias = []
+    
+    if ids is None:
+        ids = alocar_ids(banco, {'Movimentacoes': len(movimentos)}, latencias).get('Movimentacoes', [])
+    linhas = _linhas_movimentacao(ids, movimentos)
+    
+    novos_estoques = movimentar_estoque(banco, _movimentos_das_linhas(linhas))
+    try:
+        _cronometrar(latencias, f"Movimentacoes.anexar_linhas ({len(linhas)} linhas)",
+                     banco.anexar_linhas, 'Movimentacoes', linhas)
+    except Exception:
+        invalidar_saldos_estoque(banco)
+        raise
+    nova_versao(banco, 'Movimentacoes')
+    _informar_estoques(banco, novos_estoques)
+    return ids
+
+
+def _informar_estoques(banco, novos_estoques):
+    """Libera novos alertas dos produtos cujo estoque voltou acima do mínimo"""
+    minimos = obter_indice_produtos(banco).minimo
+    informar_estoques_alertas(banco, {
+        nome: (estoque, minimos[nome]) for nome, estoque in novos_estoques.items() if nome in minimos
+    })
+
+
+# Nomes aceitos no cabeçalho do arquivo de contagem (sem acento, minúsculas)
+COLUNAS_CONTAGEM = {
+    'Nome': COLUNAS_IMPORTACAO['Nome'],
+    'Contado': ['contado', 'contagem', 'quantidade', 'qtd', 'estoque'],
+}
+
+
+def contagens_do_arquivo(df_arquivo):
+    """Quantidades contadas de um arquivo de inventário: Series nome informado -> quantidade"""
+    origem = colunas_do_arquivo(df_arquivo, COLUNAS_CONTAGEM)
+    if origem['Nome'] is None or origem['Contado'] is None:
+        raise ValueError("O arquivo precisa das colunas Nome (ou Produto) e Contado (ou Quantidade)")
+    return pd.Series(
+        _numeros_importados(df_arquivo[origem['Contado']].str.strip()).values,
+        index=df_arquivo[origem['Nome']].astype(str).str.strip().values
+    )
+
+
+def conciliar_inventario(df_produtos, contagens):
+    """
+    Compara as quantidades contadas (Series nome -> quantidade, nomes sem diferenciar acento
+    e caixa) com o estoque atual de todos os produtos de uma vez.
+    Retorna (ajustes: Nome, Estoque_Atual, Contado, Diferença só dos que mudam, nomes não encontrados).
+    Produtos sem contagem (vazia ou fora da lista) ficam como estão.
+    """
+    nomes = df_produtos['Nome'].astype(str)
+    por_chave = pd.Series(nomes.values, index=normalizar_textos(nomes).values)
+    por_chave = por_chave[~por_chave.index.duplicated()]
+    
+    contadas = pd.DataFrame({
+        'Informado': pd.Series(contagens.index, dtype=str),
+        'Contado': pd.to_numeric(pd.Series(contagens.values), errors='coerce'),
+    })
+    contadas['Nome'] = normalizar_textos(contadas['Informado']).map(por_chave)
+    nao_encontrados = contadas.loc[contadas['Nome'].isna() & contadas['Informado'].str.strip().ne(''), 'Informado'].tolist()
+    
+    contadas = contadas.dropna(subset=['Nome', 'Contado']).drop_duplicates('Nome', keep='last')
+    ajustes = contadas[['Nome', 'Contado']].merge(
+        pd.DataFrame({'Nome': nomes.values, 'Estoque_Atual': df_produtos['Estoque_Atual'].astype('float64').values}),
+        on='Nome', how='left'
+    )
+    ajustes['Diferença'] = (ajustes['Contado'].clip(lower=0) - ajustes['Estoque_Atual']).round(6)
+    ajustes = ajustes[ajustes['Diferença'].ne(0)]
+    return ajustes[['Nome', 'Estoque_Atual', 'Contado', 'Diferença']].reset_index(drop=True), nao_encontrados
+
+
+def registrar_inventario(banco, df_produtos, contagens, observacao=""):
+    """
+    Registra o inventário como movimentações "Ajuste de inventário" (entrada ou saída da
+    diferença), todas numa única reserva de IDs e numa única gravação. As diferenças são
+    recalculadas aqui com o estoque do momento, para contar as vendas feitas durante a contagem.
+    Retorna o número de ajustes gravados.
+    """
+    ajustes, _ = conciliar_inventario(com_estoque_atual(banco, df_produtos), contagens)
+    movimentos = [
+        ("Entrada" if diferenca > 0 else "Saída", nome, abs(diferenca), "Ajuste de inventário", observacao)
+        for nome, diferenca in zip(ajustes['Nome'], ajustes['Diferença'])
+    ]
+    if movimentos:
+        registrar_movimentacoes_lote(banco, movimentos)
+    return len(movimentos)
+
+
+def obter_produtos_estoque_critico(df_produtos):
+    """Retorna produtos com estoque abaixo do mínimo"""
+    if df_produtos.empty:
+        return pd.DataFrame()
+    
+    if 'Estoque_Atual' not in df_produtos.columns or 'Estoque_Minimo' not in df_produtos.columns:
+        return pd.DataFrame()
+    
+    # Filtra produtos com estoque crítico
+    criticos = df_produtos[df_produtos['Estoque_Atual'] <= df_produtos['Estoque_Minimo']].copy()
+    
+    if not criticos.empty:
+        criticos['Deficit'] = criticos['Estoque_Minimo'] - criticos['Estoque_Atual']
+    
+    return criticos
+
+
+def configuracao_email():
+    """
+    Lê a seção [email_config] dos secrets: smtp_server, smtp_port, email_sender, email_password
+    e starttls (padrão true; false para um servidor local de testes sem TLS), ou None
+    """
+    try:
+        if "email_config" in st.secrets:
+            return dict(st.secrets["email_config"])
+    except Exception:
+        pass
+    return None
+
+
+def montar_email_alerta(remetente, destinatarios, produtos_criticos):
+    """Mensagem de alerta (HTML) com a tabela dos produtos críticos, para um ou mais destinatários"""
+    # Monta o corpo do email
+    html_produtos = ""
+    for _, prod in produtos_criticos.iterrows():
+        html_produtos += f"""
+        <tr>
+            <td style="padding: 8px; border: 1px solid #ddd;">{prod.get('Nome', 'N/A')}</td>
+            <td style="padding: 8px; border: 1px solid #ddd; text-align: center;">{prod.get('Estoque_Atual', 0)}</td>
+            <td style="padding: 8px; border: 1px solid #ddd; text-align: center;">{prod.get('Estoque_Minimo', 0)}</td>
+        </tr>
+        """
+    
+    html_body = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif;">
+        <div style="background: linear-gradient(135deg, #dc2626 0%, #b91c1c 100%); color: white; padding: 20px; border-radius: 10px;">
+            <h1>⚠️ Alerta de Estoque Crítico</h1>
+            <p>Os seguintes produtos estão com estoque abaixo do nível mínimo:</p>
+        </div>
+        <table style="width: 100%; border-collapse: collapse; margin-top: 20px;">
+            <thead>
+                <tr style="background-color: #1e3a5f; color: white;">
+                    <th style="padding: 10px; border: 1px solid #ddd;">Produto</th>
+                    <th style="padding: 10px; border: 1px solid #ddd;">Estoque Atual</th>
+                    <th style="padding: 10px; border: 1px solid #ddd;">Estoque Mínimo</th>
+                </tr>
+            </thead>
+            <tbody>
+                {html_produtos}
+            </tbody>
+        </table>
+        <p style="margin-top: 20px; color: #666;">
+            Este é um alerta automático do Sistema de Compras.<br>
+            Data/Hora: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}
+        </p>
+    </body>
+    </html>
+    """
+    
+    # Cria a mensagem
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = f"⚠️ ALERTA: {len(produtos_criticos)} produto(s) com estoque crítico"
+    msg['From'] = remetente
+    msg['To'] = ", ".join(destinatarios)
+    
+    msg.attach(MIMEText(html_body, 'html'))
+    return msg
+
+
+class ConexaoSMTP:
+    """
+    Conexão SMTP reaproveitada entre envios: STARTTLS e login só na primeira mensagem
+    ou depois que o servidor fechar a conexão (conferido com NOOP antes de cada envio).
+    """
+    
+    def __init__(self, config_email):
+        self.servidor = config_email.get('smtp_server', 'smtp.gmail.com')
+        self.porta = int(config_email.get('smtp_port', 587))
+        self.remetente = config_email.get('email_sender', '')
+        self.senha = config_email.get('email_password', '')
+        self.starttls = config_email.get('starttls', True)
+        self._smtp = None
+        self._lock = threading.Lock()
+    
+    def _conectar(self):
+        smtp = smtplib.SMTP(self.servidor, self.porta, timeout=15)
+        if self.starttls:
+            smtp.starttls()
+        if self.senha:
+            smtp.login(self.remetente, self.senha)
+        return smtp
+    
+    def enviar(self, msg, destinatarios):
+        with self._lock:
+            if self._smtp is not None:
+                try:
+                    self._smtp.noop()
+                except OSError:
+                    self._descartar()
+            if self._smtp is None:
+                self._smtp = self._conectar()
+            try:
+                self._smtp.sendmail(self.remetente, destinatarios, msg.as_string())
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # Recusa do servidor: a conexão continua boa para a próxima tentativa
+                raise
+            except OSError:
+                self._descartar()
+                raise
+    
+    def _descartar(self):
+        try:
+            self._smtp.close()
+        except Exception:
+            pass
+        self._smtp = None
+    
+    def fechar(self):
+        with self._lock:
+            if self._smtp is not None:
+                try:
+                    self._smtp.quit()
+                except Exception:
+                    pass
+                self._smtp = None
+
+
+def enviar_alerta_email(destinatario, produtos_criticos, config_email=None):
+    """Envia alerta por email sobre produtos com estoque crítico (na hora, pela conexão compartilhada)"""
+    try:
+        # Configurações de email (pode vir do secrets)
+        if config_email is None:
+            config_email = configuracao_email()
+            if config_email is None:
+                return False, "Configuração de email não encontrada"
+        
+        if not config_email.get('email_sender'):
+            return False, "Credenciais de email não configuradas"
+        
+        conexao = obter_despachante_alertas(config_email).conexao
+        destinatarios = [destinatario] if isinstance(destinatario, str) else list(destinatario)
+        conexao.enviar(montar_email_alerta(conexao.remetente, destinatarios, produtos_criticos), destinatarios)
+        
+        return True, "Email enviado com sucesso!"
+    except Exception as e:
+        return False, f"Erro ao enviar email: {e}"
+
+
+class EstadoAlertas:
+    """
+    Produtos já avisados por email (aba Alertas_Estado), em memória.
+    
+    Um produto avisado não entra em novos alertas enquanto continuar crítico no mesmo
+    estoque mínimo; volta a ser avisado depois que o estoque passar do mínimo (ou se o
+    mínimo mudar). Uma linha por produto: as linhas novas são anexadas e as existentes
+    têm só as células regravadas, endereçadas pelo Produto (primeira coluna) e não pelo
+    número da linha, como no resumo diário: linhas anexadas por outra instância ou
+    apagadas na planilha não desviam a gravação para outro produto. Um produto com duas
+    linhas (anexadas por duas instâncias ao mesmo tempo) usa a primeira.
+    """
+    
+    def __init__(self, df_estado):
+        self.criado_em = time.monotonic()
+        self.cabecalho = df_estado.attrs.get('cabecalho') or ESQUEMA_ABAS['Alertas_Estado']
+        self.posicao_coluna = {coluna: pos for pos, coluna in enumerate(self.cabecalho, start=1)}
+        self.linhas = {}  # produto -> [estoque_minimo, notificado_em]
+        
+        for registro in df_estado.to_dict('records'):
+            produto = str(registro.get('Produto', ''))
+            if produto:
+                self.linhas.setdefault(produto, [
+                    float(registro.get('Estoque_Minimo', 0) or 0), str(registro.get('Notificado_Em', '') or '')
+                ])
+    
+    def expirado(self, ttl=300):
+        return time.monotonic() - self.criado_em > ttl
+    
+    def notificado(self, produto, estoque_minimo):
+        atual = self.linhas.get(produto)
+        return atual is not None and bool(atual[1]) and atual[0] == float(estoque_minimo)
+    
+    def _celulas(self, produto, atual):
+        return [
+            (produto, self.posicao_coluna[coluna], valor)
+            for coluna, valor in (('Estoque_Minimo', atual[0]), ('Notificado_Em', atual[1]))
+            if coluna in self.posicao_coluna
+        ]
+    
+    def marcar(self, produtos, momento):
+        """Registra os produtos como avisados. Retorna (linhas a anexar, células [(produto, coluna, valor)] a regravar)."""
+        novas, celulas = [], []
+        for produto in produtos:
+            nome, estoque_minimo = str(produto['Nome']), float(produto['Estoque_Minimo'])
+            atual = self.linhas.get(nome)
+            if atual is None:
+                self.linhas[nome] = [estoque_minimo, momento]
+                valores = {'Produto': nome, 'Estoque_Minimo': estoque_minimo, 'Notificado_Em': momento}
+                novas.append([valores.get(coluna, '') for coluna in self.cabecalho])
+            else:
+                atual[:] = [estoque_minimo, momento]
+                celulas.extend(self._celulas(nome, atual))
+        return novas, celulas
+    
+    def rearmar(self, estoques):
+        """
+        Libera novos avisos dos produtos cujo estoque passou do mínimo.
+        estoques: {nome: (estoque_atual, estoque_minimo)}. Retorna as células a regravar.
+        """
+        celulas = []
+        for nome, (estoque_atual, estoque_minimo) in estoques.items():
+            atual = self.linhas.get(nome)
+            if atual is not None and atual[1] and estoque_atual > estoque_minimo:
+                atual[1] = ''
+                celulas.extend(self._celulas(nome, atual))
+        return celulas
+    
+    def aplicar_pendentes(self, linhas, celulas):
+        """
+        Sobrepõe ao estado lido as gravações que ainda estão na fila de envio
+        (celulas: {(produto, coluna): valor}, de DiarioGravacao.celulas_pendentes)
+        """
+        for valores in linhas:
+            registro = dict(zip(self.cabecalho, valores))
+            nome = str(registro.get('Produto', ''))
+            if nome and nome not in self.linhas:
+                self.linhas[nome] = [float(registro.get('Estoque_Minimo', 0) or 0), registro.get('Notificado_Em', '')]
         
-        return id_mov
-    except Exception as e:
-        st.error(f"❌ Erro ao registrar movimentação: {e}")
-        return None
+        colunas = {self.posicao_coluna.get('Estoque_Minimo'): 0, self.posicao_coluna.get('Notificado_Em'): 1}
+        for (nome, coluna), valor in celulas.items():
+            atual = self.linhas.get(str(nome))
+            if atual is not None and coluna in colunas:
+                atual[colunas[coluna]] = float(valor) if colunas[coluna] == 0 else valor
 
 
-def atualizar_estoque_produto(spreadsheet, nome_produto, nova_quantidade):
-    """Atualiza o estoque de um produto específico"""
-    try:
-        ws = spreadsheet.worksheet('Produtos')
-        dados = ws.get_all_records()
-        
-        # Encontra a linha do produto
-        for idx, row in enumerate(dados, start=2):  # start=2 porque linha 1 é cabeçalho
-            if row.get('Nome') == nome_produto:
-                # Encontra a coluna de Estoque_Atual
-                headers = ws.row_values(1)
-                if 'Estoque_Atual' in headers:
-                    col_idx = headers.index('Estoque_Atual') + 1
-                    ws.update_cell(idx, col_idx, float(nova_quantidade))
-                    return True
-        return False
-    except Exception as e:
-        st.error(f"❌ Erro ao atualizar estoque: {e}")
-        return False
+def ler_estado_alertas(banco):
+    """Estado dos avisos lido da aba Alertas_Estado, com as gravações ainda na fila de envio"""
+    cabecalho, colunas = banco.ler_colunas('Alertas_Estado')
+    estado = EstadoAlertas(montar_tabela(cabecalho, colunas, ESQUEMA_ABAS['Alertas_Estado']))
+    diario = obter_diario(banco)
+    if diario is not None:
+        estado.aplicar_pendentes(
+            diario.linhas_pendentes('Alertas_Estado'),
+            diario.celulas_pendentes('Alertas_Estado', 'celulas_chave')
+        )
+    return estado
 
 
-def obter_produtos_estoque_critico(df_produtos):
-    """Retorna produtos com estoque abaixo do mínimo"""
-    if df_produtos.empty:
-        return pd.DataFrame()
+def gravar_estado_alertas(banco, linhas, celulas):
+    """Grava as mudanças do estado dos avisos (pelo diário, quando o armazenamento tem um)"""
+    # As linhas novas vão antes das células: uma célula pode ser de uma linha anexada no mesmo lote
+    lancamento = [('anexar', 'Alertas_Estado', linhas), ('celulas_chave', 'Alertas_Estado', celulas)]
+    if not linhas and not celulas:
+        return
+    diario = obter_diario(banco)
+    if diario is not None:
+        diario.registrar(lancamento)
+    else:
+        aplicar_lancamento(banco, lancamento)
+
+
+class DespachanteAlertas:
+    """
+    Envio dos alertas de estoque em segundo plano, fora do checkout.
     
-    if 'Estoque_Atual' not in df_produtos.columns or 'Estoque_Minimo' not in df_produtos.columns:
-        return pd.DataFrame()
+    Os alertas entram numa fila; uma thread descarta os produtos já avisados (EstadoAlertas)
+    e junta os demais num resumo por armazenamento, enviado no máximo uma vez por janela
+    (o primeiro alerta depois de uma janela sem envios sai na hora). Cada resumo é um único
+    email para todos os destinatários ativos (aba Alertas_Config, relida a cada 5 minutos),
+    pela mesma conexão SMTP, com novas tentativas e espera exponencial se falhar. Um resumo
+    que não sai nem assim volta para a fila e é tentado de novo na janela seguinte: os
+    produtos só contam como avisados depois que o email é aceito pelo servidor.
+    A conexão é fechada depois de um minuto sem envios.
+    """
     
-    # Filtra produtos com estoque crítico
-    criticos = df_produtos[df_produtos['Estoque_Atual'] <= df_produtos['Estoque_Minimo']].copy()
+    TENTATIVAS = 5
+    OCIOSO = 60  # segundos sem envios até fechar a conexão SMTP
+    VALIDADE_DESTINATARIOS = 300
+    VALIDADE_ESTADO = 300  # segundos até reler a aba Alertas_Estado
     
-    if not criticos.empty:
-        criticos['Deficit'] = criticos['Estoque_Minimo'] - criticos['Estoque_Atual']
+    def __init__(self, config_email):
+        self.conexao = ConexaoSMTP(config_email)
+        self.janela = float(config_email.get('janela_resumo_min', 15)) * 60
+        self.ultimo_erro = None
+        self.enviados = 0
+        self.suprimidos = 0
+        self._fila = queue.Queue()
+        self._destinatarios = {}  # banco.id -> (momento da leitura, [emails])
+        self._estados = {}  # banco.id -> EstadoAlertas
+        self._resumos = {}  # banco.id -> [banco, {nome: produto}, momento do envio]
+        self._ultimo_envio = {}  # banco.id -> momento do último resumo enviado
+        self._ultimo_uso = time.monotonic()
+        self._thread = threading.Thread(target=self._trabalhar, name='despachante-alertas', daemon=True)
+        self._thread.start()
     
-    return criticos
-
-
-def enviar_alerta_email(destinatario, produtos_criticos, config_email=None):
-    """Envia alerta por email sobre produtos com estoque crítico"""
-    try:
-        # Configurações de email (pode vir do secrets)
-        if config_email is None:
-            if "email_config" in st.secrets:
-                config_email = dict(st.secrets["email_config"])
-            else:
-                return False, "Configuração de email não encontrada"
-        
-        smtp_server = config_email.get('smtp_server', 'smtp.gmail.com')
-        smtp_port = config_email.get('smtp_port', 587)
-        email_sender = config_email.get('email_sender', '')
-        email_password = config_email.get('email_password', '')
-        
-        if not email_sender or not email_password:
-            return False, "Credenciais de email não configuradas"
-        
-        # Monta o corpo do email
-        html_produtos = ""
-        for _, prod in produtos_criticos.iterrows():
-            html_produtos += f"""
-            <tr>
-                <td style="padding: 8px; border: 1px solid #ddd;">{prod.get('Nome', 'N/A')}</td>
-                <td style="padding: 8px; border: 1px solid #ddd; text-align: center;">{prod.get('Estoque_Atual', 0)}</td>
-                <td style="padding: 8px; border: 1px solid #ddd; text-align: center;">{prod.get('Estoque_Minimo', 0)}</td>
-            </tr>
-            """
-        
-        html_body = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif;">
-            <div style="background: linear-gradient(135deg, #dc2626 0%, #b91c1c 100%); color: white; padding: 20px; border-radius: 10px;">
-                <h1>⚠️ Alerta de Estoque Crítico</h1>
-                <p>Os seguintes produtos estão com estoque abaixo do nível mínimo:</p>
-            </div>
-            <table style="width: 100%; border-collapse: collapse; margin-top: 20px;">
-                <thead>
-                    <tr style="background-color: #1e3a5f; color: white;">
-                        <th style="padding: 10px; border: 1px solid #ddd;">Produto</th>
-                        <th style="padding: 10px; border: 1px solid #ddd;">Estoque Atual</th>
-                        <th style="padding: 10px; border: 1px solid #ddd;">Estoque Mínimo</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {html_produtos}
-                </tbody>
-            </table>
-            <p style="margin-top: 20px; color: #666;">
-                Este é um alerta automático do Sistema de Compras.<br>
-                Data/Hora: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}
-            </p>
-        </body>
-        </html>
+    def enfileirar(self, banco, produtos_criticos):
+        """Agenda o alerta dos produtos críticos (lista de dicts Nome/Estoque_Atual/Estoque_Minimo)"""
+        self._fila.put(('alerta', banco, list(produtos_criticos)))
+    
+    def informar_estoques(self, banco, estoques):
+        """Estoques que mudaram ({nome: (atual, mínimo)}): os que passaram do mínimo podem ser avisados de novo"""
+        self._fila.put(('estoque', banco, dict(estoques)))
+    
+    def pendentes(self):
+        return self._fila.qsize() + sum(len(resumo[1]) for resumo in list(self._resumos.values()))
+    
+    def destinatarios(self, banco):
+        """Emails ativos da aba Alertas_Config (com cache, para não ler a aba a cada alerta)"""
+        lidos_em, emails = self._destinatarios.get(banco.id, (0, []))
+        if time.monotonic() - lidos_em > self.VALIDADE_DESTINATARIOS:
+            emails = [
+                str(config['Email']) for config in carregar_config_alertas(banco)
+                if config.get('Ativo') == 'Sim' and config.get('Email')
+            ]
+            emails = list(dict.fromkeys(emails))
+            self._destinatarios[banco.id] = (time.monotonic(), emails)
+        return emails
+    
+    def esquecer_destinatarios(self, banco):
+        self._destinatarios.pop(banco.id, None)
+    
+    def _estado(self, banco):
         """
+        Estado dos avisos do armazenamento, relido depois de VALIDADE_ESTADO (avisos e edições
+        de outras instâncias). Com gravações na fila, a releitura espera o envio terminar.
+        """
+        estado = self._estados.get(banco.id)
+        if estado is None or estado.expirado(self.VALIDADE_ESTADO):
+            diario = obter_diario(banco) if estado is not None else None
+            if estado is None or diario is None or not diario.pendentes():
+                self._estados[banco.id] = estado = ler_estado_alertas(banco)
+        return estado
+    
+    def _receber(self, item):
+        tipo, banco, dados = item
+        try:
+            estado = self._estado(banco)
+        except Exception as e:
+            self.ultimo_erro = f"Estado dos alertas: {e}"
+            estado = None  # Sem o estado, avisa de novo em vez de perder o alerta
         
-        # Cria a mensagem
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = f"⚠️ ALERTA: {len(produtos_criticos)} produto(s) com estoque crítico"
-        msg['From'] = email_sender
-        msg['To'] = destinatario
-        
-        msg.attach(MIMEText(html_body, 'html'))
-        
-        # Envia o email
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(email_sender, email_password)
-            server.sendmail(email_sender, destinatario, msg.as_string())
+        if tipo == 'estoque':
+            resumo = self._resumos.get(banco.id)
+            for nome, (estoque_atual, estoque_minimo) in dados.items():
+                if resumo is not None and estoque_atual > estoque_minimo:
+                    resumo[1].pop(nome, None)
+            if estado is not None:
+                gravar_estado_alertas(banco, [], estado.rearmar(dados))
+            return
         
-        return True, "Email enviado com sucesso!"
-    except Exception as e:
-        return False, f"Erro ao enviar email: {e}"
+        novos = [p for p in dados if estado is None or not estado.notificado(p['Nome'], p['Estoque_Minimo'])]
+        self.suprimidos += len(dados) - len(novos)
+        if not novos:
+            return
+        if banco.id not in self._resumos:
+            envio = max(time.monotonic(), self._ultimo_envio.get(banco.id, float('-inf')) + self.janela)
+            self._resumos[banco.id] = [banco, {}, envio]
+        for produto in novos:
+            self._resumos[banco.id][1][produto['Nome']] = produto  # o estoque mais recente prevalece
+    
+    def _enviar(self, banco, produtos):
+        espera = 1
+        for tentativa in range(1, self.TENTATIVAS + 1):
+            try:
+                destinatarios = self.destinatarios(banco)
+                if not destinatarios:
+                    return False
+                msg = montar_email_alerta(self.conexao.remetente, destinatarios, pd.DataFrame(produtos))
+                self.conexao.enviar(msg, destinatarios)
+                self.enviados += 1
+                self.ultimo_erro = None
+                return True
+            except Exception as e:
+                self.ultimo_erro = str(e)
+                if tentativa < self.TENTATIVAS:
+                    time.sleep(espera * random.uniform(0.5, 1.5))
+                    espera = min(espera * 2, 60)
+        return False
+    
+    def _enviar_resumos_vencidos(self):
+        agora = time.monotonic()
+        for chave, (banco, por_nome, envio) in list(self._resumos.items()):
+            if envio > agora:
+                continue
+            del self._resumos[chave]
+            produtos = list(por_nome.values())
+            if not produtos:
+                continue
+            if not self._enviar(banco, produtos):
+                self._reagendar(chave, banco, por_nome)
+                continue
+            self._ultimo_envio[chave] = self._ultimo_uso = time.monotonic()
+            estado = self._estados.get(chave)
+            if estado is not None:
+                try:
+                    gravar_estado_alertas(banco, *estado.marcar(produtos, datetime.now().strftime(FORMATO_DATA)))
+                except Exception as e:
+                    self.ultimo_erro = f"Estado dos alertas: {e}"
+    
+    def _reagendar(self, chave, banco, por_nome):
+        """Devolve à fila um resumo que não foi enviado, para a próxima janela"""
+        resumo = self._resumos.setdefault(chave, [banco, {}, time.monotonic() + self.janela])
+        resumo[1] = {**por_nome, **resumo[1]}  # alertas chegados depois prevalecem
+    
+    def _trabalhar(self):
+        while True:
+            if self._resumos:
+                espera = max(0, min(resumo[2] for resumo in self._resumos.values()) - time.monotonic())
+            else:
+                espera = self.OCIOSO
+            try:
+                self._receber(self._fila.get(timeout=espera))
+                while True:
+                    self._receber(self._fila.get_nowait())
+            except queue.Empty:
+                pass
+            
+            self._enviar_resumos_vencidos()
+            if not self._resumos and time.monotonic() - self._ultimo_uso > self.OCIOSO:
+                self.conexao.fechar()
+
+
+# Um despachante por conta de email, compartilhado por todas as sessões do processo
+_despachantes = {}
+_lock_despachantes = threading.Lock()
+
+
+def obter_despachante_alertas(config_email):
+    """Despachante (e conexão SMTP) da conta de email configurada, criado na primeira chamada"""
+    chave = (config_email.get('smtp_server'), config_email.get('smtp_port'), config_email.get('email_sender'))
+    with _lock_despachantes:
+        if chave not in _despachantes:
+            _despachantes[chave] = DespachanteAlertas(config_email)
+        return _despachantes[chave]
+
+
+def agendar_alerta_estoque(banco, produtos_criticos):
+    """
+    Coloca o alerta dos produtos críticos na fila de envio (o checkout não espera o email).
+    Retorna False se o envio de emails não estiver configurado.
+    """
+    config_email = configuracao_email()
+    if not produtos_criticos or not config_email or not config_email.get('email_sender'):
+        return False
+    obter_despachante_alertas(config_email).enfileirar(banco, produtos_criticos)
+    return True
+
 
+def informar_estoques_alertas(banco, estoques):
+    """Avisa o despachante dos estoques que mudaram fora das vendas ({nome: (atual, mínimo)})"""
+    config_email = configuracao_email()
+    if config_email and config_email.get('email_sender'):
+        obter_despachante_alertas(config_email).informar_estoques(banco, estoques)
 
-def carregar_config_alertas(spreadsheet):
+
+def carregar_config_alertas(banco):
     """Carrega configurações de alertas"""
     try:
-        ws = spreadsheet.worksheet('Alertas_Config')
-        dados = ws.get_all_records()
+        dados = banco.ler_registros('Alertas_Config')
         return dados
     except:
         return []
 
 
-def salvar_config_alerta(spreadsheet, email, ativo=True):
+def salvar_config_alerta(banco, email, ativo=True):
     """Salva configuração de alerta"""
     try:
-        ws = spreadsheet.worksheet('Alertas_Config')
-        dados = ws.get_all_values()
-        novo_id = len(dados)
+        novo_id = alocar_id(banco, 'Alertas_Config')
         
-        ws.append_row([
+        banco.anexar_linhas('Alertas_Config', [[
             novo_id,
             email,
             "Sim" if ativo else "Não",
             datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ], value_input_option='RAW')
+        ]])
         return True
     except:
         return False
 
 
+# ==================== MINIATURAS DE IMAGENS ====================
+
+def configuracao_imagens():
+    """
+    Lê a seção [imagens] dos secrets:
+    pasta = onde ficam as miniaturas (padrão .miniaturas); tamanho_cache_mb = limite da pasta (padrão 50)
+    """
+    try:
+        if "imagens" in st.secrets:
+            return dict(st.secrets["imagens"])
+    except Exception:
+        pass
+    return {}
+
+
+class CacheMiniaturas:
+    """
+    Miniaturas das imagens dos produtos num cache em disco (LRU, limitado em bytes).
+
+    Cada URL é baixada uma única vez: a imagem é reduzida e gravada como JPEG com o
+    nome do hash da URL, e as telas passam a servir o arquivo local em vez de fazer o
+    navegador buscar o original em outro site. Buscas simultâneas da mesma URL esperam
+    a primeira; URLs que falharam não são tentadas de novo por alguns minutos. As telas
+    usam só as miniaturas prontas (pronta) e pedem as que faltam em segundo plano (aquecer);
+    só a prévia do cadastro espera o download (obter).
+    """
+
+    TAMANHO_MAXIMO_ORIGINAL = 15 * 1024 * 1024
+    ESPERA_APOS_FALHA = 600  # segundos
+    BUSCAS_EM_SEGUNDO_PLANO = 4
+
+    def __init__(self, pasta, limite_bytes):
+        self.pasta = pasta
+        self.limite_bytes = limite_bytes
+        self._lock = threading.Lock()
+        self._buscando = {}  # arquivo -> Event da busca em andamento
+        self._falhas = {}  # url -> momento da última falha
+        self._agendadas = set()  # (url, lado) na fila de aquecer
+        self._executor = None
+        os.makedirs(pasta, exist_ok=True)
+        self._tamanho_total = sum(entrada.stat().st_size for entrada in os.scandir(pasta) if entrada.is_file())
+
+    def _arquivo(self, url, lado):
+        return os.path.join(self.pasta, f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}_{lado}.jpg")
+
+    @staticmethod
+    def url_valida(url):
+        url = str(url or '').strip()
+        return url if url.lower().startswith(('http://', 'https://')) else None
+
+    @staticmethod
+    def _ler(arquivo):
+        try:
+            with open(arquivo, 'rb') as f:
+                dados = f.read()
+            os.utime(arquivo)  # uso recente: fica por último na fila de remoção
+            return dados
+        except FileNotFoundError:
+            return None
+
+    def pronta(self, url, lado):
+        """Bytes da miniatura se já estiver no cache, sem baixar nada; senão None"""
+        url = self.url_valida(url)
+        return self._ler(self._arquivo(url, lado)) if url else None
+
+    def aquecer(self, urls, lado):
+        """Agenda em segundo plano a busca das miniaturas que ainda não estão no cache"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.BUSCAS_EM_SEGUNDO_PLANO, thread_name_prefix='miniaturas'
+                )
+            novas = [(url, lado) for url in urls if (url, lado) not in self._agendadas]
+            self._agendadas.update(novas)
+        for url, lado in novas:
+            self._executor.submit(self._aquecer_uma, url, lado)
+
+    def _aquecer_uma(self, url, lado):
+        try:
+            self.obter(url, lado)
+        finally:
+            with self._lock:
+                self._agendadas.discard((url, lado))
+
+    def obter(self, url, lado):
+        """Bytes JPEG da miniatura (lado máximo em pixels), ou None se a imagem não puder ser obtida"""
+        url = self.url_valida(url)
+        if not url:
+            return None
+        arquivo = self._arquivo(url, lado)
+
+        while True:
+            dados = self._ler(arquivo)
+            if dados is not None:
+                return dados
+
+            with self._lock:
+                if time.monotonic() - self._falhas.get(url, -self.ESPERA_APOS_FALHA) < self.ESPERA_APOS_FALHA:
+                    return None
+                em_andamento = self._buscando.get(arquivo)
+                if em_andamento is None:
+                    self._buscando[arquivo] = threading.Event()
+                    break
+            em_andamento.wait(timeout=30)
+
+        try:
+            dados = self._baixar_e_reduzir(url, lado)
+            temporario = f"{arquivo}.{uuid.uuid4().hex}.tmp"
+            with open(temporario, 'wb') as f:
+                f.write(dados)
+            os.replace(temporario, arquivo)
+            with self._lock:
+                self._tamanho_total += len(dados)
+            self._podar()
+            return dados
+        except Exception:
+            with self._lock:
+                self._falhas[url] = time.monotonic()
+            return None
+        finally:
+            with self._lock:
+                self._buscando.pop(arquivo).set()
+
+    def _baixar_e_reduzir(self, url, lado):
+        with requests.get(url, timeout=(3, 10), stream=True, headers={'User-Agent': 'Sistema-Compras'}) as resposta:
+            resposta.raise_for_status()
+            original = io.BytesIO()
+            for bloco in resposta.iter_content(64 * 1024):
+                original.write(bloco)
+                if original.tell() > self.TAMANHO_MAXIMO_ORIGINAL:
+                    raise ValueError("Imagem grande demais")
+
+        original.seek(0)
+        with Image.open(original) as imagem:
+            imagem.draft('RGB', (lado, lado))  # JPEG: decodifica já reduzido
+            imagem = ImageOps.exif_transpose(imagem)
+            imagem.thumbnail((lado, lado))
+            if imagem.mode in ('RGBA', 'LA', 'P'):
+                imagem = imagem.convert('RGBA')
+                fundo = Image.new('RGB', imagem.size, 'white')
+                fundo.paste(imagem, mask=imagem.getchannel('A'))
+                imagem = fundo
+            saida = io.BytesIO()
+            imagem.convert('RGB').save(saida, 'JPEG', quality=85, optimize=True)
+        return saida.getvalue()
+
+    def _podar(self):
+        """Remove as miniaturas usadas há mais tempo até a pasta caber em 90% do limite"""
+        with self._lock:
+            if self._tamanho_total <= self.limite_bytes:
+                return
+            entradas = sorted(
+                (entrada for entrada in os.scandir(self.pasta) if entrada.is_file()),
+                key=lambda entrada: entrada.stat().st_mtime
+            )
+            for entrada in entradas:
+                if self._tamanho_total <= self.limite_bytes * 0.9:
+                    break
+                try:
+                    tamanho = entrada.stat().st_size
+                    os.remove(entrada.path)
+                    self._tamanho_total -= tamanho
+                except FileNotFoundError:
+                    pass
+
+
+@st.cache_resource
+def obter_cache_miniaturas(pasta, limite_mb):
+    """Cache de miniaturas do processo (compartilhado por todas as sessões)"""
+    return CacheMiniaturas(pasta, int(limite_mb * 1024 * 1024))
+
+
+def _cache_miniaturas():
+    config = configuracao_imagens()
+    return obter_cache_miniaturas(config.get('pasta', '.miniaturas'), config.get('tamanho_cache_mb', 50))
+
+
+def miniatura(url, lado):
+    """Bytes JPEG da miniatura da imagem do produto, ou None"""
+    return _cache_miniaturas().obter(url, lado)
+
+
+def miniaturas_data_uri(urls, lado):
+    """
+    {url: imagem} para colunas ImageColumn, só com as URLs informadas (as linhas exibidas).
+    As miniaturas já no cache vão como data URI, junto com a tabela; as outras ficam com a URL
+    original nesta exibição e são baixadas em segundo plano, sem segurar a página.
+    """
+    cache = _cache_miniaturas()
+    imagens, faltando = {}, []
+    for url in dict.fromkeys(urls):
+        conteudo = cache.pronta(url, lado)
+        if conteudo:
+            imagens[url] = 'data:image/jpeg;base64,' + base64.b64encode(conteudo).decode('ascii')
+        elif cache.url_valida(url):
+            imagens[url] = url
+            faltando.append(url)
+    if faltando:
+        cache.aquecer(faltando, lado)
+    return imagens
+
+
+def mostrar_imagem_produto(url, largura, esperar=False, **kwargs):
+    """
+    Mostra a miniatura local da imagem do produto (em dobro, para telas de alta densidade) ou 📦.
+    Normalmente só usa a miniatura já no cache: a que falta é baixada em segundo plano e aparece
+    numa próxima exibição, sem segurar o caixa. esperar=True (prévia do cadastro) baixa na hora.
+    """
+    lado = largura * 2
+    if esperar:
+        conteudo = miniatura(url, lado) if url else None
+    else:
+        cache = _cache_miniaturas()
+        conteudo = cache.pronta(url, lado)
+        if conteudo is None and cache.url_valida(url):
+            cache.aquecer([url], lado)
+    if conteudo:
+        st.image(conteudo, width=largura, **kwargs)
+    else:
+        st.markdown("📦")
+    return conteudo is not None
+
+
 # ==================== INTERFACE STREAMLIT ====================
 
 def mostrar_config():
@@ -777,7 +4147,7 @@ def mostrar_config():
     """)
 
 
-def pagina_produtos(spreadsheet):
+def pagina_produtos(banco):
     """Página de gerenciamento de produtos"""
     st.markdown("""
     <div class="main-header">
@@ -798,7 +4168,11 @@ def pagina_produtos(spreadsheet):
                 ["Alimentos", "Bebidas", "Limpeza", "Higiene", "Outros"]
             )
             preco = st.number_input("Preço (R$)", min_value=0.01, step=0.01, format="%.2f")
-            unidade = st.selectbox("Unidade", ["un", "kg", "L", "cx", "pct"])
+            unidade = st.selectbox("Unidade", UNIDADES)
+            codigo = st.text_input(
+                "🏷️ Código de Barras (opcional)",
+                help="EAN/GTIN da embalagem, usado na leitura de códigos do carrinho"
+            )
             
             # Campos de estoque
             st.markdown("##### 📦 Estoque")
@@ -815,44 +4189,58 @@ def pagina_produtos(spreadsheet):
                 help="Cole a URL de uma imagem da web para o produto"
             )
             
-            # Preview da imagem se URL fornecida
-            if imagem_url:
-                st.image(imagem_url, width=150, caption="Preview da imagem")
+            # Preview da imagem se URL fornecida (já fica no cache de miniaturas)
+            if imagem_url and not mostrar_imagem_produto(imagem_url, 150, esperar=True, caption="Preview da imagem"):
+                st.caption("Não foi possível carregar a imagem desta URL.")
             
             submitted = st.form_submit_button("💾 Salvar Produto", use_container_width=True)
             
             if submitted:
                 if nome:
-                    sucesso = adicionar_produto(spreadsheet, nome, categoria, preco, unidade, estoque_atual, estoque_minimo, imagem_url)
+                    sucesso = adicionar_produto(banco, nome, categoria, preco, unidade, estoque_atual, estoque_minimo, imagem_url,
+                                                codigo)
                     if sucesso:
                         st.success(f"✅ Produto '{nome}' adicionado com sucesso!")
-                        # Invalida cache de produtos
-                        st.session_state.cache_key_produtos += 1
                         st.rerun()
                 else:
                     st.error("❌ Informe o nome do produto!")
+        
+        mostrar_importacao_produtos(banco)
     
     with col2:
         st.subheader("📋 Lista de Produtos")
         
-        df_produtos = carregar_produtos(spreadsheet, st.session_state.cache_key_produtos)
+        versao_produtos = versao_dados(banco, 'Produtos')
+        df_produtos = com_estoque_atual(banco, carregar_produtos(banco, versao_produtos))
         
         if not df_produtos.empty:
-            # Filtro de busca
-            busca = st.text_input("🔍 Buscar produto...")
+            # Busca pelo índice do catálogo (sem acentos), com a categoria como faceta
+            col_busca, col_categoria = st.columns([2, 1])
+            with col_busca:
+                busca = st.text_input("🔍 Buscar produto...")
             
-            if busca:
-                df_filtrado = df_produtos[
-                    df_produtos['Nome'].str.contains(busca, case=False, na=False)
-                ]
-            else:
-                df_filtrado = df_produtos
+            indice_busca = indice_busca_produtos(banco, versao_produtos)
+            posicoes = indice_busca.buscar(busca)
+            facetas = indice_busca.categorias_encontradas(posicoes)
+            with col_categoria:
+                categoria = st.selectbox(
+                    "Categoria", ["Todas"] + facetas.index.tolist(),
+                    format_func=lambda c: f"Todas ({len(posicoes)})" if c == "Todas" else f"{c} ({facetas[c]})"
+                )
+            if categoria != "Todas":
+                posicoes = posicoes[indice_busca.categorias[posicoes] == categoria]
+            
+            df_filtrado = df_produtos.iloc[posicoes] if busca or categoria != "Todas" else df_produtos
             
             # Verifica produtos com estoque crítico
             produtos_criticos = obter_produtos_estoque_critico(df_filtrado)
             if not produtos_criticos.empty:
                 st.warning(f"⚠️ **{len(produtos_criticos)} produto(s) com estoque crítico!**")
             
+            if st.toggle("✏️ Editar catálogo", key="editar_catalogo"):
+                mostrar_edicao_catalogo(banco, df_produtos, df_filtrado)
+                return
+            
             # Configuração das colunas (só inclui as que existem no DataFrame)
             column_config = {}
             
@@ -875,8 +4263,30 @@ def pagina_produtos(spreadsheet):
             if 'Data_Cadastro' in df_filtrado.columns:
                 column_config["Data_Cadastro"] = st.column_config.TextColumn("Cadastrado em", width="medium")
             
+            # Paginação: só as linhas da página atual vão ao navegador e têm miniaturas montadas
+            col_pagina, col_tamanho, _ = st.columns([1, 1, 2])
+            with col_tamanho:
+                itens_por_pagina = st.selectbox("Itens por página", [50, 100, 250], key="produtos_por_pagina")
+            total_paginas = max(1, -(-len(df_filtrado) // itens_por_pagina))
+            with col_pagina:
+                pagina_atual = st.number_input(
+                    f"Página (de {total_paginas})",
+                    min_value=1,
+                    max_value=total_paginas,
+                    value=1,
+                    step=1,
+                    key=f"produtos_pagina_{total_paginas}"
+                )
+            inicio_pagina = (int(pagina_atual) - 1) * itens_por_pagina
+            df_pagina = df_filtrado.iloc[inicio_pagina:inicio_pagina + itens_por_pagina]
+            
+            if 'Imagem' in df_pagina.columns:
+                # Miniaturas locais no lugar das URLs originais (as que faltam chegam nas próximas exibições)
+                imagens = df_pagina['Imagem'].astype(str)
+                df_pagina = df_pagina.assign(Imagem=imagens.map(miniaturas_data_uri(imagens.tolist(), 64)))
+            
             st.dataframe(
-                df_filtrado,
+                df_pagina,
                 use_container_width=True,
                 hide_index=True,
                 column_config=column_config
@@ -887,7 +4297,207 @@ def pagina_produtos(spreadsheet):
             st.info("📭 Nenhum produto cadastrado ainda.")
 
 
-def pagina_compras(spreadsheet):
+def _salvar_alteracoes_catalogo(banco, alteracoes, df_produtos=None):
+    """Valida e grava as alterações do catálogo, mostrando o resultado"""
+    validas, recusadas = validar_alteracoes_catalogo(alteracoes, df_produtos)
+    if not recusadas.empty:
+        st.error(
+            f"❌ {len(recusadas)} alteração(ões) recusada(s): preço, unidade e mínimo não podem ficar "
+            f"vazios, o preço deve ser positivo, o mínimo não pode ser negativo, a unidade deve ser "
+            f"uma de {', '.join(UNIDADES)} e cada código de barras só pode ser de um produto"
+        )
+        st.dataframe(recusadas.astype({'Antes': str, 'Depois': str}), use_container_width=True, hide_index=True)
+        return False
+    try:
+        total = gravar_alteracoes_catalogo(banco, validas)
+    except Exception as e:
+        st.error(f"❌ Erro ao salvar as alterações: {e}")
+        return False
+    st.success(f"✅ {total} célula(s) atualizada(s)!")
+    return True
+
+
+def mostrar_edicao_catalogo(banco, df_produtos, df_filtrado):
+    """Catálogo editável: só as células alteradas são gravadas, numa única gravação"""
+    with st.expander("📈 Reajuste de preços em massa"):
+        col1, col2 = st.columns(2)
+        with col1:
+            categorias = sorted(df_produtos['Categoria'].astype(str).unique())
+            categoria = st.selectbox("Categoria", ["Todas"] + categorias, key="categoria_reajuste")
+        with col2:
+            percentual = st.number_input("Reajuste (%)", min_value=-90.0, max_value=500.0, value=0.0, step=1.0,
+                                         format="%.1f", key="percentual_reajuste")
+        
+        reajustados = reajustar_precos(df_produtos, percentual, None if categoria == "Todas" else categoria)
+        alteracoes = alteracoes_catalogo(df_produtos, reajustados)
+        st.caption(f"{len(alteracoes)} preço(s) serão alterados")
+        if st.button("📈 Aplicar reajuste", use_container_width=True, disabled=alteracoes.empty):
+            if _salvar_alteracoes_catalogo(banco, alteracoes):
+                st.session_state.pop("percentual_reajuste", None)  # não reaplica o mesmo reajuste
+                time.sleep(1)
+                st.rerun()
+    
+    colunas = [c for c in ['ID', 'Nome'] + COLUNAS_EDITAVEIS_PRODUTOS if c in df_filtrado.columns]
+    # Categoria e Unidade como texto: o editor não deixaria digitar valores fora das categorias lidas
+    df_edicao = df_filtrado[colunas].astype({c: str for c in ['Categoria', 'Unidade', 'Imagem', 'Codigo'] if c in colunas})
+    
+    editado = st.data_editor(
+        df_edicao,
+        use_container_width=True,
+        hide_index=True,
+        disabled=['ID', 'Nome'],
+        num_rows="fixed",
+        key="editor_catalogo",
+        column_config={
+            "ID": st.column_config.NumberColumn("ID", width="small"),
+            "Nome": st.column_config.TextColumn("Produto", width="medium"),
+            "Categoria": st.column_config.TextColumn("Categoria", width="small"),
+            "Preço": st.column_config.NumberColumn("Preço", format="R$ %.2f", min_value=0.01, step=0.01),
+            "Unidade": st.column_config.SelectboxColumn("Un.", options=UNIDADES, width="small"),
+            "Estoque_Minimo": st.column_config.NumberColumn("⚠️ Mín.", format="%.1f", min_value=0.0),
+            "Imagem": st.column_config.TextColumn("🖼️ URL da Imagem"),
+            "Codigo": st.column_config.TextColumn("🏷️ Código", width="small"),
+        }
+    )
+    
+    alteracoes = alteracoes_catalogo(df_edicao, editado)
+    if alteracoes.empty:
+        st.info(f"📊 Total de {len(df_filtrado)} produto(s). Edite as células e salve.")
+        return
+    
+    st.write(f"✏️ **{len(alteracoes)}** célula(s) alterada(s)")
+    st.dataframe(
+        alteracoes.astype({'Antes': str, 'Depois': str}),
+        use_container_width=True, hide_index=True, height=min(300, 38 + 35 * len(alteracoes))
+    )
+    if st.button("💾 Salvar alterações", use_container_width=True, type="primary"):
+        if _salvar_alteracoes_catalogo(banco, alteracoes, df_produtos):
+            st.session_state.pop("editor_catalogo", None)
+            time.sleep(1)
+            st.rerun()
+
+
+def mostrar_importacao_produtos(banco):
+    """Importação de vários produtos de uma vez a partir de um arquivo CSV ou Excel"""
+    with st.expander("📥 Importar Planilha de Produtos"):
+        st.caption(
+            "Colunas: Nome (obrigatória), Categoria, Preço, Unidade, Estoque_Atual, Estoque_Minimo, Imagem e Codigo (código de barras). "
+            "Preços podem vir como 1.234,50 ou 1234.50."
+        )
+        arquivo = st.file_uploader("Arquivo CSV ou XLSX", type=["csv", "xlsx"], key="arquivo_importacao")
+        if arquivo is None:
+            return
+        
+        try:
+            df_arquivo = ler_arquivo_produtos(arquivo.getvalue(), arquivo.name)
+            df_validos, df_recusados = preparar_importacao(
+                df_arquivo, carregar_produtos(banco, versao_dados(banco, 'Produtos'))
+            )
+        except Exception as e:
+            st.error(f"❌ Não foi possível ler o arquivo: {e}")
+            return
+        
+        st.write(f"✅ **{len(df_validos)}** produto(s) prontos para importar")
+        if not df_recusados.empty:
+            st.warning(f"⚠️ {len(df_recusados)} linha(s) recusada(s)")
+            st.dataframe(df_recusados, use_container_width=True, hide_index=True, height=200)
+        
+        if df_validos.empty:
+            return
+        
+        if st.button(f"📥 Importar {len(df_validos)} produto(s)", use_container_width=True):
+            barra = st.progress(0.0, text="Gravando produtos...")
+            
+            def progresso(gravados, total):
+                barra.progress(gravados / total, text=f"{gravados} de {total} produtos gravados")
+            
+            try:
+                gravados = importar_produtos(banco, df_validos, progresso)
+                st.success(f"✅ {gravados} produto(s) importado(s)!")
+            except Exception as e:
+                st.error(
+                    f"❌ Importação interrompida: {e}. Envie o mesmo arquivo de novo para continuar "
+                    "(os produtos já cadastrados são pulados)."
+                )
+
+
+def mostrar_checkout_concluido():
+    """Mostra (uma vez) o resumo da última compra finalizada nesta sessão"""
+    resumo = st.session_state.pop('checkout_concluido', None)
+    if not resumo:
+        return
+    
+    st.success(f"🎉 Compra {resumo['id_compra']} registrada com sucesso!")
+    st.info("📦 Estoque atualizado automaticamente!")
+    
+    # Latência de cada chamada do checkout
+    latencias = resumo['latencias']
+    if latencias:
+        total_ms = sum(ms for _, ms in latencias)
+        st.caption(
+            f"⏱️ Checkout em {total_ms:.0f} ms ({len(latencias)} chamadas): " +
+            " · ".join(f"{nome} {ms:.0f} ms" for nome, ms in latencias)
+        )
+    
+    # Alerta de produtos críticos
+    produtos_criticos = resumo['produtos_criticos']
+    if produtos_criticos:
+        st.warning(f"⚠️ **ATENÇÃO:** {len(produtos_criticos)} produto(s) ficaram com estoque crítico!")
+        
+        for prod in produtos_criticos:
+            st.error(f"🔴 **{prod['Nome']}** - Estoque: {prod['Estoque_Atual']:.0f} (Mín: {prod['Estoque_Minimo']:.0f})")
+    
+    if resumo['alerta_agendado']:
+        st.info("📧 Alerta de estoque na fila de envio por email")
+    
+    st.balloons()
+
+
+def adicionar_ao_carrinho(produto, quantidade):
+    """Põe o produto (registro do índice de produtos) no carrinho; se já estiver lá, soma a quantidade"""
+    nome = produto['Nome']
+    preco = float(produto.get('Preço', 0) or 0)
+    for item in st.session_state.carrinho:
+        if item['produto'] == nome and item['preco'] == preco:
+            item['quantidade'] += quantidade
+            item['subtotal'] = item['quantidade'] * preco
+            return
+    st.session_state.carrinho.append({
+        'produto': nome,
+        'quantidade': quantidade,
+        'preco': preco,
+        'subtotal': quantidade * preco,
+        'imagem': str(produto.get('Imagem', '') or '')
+    })
+
+
+def _ler_codigo_carrinho(banco):
+    """
+    Callback do campo de leitura: o leitor de código de barras digita o código e um Enter,
+    e o produto entra no carrinho. '3*789...' adiciona 3 unidades. O campo é limpo para a próxima leitura.
+    """
+    leitura = str(st.session_state.get('leitura_codigo', '')).strip()
+    st.session_state.leitura_codigo = ''
+    if not leitura:
+        return
+    
+    quantidade, _, codigo = leitura.rpartition('*')
+    try:
+        quantidade = float(quantidade.replace(',', '.')) if quantidade else 1.0
+    except ValueError:
+        quantidade = 0.0
+    
+    produto = obter_indice_produtos(banco).produto_por_codigo(codigo)
+    if produto is None:
+        st.session_state.leitura_resultado = ('erro', f"❌ Código {codigo} não cadastrado")
+    elif quantidade <= 0:
+        st.session_state.leitura_resultado = ('erro', f"❌ Quantidade inválida: {leitura}")
+    else:
+        adicionar_ao_carrinho(produto, quantidade)
+        st.session_state.leitura_resultado = ('ok', f"✅ {quantidade:g} x {produto['Nome']} adicionado!")
+
+
+def pagina_compras(banco):
     """Página de registro de compras"""
     st.markdown("""
     <div class="main-header">
@@ -900,7 +4510,16 @@ def pagina_compras(spreadsheet):
     if 'carrinho' not in st.session_state:
         st.session_state.carrinho = []
     
-    df_produtos = carregar_produtos(spreadsheet, st.session_state.cache_key_produtos)
+    mostrar_checkout_concluido()
+    
+    diario = obter_diario(banco)
+    if diario is not None and diario.pendentes():
+        st.caption(f"⏳ {diario.pendentes()} venda(s) na fila de envio para a planilha")
+        if diario.ultimo_erro:
+            st.caption(f"⚠️ Última tentativa de envio falhou: {diario.ultimo_erro}")
+    
+    versao_produtos = versao_dados(banco, 'Produtos')
+    df_produtos = carregar_produtos(banco, versao_produtos)
     
     if df_produtos.empty:
         st.warning("⚠️ Cadastre produtos primeiro na aba 'Produtos'!")
@@ -911,8 +4530,32 @@ def pagina_compras(spreadsheet):
     with col1:
         st.subheader("➕ Adicionar ao Carrinho")
         
+        # Leitura de código de barras: cada leitura (código + Enter) já adiciona o item
+        if st.toggle("📷 Leitura de código de barras", key="modo_leitura"):
+            st.text_input(
+                "Código de barras",
+                key="leitura_codigo",
+                on_change=_ler_codigo_carrinho,
+                args=(banco,),
+                placeholder="Passe o leitor ou digite o código e Enter",
+                help="Para várias unidades, digite a quantidade e * antes do código (ex.: 3*7891234567890)"
+            )
+            resultado = st.session_state.pop('leitura_resultado', None)
+            if resultado:
+                (st.success if resultado[0] == 'ok' else st.error)(resultado[1])
+            st.markdown("---")
+        
+        # Busca pelo índice do catálogo: a lista mostra só os 50 mais relevantes
+        busca = st.text_input("🔍 Buscar produto", key="busca_carrinho", placeholder="Digite parte do nome")
+        nomes = df_produtos['Nome']
+        if busca:
+            nomes = nomes.iloc[indice_busca_produtos(banco, versao_produtos).buscar(busca, limite=50)]
+            if nomes.empty:
+                st.caption("Nenhum produto encontrado para a busca.")
+                nomes = df_produtos['Nome']
+        
         # Seleção de produto (filtra nomes vazios)
-        opcoes_produtos = [nome for nome in df_produtos['Nome'].tolist() if nome and str(nome).strip()]
+        opcoes_produtos = [nome for nome in nomes.tolist() if nome and str(nome).strip()]
         
         if not opcoes_produtos:
             st.warning("⚠️ Nenhum produto válido encontrado!")
@@ -920,23 +4563,19 @@ def pagina_compras(spreadsheet):
         
         produto_selecionado = st.selectbox("Selecione o Produto", opcoes_produtos)
         
-        # Busca dados do produto selecionado com tratamento de erros
-        try:
-            produto_info = df_produtos[df_produtos['Nome'] == produto_selecionado].iloc[0]
-            preco_produto = float(produto_info.get('Preço', 0) or 0)
-            unidade_produto = str(produto_info.get('Unidade', 'un') or 'un')
-            imagem_produto = str(produto_info.get('Imagem', '') or '') if 'Imagem' in df_produtos.columns else ''
-        except (IndexError, KeyError):
+        # Dados do produto selecionado pelo índice de produtos (sem varrer o catálogo)
+        produto_info = obter_indice_produtos(banco, [produto_selecionado]).registros.get(produto_selecionado)
+        if produto_info is None:
             st.error("❌ Erro ao carregar dados do produto!")
             return
+        preco_produto = float(produto_info.get('Preço', 0) or 0)
+        unidade_produto = str(produto_info.get('Unidade', 'un') or 'un')
+        imagem_produto = str(produto_info.get('Imagem', '') or '')
         
         # Mostra imagem do produto se disponível
         col_img, col_info = st.columns([1, 2])
         with col_img:
-            if imagem_produto and str(imagem_produto).strip():
-                st.image(imagem_produto, width=100)
-            else:
-                st.markdown("📦")
+            mostrar_imagem_produto(imagem_produto, 100)
         with col_info:
             st.info(f"💰 Preço: R$ {preco_produto:.2f} / {unidade_produto}")
         
@@ -952,14 +4591,7 @@ def pagina_compras(spreadsheet):
         st.markdown(f"**Subtotal: R$ {subtotal:.2f}**")
         
         if st.button("🛒 Adicionar ao Carrinho", use_container_width=True):
-            item = {
-                'produto': produto_selecionado,
-                'quantidade': quantidade,
-                'preco': preco_produto,
-                'subtotal': subtotal,
-                'imagem': imagem_produto if imagem_produto else ""
-            }
-            st.session_state.carrinho.append(item)
+            adicionar_ao_carrinho(produto_info, quantidade)
             st.success(f"✅ {produto_selecionado} adicionado!")
             st.rerun()
     
@@ -972,10 +4604,7 @@ def pagina_compras(spreadsheet):
                 col_img_cart, col_info_cart, col_remove = st.columns([1, 3, 1])
                 
                 with col_img_cart:
-                    if item.get('imagem') and str(item['imagem']).strip():
-                        st.image(item['imagem'], width=60)
-                    else:
-                        st.markdown("📦")
+                    mostrar_imagem_produto(item.get('imagem'), 60)
                 
                 with col_info_cart:
                     st.markdown(f"**{item['produto']}**")
@@ -1040,48 +4669,29 @@ def pagina_compras(spreadsheet):
                 observacao = st.text_input("Observação (opcional)")
                 
                 if st.button("✅ Finalizar Compra", use_container_width=True, type="primary"):
-                    resultado = registrar_compra(spreadsheet, st.session_state.carrinho, metodo_pagamento, observacao)
+                    resultado = registrar_compra(banco, st.session_state.carrinho, metodo_pagamento, observacao)
                     
                     if resultado and resultado[0]:
                         id_compra, produtos_criticos = resultado
                         
-                        st.success(f"🎉 Compra {id_compra} registrada com sucesso!")
-                        st.info("📦 Estoque atualizado automaticamente!")
+                        # O alerta por email (se configurado) vai para a fila de envio em segundo plano
+                        alerta_agendado = agendar_alerta_estoque(banco, produtos_criticos)
                         
-                        # Alerta de produtos críticos
-                        if produtos_criticos:
-                            st.warning(f"⚠️ **ATENÇÃO:** {len(produtos_criticos)} produto(s) ficaram com estoque crítico!")
-                            
-                            for prod in produtos_criticos:
-                                st.error(f"🔴 **{prod['Nome']}** - Estoque: {prod['Estoque_Atual']:.0f} (Mín: {prod['Estoque_Minimo']:.0f})")
-                            
-                            # Tenta enviar alerta por email se configurado
-                            try:
-                                config_alertas = carregar_config_alertas(spreadsheet)
-                                if config_alertas:
-                                    for config in config_alertas:
-                                        if config.get('Ativo') == 'Sim' and config.get('Email'):
-                                            df_criticos = pd.DataFrame(produtos_criticos)
-                                            enviar_alerta_email(config['Email'], df_criticos)
-                                            st.info(f"📧 Alerta enviado para {config['Email']}")
-                            except:
-                                pass  # Silenciosamente ignora erros de email
+                        # O resumo é mostrado depois do rerun, sem segurar a tela
+                        st.session_state.checkout_concluido = {
+                            'id_compra': id_compra,
+                            'produtos_criticos': produtos_criticos,
+                            'latencias': st.session_state.get('latencias_checkout', []),
+                            'alerta_agendado': alerta_agendado,
+                        }
                         
                         st.session_state.carrinho = []
-                        # Invalida caches
-                        st.session_state.cache_key_compras += 1
-                        st.session_state.cache_key_produtos += 1
-                        if 'cache_key_movimentacoes' in st.session_state:
-                            st.session_state.cache_key_movimentacoes += 1
-                        
-                        st.balloons()
-                        time.sleep(2)
                         st.rerun()
         else:
             st.info("🛒 Carrinho vazio. Adicione produtos!")
 
 
-def pagina_historico(spreadsheet):
+def pagina_historico(banco):
     """Página de histórico de compras"""
     st.markdown("""
     <div class="main-header">
@@ -1090,15 +4700,11 @@ def pagina_historico(spreadsheet):
     </div>
     """, unsafe_allow_html=True)
     
-    df_compras = carregar_compras(spreadsheet, st.session_state.cache_key_compras)
+    # Anos, produtos e pagamentos vêm do resumo diário: as compras são lidas só no período escolhido
+    df_resumo = carregar_resumo_diario(banco)
     
-    if not df_compras.empty:
-        # Converte coluna de data para datetime para filtros
-        if 'Data' in df_compras.columns:
-            df_compras['Data_dt'] = pd.to_datetime(df_compras['Data'], errors='coerce')
-            df_compras['Ano'] = df_compras['Data_dt'].dt.year
-            df_compras['Mes'] = df_compras['Data_dt'].dt.month
-            df_compras['Dia'] = df_compras['Data_dt'].dt.day
+    if not df_resumo.empty:
+        hoje = datetime.now().date()
         
         # ==================== FILTROS ====================
         st.subheader("🔍 Filtros")
@@ -1108,10 +4714,10 @@ def pagina_historico(spreadsheet):
             
             with col_data1:
                 # Anos disponíveis
-                if 'Ano' in df_compras.columns:
-                    anos_disponiveis = sorted(df_compras['Ano'].dropna().unique().tolist(), reverse=True)
-                    anos_opcoes = ['Todos'] + [int(a) for a in anos_disponiveis if pd.notna(a)]
-                    filtro_ano = st.selectbox("📆 Ano", anos_opcoes)
+                anos_disponiveis = sorted(df_resumo['Ano'].unique().tolist(), reverse=True)
+                anos_opcoes = ['Todos'] + [int(a) for a in anos_disponiveis]
+                filtro_ano = st.selectbox("📆 Ano", anos_opcoes)
+                ano = None if filtro_ano == 'Todos' else filtro_ano
             
             with col_data2:
                 # Meses
@@ -1123,87 +4729,82 @@ def pagina_historico(spreadsheet):
                 meses_opcoes = ['Todos'] + list(meses_nomes.values())
                 filtro_mes = st.selectbox("📅 Mês", meses_opcoes)
             
+            # Período inicial: últimos 30 dias, ou o ano/mês escolhido (as datas voltam ao
+            # padrão quando o ano ou o mês muda)
+            mes_num = list(meses_nomes.values()).index(filtro_mes) + 1 if filtro_mes != 'Todos' else None
+            data_min, data_max = periodo_padrao(ano, mes_num, hoje)
+            
             with col_data3:
                 # Data inicial
-                if 'Data_dt' in df_compras.columns:
-                    data_min = df_compras['Data_dt'].min()
-                    if pd.notna(data_min):
-                        data_min = data_min.date()
-                    else:
-                        data_min = datetime.now().date() - timedelta(days=365)
-                else:
-                    data_min = datetime.now().date() - timedelta(days=365)
-                
                 filtro_data_inicio = st.date_input(
                     "📅 Data Inicial",
                     value=data_min,
-                    format="DD/MM/YYYY"
+                    format="DD/MM/YYYY",
+                    key=f"historico_inicio_{filtro_ano}_{filtro_mes}"
                 )
             
             with col_data4:
                 # Data final
                 filtro_data_fim = st.date_input(
                     "📅 Data Final",
-                    value=datetime.now().date(),
-                    format="DD/MM/YYYY"
+                    value=data_max,
+                    format="DD/MM/YYYY",
+                    key=f"historico_fim_{filtro_ano}_{filtro_mes}"
                 )
         
+        # Só as linhas do período são lidas; ampliar as datas busca os períodos anteriores
+        versao_compras = versao_dados(banco, 'Compras')
+        df_compras = carregar_compras_periodo(banco, versao_compras, filtro_data_inicio, filtro_data_fim)
+        st.caption(
+            f"Compras de {filtro_data_inicio.strftime('%d/%m/%Y')} a {filtro_data_fim.strftime('%d/%m/%Y')}. "
+            "Amplie as datas para ver períodos anteriores."
+        )
+        
         # Outros filtros
         col_filtro1, col_filtro2, col_filtro3 = st.columns(3)
         
         with col_filtro1:
-            if 'ID_Compra' in df_compras.columns:
-                compras_unicas = ['Todas'] + df_compras['ID_Compra'].unique().tolist()
-                filtro_compra = st.selectbox("🏷️ Filtrar por Compra", compras_unicas)
+            compras_unicas = ['Todas'] + df_compras['ID_Compra'].unique().tolist()
+            filtro_compra = st.selectbox("🏷️ Filtrar por Compra", compras_unicas)
         
         with col_filtro2:
-            if 'Produto' in df_compras.columns:
-                produtos_unicos = ['Todos'] + sorted(df_compras['Produto'].unique().tolist())
-                filtro_produto = st.selectbox("📦 Filtrar por Produto", produtos_unicos)
+            produtos_unicos = ['Todos'] + sorted(p for p in df_resumo['Produto'].unique().tolist() if p)
+            filtro_produto = st.selectbox("📦 Filtrar por Produto", produtos_unicos)
         
         with col_filtro3:
-            if 'Pagamento' in df_compras.columns:
-                pagamentos_unicos = df_compras['Pagamento'].unique().tolist()
-                pagamentos = ['Todos'] + sorted([p for p in pagamentos_unicos if p])
-                filtro_pagamento = st.selectbox("💳 Filtrar por Pagamento", pagamentos)
+            pagamentos_unicos = df_resumo['Pagamento'].unique().tolist()
+            pagamentos = ['Todos'] + sorted([p for p in pagamentos_unicos if p])
+            filtro_pagamento = st.selectbox("💳 Filtrar por Pagamento", pagamentos)
         
         st.markdown("---")
         
         # ==================== APLICA FILTROS ====================
-        df_filtrado = df_compras.copy()
-        
-        # Filtro de ano
-        if 'filtro_ano' in dir() and filtro_ano != 'Todos' and 'Ano' in df_filtrado.columns:
-            df_filtrado = df_filtrado[df_filtrado['Ano'] == filtro_ano]
-        
-        # Filtro de mês
-        if 'filtro_mes' in dir() and filtro_mes != 'Todos' and 'Mes' in df_filtrado.columns:
-            mes_num = list(meses_nomes.keys())[list(meses_nomes.values()).index(filtro_mes)]
-            df_filtrado = df_filtrado[df_filtrado['Mes'] == mes_num]
-        
-        # Filtro de data inicial e final
-        if 'Data_dt' in df_filtrado.columns:
-            df_filtrado = df_filtrado[
-                (df_filtrado['Data_dt'].dt.date >= filtro_data_inicio) &
-                (df_filtrado['Data_dt'].dt.date <= filtro_data_fim)
-            ]
-        
-        # Filtro de compra
-        if 'filtro_compra' in dir() and filtro_compra != 'Todas':
-            df_filtrado = df_filtrado[df_filtrado['ID_Compra'] == filtro_compra]
-        
-        # Filtro de produto
-        if 'filtro_produto' in dir() and filtro_produto != 'Todos':
-            df_filtrado = df_filtrado[df_filtrado['Produto'] == filtro_produto]
-        
-        # Filtro de pagamento
-        if 'filtro_pagamento' in dir() and filtro_pagamento != 'Todos' and 'Pagamento' in df_filtrado.columns:
-            df_filtrado = df_filtrado[df_filtrado['Pagamento'] == filtro_pagamento]
+        # Todos os filtros ativos numa única máscara: uma passada vetorizada, uma única cópia no fim
+        filtros = dict(
+            ano=ano,
+            mes=mes_num,
+            inicio=filtro_data_inicio,
+            fim=filtro_data_fim,
+            produto=None if filtro_produto == 'Todos' else filtro_produto,
+            pagamento=None if filtro_pagamento == 'Todos' else filtro_pagamento,
+        )
+        compra = None if filtro_compra == 'Todas' else filtro_compra
+        df_filtrado = df_compras[mascara_filtros(df_compras, condicoes_historico('Data', compra=compra, **filtros))]
         
         # ==================== MÉTRICAS FILTRADAS ====================
-        total_geral = df_filtrado['Total'].sum() if 'Total' in df_filtrado.columns else 0
-        num_compras = df_filtrado['ID_Compra'].nunique() if 'ID_Compra' in df_filtrado.columns else 0
-        num_itens = len(df_filtrado)
+        # Sem filtro por compra, os totais vêm do resumo diário (não somam as linhas uma a uma)
+        resumo_total = resumo_produtos = None
+        if compra is None:
+            resumo_total, resumo_produtos = filtrar_resumo_diario(df_resumo, **filtros)
+        
+        if resumo_total is not None:
+            total_geral = resumo_total['Total'].sum()
+            num_compras = int(resumo_total['Compras'].sum())
+            num_itens = int(resumo_total['Itens'].sum())
+        else:
+            total_geral = df_filtrado['Total'].sum() if 'Total' in df_filtrado.columns else 0
+            num_compras = df_filtrado['ID_Compra'].nunique() if 'ID_Compra' in df_filtrado.columns else 0
+            num_itens = len(df_filtrado)
         
         col1, col2, col3 = st.columns(3)
         
@@ -1235,7 +4836,8 @@ def pagina_historico(spreadsheet):
         if 'Pagamento' in df_filtrado.columns and not df_filtrado.empty:
             st.markdown("#### 💳 Totais por Método de Pagamento")
             
-            totais_pagamento = df_filtrado.groupby('Pagamento')['Total'].sum().to_dict()
+            origem = resumo_total if resumo_total is not None else df_filtrado
+            totais_pagamento = origem.groupby('Pagamento', observed=True)['Total'].sum().to_dict()
             
             # Cores para cada método
             cores_pagamento = {
@@ -1270,28 +4872,32 @@ def pagina_historico(spreadsheet):
             st.subheader(f"📋 Registros ({len(df_filtrado)} itens)")
         
         with col_export:
-            # Prepara DataFrame para exportação (remove colunas auxiliares)
-            df_export = df_filtrado.drop(columns=['Data_dt', 'Ano', 'Mes', 'Dia'], errors='ignore')
-            
-            # Cria arquivo Excel em memória
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                df_export.to_excel(writer, index=False, sheet_name='Histórico')
-            
-            st.download_button(
-                label="📥 Exportar Excel",
-                data=buffer.getvalue(),
-                file_name=f"historico_compras_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True
+            # O arquivo só é gerado quando pedido; depois fica em cache para o mesmo filtro
+            formato = st.selectbox("Formato", list(FORMATOS_EXPORTACAO), label_visibility="collapsed")
+            assinatura = (
+                versao_compras, filtro_data_inicio, filtro_data_fim,
+                tuple(condicoes_historico('Data', compra=compra, **filtros)), formato
             )
+            
+            if st.session_state.get('exportacao_historico') == assinatura or st.button(
+                "📦 Preparar Exportação", use_container_width=True
+            ):
+                st.session_state.exportacao_historico = assinatura
+                extensao, mime = FORMATOS_EXPORTACAO[formato]
+                st.download_button(
+                    label=f"📥 Baixar {formato}",
+                    data=exportar_historico(banco, *assinatura),
+                    file_name=f"historico_compras_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extensao}",
+                    mime=mime,
+                    use_container_width=True
+                )
         
         # Configuração das colunas (remove colunas auxiliares da visualização)
-        df_exibir = df_filtrado.drop(columns=['Data_dt', 'Ano', 'Mes', 'Dia'], errors='ignore')
+        df_exibir = df_filtrado.drop(columns=['Ano', 'Mes', 'Lancamento'])
         
         column_config = {
             "ID_Compra": st.column_config.TextColumn("ID Compra", width="small"),
-            "Data": st.column_config.TextColumn("Data/Hora", width="medium"),
+            "Data": st.column_config.DatetimeColumn("Data/Hora", format="DD/MM/YYYY HH:mm", width="medium"),
             "Produto": st.column_config.TextColumn("Produto", width="medium"),
             "Quantidade": st.column_config.NumberColumn("Qtd", format="%.2f"),
             "Preço_Unit": st.column_config.NumberColumn("Preço Unit.", format="R$ %.2f"),
@@ -1303,8 +4909,24 @@ def pagina_historico(spreadsheet):
         if 'Pagamento' in df_exibir.columns:
             column_config["Pagamento"] = st.column_config.TextColumn("💳 Pagamento", width="small")
         
+        # Paginação: só as linhas da página atual são enviadas ao navegador
+        col_pagina, col_tamanho, _ = st.columns([1, 1, 2])
+        with col_tamanho:
+            itens_por_pagina = st.selectbox("Itens por página", [50, 100, 250, 500], index=1)
+        total_paginas = max(1, -(-len(df_exibir) // itens_por_pagina))
+        with col_pagina:
+            pagina_atual = st.number_input(
+                f"Página (de {total_paginas})",
+                min_value=1,
+                max_value=total_paginas,
+                value=1,
+                step=1,
+                key=f"historico_pagina_{total_paginas}"
+            )
+        
+        inicio_pagina = (int(pagina_atual) - 1) * itens_por_pagina
         st.dataframe(
-            df_exibir,
+            df_exibir.iloc[inicio_pagina:inicio_pagina + itens_por_pagina],
             use_container_width=True,
             hide_index=True,
             column_config=column_config
@@ -1313,7 +4935,8 @@ def pagina_historico(spreadsheet):
         # Resumo por produto
         if not df_filtrado.empty:
             with st.expander("📊 Resumo por Produto"):
-                resumo = df_filtrado.groupby('Produto').agg({
+                origem = resumo_produtos if resumo_produtos is not None else df_filtrado
+                resumo = origem.groupby('Produto', observed=True).agg({
                     'Quantidade': 'sum',
                     'Total': 'sum'
                 }).reset_index()
@@ -1334,7 +4957,77 @@ def pagina_historico(spreadsheet):
         st.info("📭 Nenhuma compra registrada ainda.")
 
 
-def pagina_estoque(spreadsheet):
+def mostrar_inventario(banco, df_produtos):
+    """Contagem física do estoque: quantidades digitadas na tabela ou enviadas num arquivo, conciliadas de uma vez"""
+    st.markdown("### 🧮 Inventário")
+    st.caption("Informe a quantidade contada de cada produto. Os produtos sem contagem ficam como estão.")
+    
+    origem = st.radio("Contagens", ["Digitar na tabela", "Enviar arquivo"], horizontal=True, key="origem_inventario")
+    
+    if origem == "Digitar na tabela":
+        df_contagem = df_produtos[['Nome', 'Categoria', 'Estoque_Atual']].assign(Contado=np.nan)
+        editado = st.data_editor(
+            df_contagem,
+            use_container_width=True,
+            hide_index=True,
+            disabled=['Nome', 'Categoria', 'Estoque_Atual'],
+            key="editor_inventario",
+            column_config={
+                "Nome": st.column_config.TextColumn("Produto"),
+                "Estoque_Atual": st.column_config.NumberColumn("📦 Sistema", format="%.1f"),
+                "Contado": st.column_config.NumberColumn("🧮 Contado", min_value=0.0, step=1.0, format="%.1f"),
+            }
+        )
+        contagens = pd.Series(editado['Contado'].values, index=editado['Nome'].astype(str).values)
+    else:
+        st.caption("Arquivo CSV ou XLSX com as colunas Nome (ou Produto) e Contado (ou Quantidade).")
+        arquivo = st.file_uploader("Arquivo de contagem", type=["csv", "xlsx"], key="arquivo_inventario")
+        if arquivo is None:
+            return
+        try:
+            contagens = contagens_do_arquivo(ler_arquivo_produtos(arquivo.getvalue(), arquivo.name))
+        except Exception as e:
+            st.error(f"❌ Não foi possível ler o arquivo: {e}")
+            return
+    
+    ajustes, nao_encontrados = conciliar_inventario(df_produtos, contagens)
+    if nao_encontrados:
+        st.warning(f"⚠️ {len(nao_encontrados)} produto(s) não encontrado(s) no cadastro: {', '.join(nao_encontrados[:20])}")
+    
+    if ajustes.empty:
+        st.info("Nenhuma diferença entre o contado e o estoque do sistema.")
+        return
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Ajustes", len(ajustes))
+    col2.metric("📥 Entradas", f"{ajustes['Diferença'].clip(lower=0).sum():.0f}")
+    col3.metric("📤 Saídas", f"{-ajustes['Diferença'].clip(upper=0).sum():.0f}")
+    
+    st.dataframe(
+        ajustes,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Nome": st.column_config.TextColumn("Produto"),
+            "Estoque_Atual": st.column_config.NumberColumn("📦 Sistema", format="%.1f"),
+            "Contado": st.column_config.NumberColumn("🧮 Contado", format="%.1f"),
+            "Diferença": st.column_config.NumberColumn("Diferença", format="%+.1f"),
+        }
+    )
+    
+    observacao = st.text_input("Observação (opcional)", key="obs_inventario", placeholder="Ex: inventário mensal")
+    if st.button(f"✅ Registrar {len(ajustes)} ajuste(s) de inventário", use_container_width=True):
+        try:
+            total = registrar_inventario(banco, df_produtos, contagens, observacao)
+            st.success(f"✅ {total} ajuste(s) de inventário registrado(s)!")
+            st.session_state.pop("editor_inventario", None)
+            time.sleep(1)
+            st.rerun()
+        except Exception as e:
+            st.error(f"❌ Erro ao registrar o inventário: {e}")
+
+
+def pagina_estoque(banco):
     """Página de controle de estoque"""
     st.markdown("""
     <div class="main-header">
@@ -1343,11 +5036,8 @@ def pagina_estoque(spreadsheet):
     </div>
     """, unsafe_allow_html=True)
     
-    # Inicializa cache key de movimentações
-    if 'cache_key_movimentacoes' not in st.session_state:
-        st.session_state.cache_key_movimentacoes = 0
-    
-    df_produtos = carregar_produtos(spreadsheet, st.session_state.cache_key_produtos)
+    # Estoque calculado pelas movimentações (o Estoque_Atual da aba é só a foto do último snapshot)
+    df_produtos = com_estoque_atual(banco, carregar_produtos(banco, versao_dados(banco, 'Produtos')))
     
     if df_produtos.empty:
         st.warning("⚠️ Cadastre produtos primeiro na aba 'Produtos'!")
@@ -1377,7 +5067,7 @@ def pagina_estoque(spreadsheet):
         st.markdown("---")
     
     # ==================== TABS ====================
-    tab1, tab2, tab3 = st.tabs(["📊 Visão Geral", "📥 Movimentações", "⚙️ Configurar Alertas"])
+    tab1, tab2, tab3, tab4 = st.tabs(["📊 Visão Geral", "📥 Movimentações", "🧮 Inventário", "⚙️ Configurar Alertas"])
     
     with tab1:
         # Métricas gerais
@@ -1486,39 +5176,29 @@ def pagina_estoque(spreadsheet):
                 )
                 
                 if submitted_mov:
-                    # Busca estoque atual do produto
-                    estoque_atual = df_produtos[df_produtos['Nome'] == produto_mov]['Estoque_Atual'].values[0]
+                    # Estoque atual calculado pelas movimentações (inclui vendas de outras sessões)
+                    estoque_disponivel = estoque_atual(banco, produto_mov)
                     
-                    # Calcula novo estoque
-                    if tipo_mov == "Entrada":
-                        novo_estoque = estoque_atual + quantidade_mov
+                    if tipo_mov == "Saída" and quantidade_mov > estoque_disponivel:
+                        st.error(f"❌ Quantidade maior que o estoque disponível ({estoque_disponivel:.0f})")
                     else:
-                        if quantidade_mov > estoque_atual:
-                            st.error(f"❌ Quantidade maior que o estoque disponível ({estoque_atual:.0f})")
-                        else:
-                            novo_estoque = estoque_atual - quantidade_mov
-                    
-                    if tipo_mov == "Entrada" or quantidade_mov <= estoque_atual:
-                        # Registra movimentação
-                        id_mov = registrar_movimentacao(spreadsheet, tipo_mov, produto_mov, quantidade_mov, motivo_mov, obs_mov)
+                        # A movimentação é o próprio lançamento do estoque: nada mais é regravado
+                        id_mov = registrar_movimentacao(banco, tipo_mov, produto_mov, quantidade_mov, motivo_mov, obs_mov)
                         
                         if id_mov:
-                            # Atualiza estoque do produto
-                            if atualizar_estoque_produto(spreadsheet, produto_mov, novo_estoque):
-                                st.success(f"✅ {tipo_mov} registrada! Novo estoque de '{produto_mov}': {novo_estoque:.0f}")
-                                st.session_state.cache_key_produtos += 1
-                                st.session_state.cache_key_movimentacoes += 1
-                                time.sleep(1)
-                                st.rerun()
+                            novo_estoque = estoque_atual(banco, produto_mov)
+                            st.success(f"✅ {tipo_mov} registrada! Novo estoque de '{produto_mov}': {novo_estoque:.0f}")
+                            time.sleep(1)
+                            st.rerun()
         
         with col2:
             st.markdown("### 📜 Últimas Movimentações")
             
-            df_mov = carregar_movimentacoes(spreadsheet, st.session_state.cache_key_movimentacoes)
+            df_mov = carregar_movimentacoes(banco, versao_dados(banco, 'Movimentacoes'))
             
             if not df_mov.empty:
                 # Mostra últimas 10 movimentações
-                df_ultimas = df_mov.tail(10).iloc[::-1]  # Inverte para mostrar mais recentes primeiro
+                df_ultimas = df_mov.tail(10).iloc[::-1].drop(columns=['Lancamento'])  # Inverte para mostrar mais recentes primeiro
                 
                 st.dataframe(
                     df_ultimas,
@@ -1526,7 +5206,7 @@ def pagina_estoque(spreadsheet):
                     hide_index=True,
                     column_config={
                         "ID_Mov": st.column_config.TextColumn("ID", width="small"),
-                        "Data": st.column_config.TextColumn("Data"),
+                        "Data": st.column_config.DatetimeColumn("Data", format="DD/MM/YYYY HH:mm"),
                         "Tipo": st.column_config.TextColumn("Tipo"),
                         "Produto": st.column_config.TextColumn("Produto"),
                         "Quantidade": st.column_config.NumberColumn("Qtd", format="%.0f"),
@@ -1537,6 +5217,9 @@ def pagina_estoque(spreadsheet):
                 st.info("📭 Nenhuma movimentação registrada ainda.")
     
     with tab3:
+        mostrar_inventario(banco, df_produtos)
+    
+    with tab4:
         st.markdown("### ⚙️ Configurar Alertas por Email")
         
         st.info("""
@@ -1567,7 +5250,10 @@ def pagina_estoque(spreadsheet):
             
             with col_btn2:
                 if st.button("💾 Salvar Configuração", use_container_width=True, disabled=not email_destinatario):
-                    if salvar_config_alerta(spreadsheet, email_destinatario):
+                    if salvar_config_alerta(banco, email_destinatario):
+                        config_email = configuracao_email()
+                        if config_email:
+                            obter_despachante_alertas(config_email).esquecer_destinatarios(banco)
                         st.success("✅ Configuração salva!")
                     else:
                         st.error("❌ Erro ao salvar configuração")
@@ -1585,8 +5271,13 @@ def pagina_estoque(spreadsheet):
         smtp_port = 587
         email_sender = "seu-email@gmail.com"
         email_password = "sua-senha-de-app"
+        janela_resumo_min = 15   # opcional: intervalo mínimo entre dois emails de alerta
         ```
         
+        Os alertas do checkout são enviados em segundo plano: a venda não espera o email.
+        Cada produto é avisado uma vez e só volta a ser avisado depois que o estoque passar do mínimo;
+        os produtos que ficarem críticos dentro da janela vão juntos no email seguinte.
+        
         **⚠️ Para Gmail:**
         1. Ative a verificação em duas etapas
         2. Crie uma "Senha de App" em [myaccount.google.com](https://myaccount.google.com/apppasswords)
@@ -1597,12 +5288,6 @@ def pagina_estoque(spreadsheet):
 # ==================== MAIN ====================
 
 def main():
-    # Inicializa cache keys no session_state (para invalidar cache quando necessário)
-    if 'cache_key_produtos' not in st.session_state:
-        st.session_state.cache_key_produtos = 0
-    if 'cache_key_compras' not in st.session_state:
-        st.session_state.cache_key_compras = 0
-    
     # Sidebar para navegação
     with st.sidebar:
         # Logo e título
@@ -1687,26 +5372,42 @@ def main():
             st.markdown("")
             
             if st.button("🔄 Recarregar Dados", use_container_width=True):
-                # Invalida todos os caches
-                st.session_state.cache_key_produtos += 1
-                st.session_state.cache_key_compras += 1
-                st.session_state.abas_verificadas = False
+                # Invalida todos os caches (de todas as sessões)
+                nova_versao(None)
+                invalidar_estruturas()
+                invalidar_indice_produtos()
+                invalidar_sincronizacoes()
+                invalidar_resumos()
+                invalidar_saldos_estoque()
                 st.rerun()
             
             st.markdown("---")
             st.caption("v1.0 - Sistema de Compras")
     
-    # Tenta conectar
-    client = conectar_gsheets()
+    iniciar_contexto_chamadas(pagina)
     
-    if client is None:
-        mostrar_config()
-        return
+    # Escolhe o armazenamento: Google Sheets (padrão) ou SQLite local
+    config_armazenamento = configuracao_armazenamento()
+    motor = str(config_armazenamento.get('motor', 'sheets')).strip().lower()
+    
+    if motor != 'sqlite':
+        # Tenta conectar
+        client = conectar_gsheets()
+        
+        if client is None:
+            mostrar_config()
+            return
     
-    # Obtém/cria a planilha
+    # Obtém/cria a planilha (ou o banco local)
     try:
-        spreadsheet = obter_planilha(client, nome_planilha)
-        garantir_abas(spreadsheet)
+        if motor == 'sqlite':
+            banco = obter_armazenamento_sqlite(config_armazenamento.get('caminho', 'sistema_compras.db'))
+        else:
+            banco = obter_armazenamento_sheets(client, nome_planilha)
+        garantir_abas(banco)
+        
+        # Inicia o envio em segundo plano (e reenvia vendas pendentes de uma execução anterior)
+        obter_diario(banco)
     except Exception as e:
         erro_str = str(e)
         st.error(f"Erro ao acessar planilha: {e}")
@@ -1756,9 +5457,10 @@ def main():
         💡 **Dica:** Todos os dados são salvos automaticamente no Google Sheets!
         """)
         
-        # Mostra estatísticas rápidas
-        df_produtos = carregar_produtos(spreadsheet, st.session_state.cache_key_produtos)
-        df_compras = carregar_compras(spreadsheet, st.session_state.cache_key_compras)
+        # Mostra estatísticas rápidas (totais do resumo diário, sem ler a aba Compras)
+        df_produtos = carregar_produtos(banco, versao_dados(banco, 'Produtos'))
+        df_resumo = carregar_resumo_diario(banco)
+        df_vendas = df_resumo[df_resumo['Produto'] == '']
         
         col1, col2, col3 = st.columns(3)
         
@@ -1771,7 +5473,7 @@ def main():
             """, unsafe_allow_html=True)
         
         with col2:
-            num_compras = df_compras['ID_Compra'].nunique() if not df_compras.empty and 'ID_Compra' in df_compras.columns else 0
+            num_compras = int(df_vendas['Compras'].sum())
             st.markdown(f"""
             <div class="metric-card">
                 <div class="metric-label">Compras Realizadas</div>
@@ -1780,7 +5482,7 @@ def main():
             """, unsafe_allow_html=True)
         
         with col3:
-            total = df_compras['Total'].sum() if not df_compras.empty and 'Total' in df_compras.columns else 0
+            total = df_vendas['Total'].sum()
             st.markdown(f"""
             <div class="metric-card">
                 <div class="metric-label">Total em Compras</div>
@@ -1789,16 +5491,21 @@ def main():
             """, unsafe_allow_html=True)
     
     elif pagina == "📦 Produtos":
-        pagina_produtos(spreadsheet)
+        pagina_produtos(banco)
     
     elif pagina == "🛒 Nova Compra":
-        pagina_compras(spreadsheet)
+        pagina_compras(banco)
     
     elif pagina == "📊 Estoque":
-        pagina_estoque(spreadsheet)
+        pagina_estoque(banco)
     
     elif pagina == "📈 Histórico":
-        pagina_historico(spreadsheet)
+        pagina_historico(banco)
+    
+    # Painel de chamadas à API (só com [diagnostico] painel = true nos secrets)
+    if configuracao_diagnostico().get('painel'):
+        with st.sidebar:
+            mostrar_diagnostico()
 
 
 if __name__ == "__main__":
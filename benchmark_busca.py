@@ -0,0 +1,91 @@
+"""
+Compara a busca de produtos por str.contains (varre o catálogo inteiro a cada consulta)
+com o índice de busca (IndiceBusca), num catálogo sintético com códigos de barras.
+As consultas incluem prefixos, erros de digitação, pedaços do meio das palavras e
+pedaços de códigos de barras.
+
+Uso:
+    python benchmark_busca.py              # 50 mil produtos
+    python benchmark_busca.py --produtos 10000
+"""
+import argparse
+import logging
+import random
+import time
+
+# O app é importado fora do `streamlit run`: silencia os avisos de "sem runtime"
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+for nome in list(logging.root.manager.loggerDict):
+    if nome.startswith('streamlit'):
+        logging.getLogger(nome).setLevel(logging.ERROR)
+
+import pandas as pd
+
+import app
+
+
+PALAVRAS = [
+    "Açúcar", "Café", "Feijão", "Arroz", "Macarrão", "Óleo", "Leite", "Pão", "Maçã", "Limão",
+    "Sabão", "Detergente", "Água", "Suco", "Refrigerante", "Biscoito", "Chocolate", "Manteiga",
+    "Queijo", "Presunto", "Farinha", "Fubá", "Sal", "Vinagre", "Molho", "Tomate", "Cebola",
+]
+MARCAS = [f"Marca{i}" for i in range(200)]
+DETALHES = ["Refinado", "Integral", "Light", "Zero", "Tradicional", "Extra", "Premium", "1kg", "500g", "2L"]
+CATEGORIAS = ["Alimentos", "Bebidas", "Limpeza", "Higiene", "Outros"]
+CONSULTAS = [
+    "acucar", "cafe marca1", "refri zero", "feijao pre", "chocolat", "detergnte", "mac", "leite integral 1kg",
+    "ucar", "ntegral", "arca12",  # pedaços do meio das palavras
+    "000123", "78900001", "7891234567", "0012345",  # pedaços de códigos de barras
+]
+
+
+def gerar_catalogo(total):
+    random.seed(42)
+    nomes = [
+        f"{random.choice(PALAVRAS)} {random.choice(MARCAS)} {random.choice(DETALHES)} {i}"
+        for i in range(total)
+    ]
+    # 80% com EAN-13 nacional, 10% com código interno com zeros à esquerda e 10% sem código
+    codigos = [
+        f"789{random.randrange(10 ** 10):010d}" if sorteio < 0.8 else f"{i:07d}" if sorteio < 0.9 else ""
+        for i, sorteio in enumerate(random.random() for _ in range(total))
+    ]
+    return pd.DataFrame({
+        'Nome': nomes,
+        'Categoria': [random.choice(CATEGORIAS) for _ in range(total)],
+        'Codigo': codigos,
+    })
+
+
+def medir(funcao, repeticoes=20):
+    """Tempo médio (ms) de uma chamada"""
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = funcao()
+    return (time.perf_counter() - inicio) / repeticoes * 1000, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--produtos', type=int, default=50_000)
+    args = parser.parse_args()
+
+    df = gerar_catalogo(args.produtos)
+
+    inicio = time.perf_counter()
+    indice = app.IndiceBusca(df)
+    montagem = time.perf_counter() - inicio
+
+    print(f"Catálogo com {args.produtos:,} produtos; índice montado em {montagem * 1000:.0f} ms".replace(',', '.'))
+    print(f"{'consulta':<22} {'str.contains':>14} {'achados':>8} {'índice':>10} {'achados':>8}")
+
+    for consulta in CONSULTAS:
+        tempo_contains, achados = medir(lambda: df[
+            df['Nome'].str.contains(consulta, case=False, na=False) | df['Codigo'].str.contains(consulta, regex=False)
+        ])
+        tempo_indice, posicoes = medir(lambda: indice.buscar(consulta))
+        print(f"{consulta:<22} {tempo_contains:>11.1f} ms {len(achados):>8} {tempo_indice:>7.2f} ms {len(posicoes):>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Compara o carregamento da aba Compras: registros (get_all_records -> lista de dicts ->
+DataFrame -> pd.to_numeric) contra o carregamento por colunas já tipadas (montar_tabela).
+
+Uso:
+    python benchmark_carregamento.py            # 200 mil linhas
+    python benchmark_carregamento.py --linhas 50000
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# O app é importado fora do `streamlit run`: silencia os avisos de "sem runtime"
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+for nome in list(logging.root.manager.loggerDict):
+    if nome.startswith('streamlit'):
+        logging.getLogger(nome).setLevel(logging.ERROR)
+
+import pandas as pd
+
+import app
+
+
+PRODUTOS = [f"Produto {i}" for i in range(300)]
+PAGAMENTOS = ["Pix", "Crédito", "Débito", "Dinheiro", "Vale Alimentação"]
+
+
+def gerar_linhas(total):
+    """Linhas da aba Compras como a API devolve (valores sem formatação)"""
+    random.seed(42)
+    inicio = datetime(2024, 1, 1)
+    linhas = []
+    for i in range(total):
+        quantidade = random.randint(1, 5)
+        preco = round(random.uniform(1, 50), 2)
+        linhas.append([
+            f"CMP{i // 3 + 1:04d}",
+            (inicio + timedelta(minutes=i)).strftime(app.FORMATO_DATA),
+            random.choice(PRODUTOS),
+            quantidade,
+            preco,
+            round(quantidade * preco, 2),
+            random.choice(PAGAMENTOS),
+            "",
+            "",
+        ])
+    return linhas
+
+
+def carregar_por_registros(registros):
+    """Caminho anterior: DataFrame de uma lista de dicts e conversão coluna a coluna"""
+    df = pd.DataFrame(registros)
+    for col in ['Quantidade', 'Preço_Unit', 'Total']:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    return df
+
+
+def medir(funcao, *args, repeticoes=3):
+    """Melhor tempo (s), pico de memória alocada (bytes) e o resultado"""
+    melhor = float('inf')
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao(*args)
+        melhor = min(melhor, time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    funcao(*args)
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return melhor, pico, resultado
+
+
+def linha_resultado(nome, tempo, pico, df):
+    memoria_df = df.memory_usage(deep=True).sum()
+    print(f"{nome:<34} {tempo * 1000:>9.0f} ms {pico / 2**20:>10.1f} MB {memoria_df / 2**20:>10.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--linhas', type=int, default=200_000)
+    args = parser.parse_args()
+
+    cabecalho = app.ESQUEMA_ABAS['Compras']
+    linhas = gerar_linhas(args.linhas)
+
+    # O que cada leitura devolve: linhas viram dicts (get_all_records) ou colunas (majorDimension=COLUMNS)
+    registros = [dict(zip(cabecalho, linha)) for linha in linhas]
+    colunas = {nome: list(valores) for nome, valores in zip(cabecalho, zip(*linhas))}
+
+    print(f"Aba Compras com {args.linhas:,} linhas".replace(',', '.'))
+    print(f"{'':<34} {'tempo':>12} {'pico alocado':>13} {'DataFrame':>13}")
+
+    tempo, pico, df = medir(carregar_por_registros, registros)
+    linha_resultado("registros -> DataFrame (antes)", tempo, pico, df)
+
+    tempo, pico, df = medir(app.montar_tabela, cabecalho, colunas, cabecalho)
+    linha_resultado("colunas tipadas (montar_tabela)", tempo, pico, df)
+
+    # Do armazenamento até o DataFrame, com um banco SQLite temporário
+    with tempfile.TemporaryDirectory() as pasta:
+        banco = app.ArmazenamentoSQLite(os.path.join(pasta, 'benchmark.db'))
+        banco.garantir_estrutura(app.ESQUEMA_ABAS)
+        banco.anexar_linhas('Compras', linhas)
+
+        tempo, pico, df = medir(lambda: carregar_por_registros(banco.ler_registros('Compras')))
+        linha_resultado("SQLite: ler_registros (antes)", tempo, pico, df)
+
+        tempo, pico, df = medir(lambda: app.montar_tabela(*banco.ler_colunas('Compras'), cabecalho))
+        linha_resultado("SQLite: ler_colunas + tipagem", tempo, pico, df)
+
+        banco._conexao.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# O app é importado fora do `streamlit run`: silencia os avisos de "sem runtime"
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+for nome in list(logging.root.manager.loggerDict):
+    if nome.startswith('streamlit'):
+        logging.getLogger(nome).setLevel(logging.ERROR)
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def banco(tmp_path):
+    """Banco SQLite novo, com todas as abas do sistema"""
+    banco = app.ArmazenamentoSQLite(str(tmp_path / 'teste.db'))
+    banco.garantir_estrutura(app.ESQUEMA_ABAS)
+    yield banco
+    banco._conexao.close()
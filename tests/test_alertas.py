@@ -0,0 +1,72 @@
+import smtplib
+
+import app
+
+
+class ConexaoFalsa:
+    remetente = 'alertas@exemplo.com'
+    
+    def __init__(self):
+        self.falhar = True
+        self.enviadas = []
+    
+    def enviar(self, msg, destinatarios):
+        if self.falhar:
+            raise smtplib.SMTPServerDisconnected('servidor fora do ar')
+        self.enviadas.append((msg['Subject'], list(destinatarios)))
+    
+    def fechar(self):
+        pass
+
+
+def produto(nome, estoque=1, minimo=5):
+    return {'Nome': nome, 'Estoque_Atual': estoque, 'Estoque_Minimo': minimo}
+
+
+def test_resumo_que_falha_volta_para_a_fila(banco, monkeypatch):
+    despachante = app.DespachanteAlertas({'email_sender': 'alertas@exemplo.com', 'janela_resumo_min': 15})
+    despachante.conexao = conexao = ConexaoFalsa()
+    monkeypatch.setattr(despachante, 'TENTATIVAS', 1)
+    monkeypatch.setattr(despachante, 'destinatarios', lambda banco: ['compras@exemplo.com'])
+    
+    estado = despachante._estados[banco.id] = app.ler_estado_alertas(banco)
+    despachante._resumos[banco.id] = [banco, {'Água': produto('Água')}, 0]
+    despachante._enviar_resumos_vencidos()
+    
+    # Falhou: continua pendente para a próxima janela e não conta como avisado
+    assert set(despachante._resumos[banco.id][1]) == {'Água'}
+    assert despachante._resumos[banco.id][2] > 0
+    assert not estado.notificado('Água', 5)
+    assert app.ler_estado_alertas(banco).linhas == {}
+    
+    # Um alerta novo entra no mesmo resumo; na janela seguinte os dois saem juntos
+    despachante._resumos[banco.id][1]['Pão'] = produto('Pão', 0, 3)
+    despachante._resumos[banco.id][2] = 0
+    conexao.falhar = False
+    despachante._enviar_resumos_vencidos()
+    
+    assert banco.id not in despachante._resumos
+    assert len(conexao.enviadas) == 1 and '2 produto(s)' in conexao.enviadas[0][0]
+    assert estado.notificado('Água', 5) and estado.notificado('Pão', 3)
+    assert set(app.ler_estado_alertas(banco).linhas) == {'Água', 'Pão'}
+
+
+def test_estado_gravado_pelo_produto_e_nao_pela_linha(banco, monkeypatch):
+    # Duas instâncias leem a aba vazia e cada uma anexa a linha de um produto
+    primeira, segunda = app.ler_estado_alertas(banco), app.ler_estado_alertas(banco)
+    app.gravar_estado_alertas(banco, *primeira.marcar([produto('Água')], '2024-01-01 10:00:00'))
+    app.gravar_estado_alertas(banco, *segunda.marcar([produto('Pão', 0, 3)], '2024-01-01 10:05:00'))
+    
+    # A segunda acha que Pão está na linha 2 (que é de Água): a gravação vai para a linha de Pão
+    app.gravar_estado_alertas(banco, [], segunda.rearmar({'Pão': (10, 3)}))
+    app.gravar_estado_alertas(banco, *segunda.marcar([produto('Pão', 1, 4)], '2024-01-01 11:00:00'))
+    
+    lido = app.ler_estado_alertas(banco)
+    assert lido.linhas == {'Água': [5.0, '2024-01-01 10:00:00'], 'Pão': [4.0, '2024-01-01 11:00:00']}
+    
+    # O despachante relê o estado depois da validade e passa a ver o aviso da outra instância
+    despachante = app.DespachanteAlertas({'email_sender': 'alertas@exemplo.com'})
+    despachante._estados[banco.id] = segunda
+    assert despachante._estado(banco) is segunda
+    monkeypatch.setattr(despachante, 'VALIDADE_ESTADO', 0)
+    assert despachante._estado(banco).notificado('Água', 5)
@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture
+def indice():
+    df = pd.DataFrame({
+        'Nome': ['Açúcar Refinado', 'Açúcar Mascavo Orgânico', 'Café Torrado', 'Pão Francês', 'Cafeteira Elétrica',
+                 'Damasco Seco'],
+        'Categoria': ['Mercearia', 'Mercearia', 'Mercearia', 'Padaria', 'Utilidades', 'Mercearia'],
+        'Codigo': ['0012345', '7891000100103', '', '7891000055500', '', ''],
+    })
+    return app.IndiceBusca(df)
+
+
+def nomes(indice, consulta, **opcoes):
+    return [indice.nomes[posicao] for posicao in indice.buscar(consulta, **opcoes)]
+
+
+def test_sem_acentos_e_maiusculas(indice):
+    assert nomes(indice, 'ACUCAR') == ['Açúcar Refinado', 'Açúcar Mascavo Orgânico']
+    assert nomes(indice, 'pao frances') == ['Pão Francês']
+
+
+def test_palavra_inteira_antes_do_prefixo(indice):
+    assert nomes(indice, 'cafe') == ['Café Torrado', 'Cafeteira Elétrica']
+    assert nomes(indice, 'caf', categoria='Utilidades') == ['Cafeteira Elétrica']
+
+
+def test_pedaco_do_meio_da_palavra(indice):
+    assert nomes(indice, 'ucar') == ['Açúcar Refinado', 'Açúcar Mascavo Orgânico']
+    assert nomes(indice, 'finad') == ['Açúcar Refinado']
+    assert nomes(indice, 'ganico acu') == ['Açúcar Mascavo Orgânico']
+    
+    # Prefixo de uma palavra e pedaço do meio de outra: os dois casam, o prefixo primeiro
+    assert nomes(indice, 'mas') == ['Açúcar Mascavo Orgânico', 'Damasco Seco']
+
+
+def test_erro_de_digitacao(indice):
+    assert nomes(indice, 'refinadu') == ['Açúcar Refinado']
+
+
+def test_codigo_de_barras(indice):
+    assert nomes(indice, '7891000055500') == ['Pão Francês']
+    assert nomes(indice, ' 0012345 ') == ['Açúcar Refinado']
+    assert nomes(indice, '12345') == ['Açúcar Refinado']
+    assert nomes(indice, '7891000') == ['Pão Francês', 'Açúcar Mascavo Orgânico']
+    assert nomes(indice, '0555') == ['Pão Francês']
+    assert nomes(indice, '103') == ['Açúcar Mascavo Orgânico']
+    assert nomes(indice, '78910000555001') == []
+    assert nomes(indice, '12') == []
+
+
+def test_termo_que_nao_casa(indice):
+    assert nomes(indice, 'ucar xyz') == []
+
+
+def test_catalogo_sem_codigos():
+    indice = app.IndiceBusca(pd.DataFrame({'Nome': ['Leite 1L'], 'Categoria': ['Bebidas']}))
+    assert nomes(indice, 'leite') == ['Leite 1L'] and nomes(indice, '123') == []
+    assert len(app.IndiceBusca(pd.DataFrame(columns=['Nome', 'Categoria', 'Codigo'])).buscar('123')) == 0
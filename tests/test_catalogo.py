@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def catalogo(**colunas):
+    base = {
+        'ID': ['PROD0001', 'PROD0002'],
+        'Nome': ['Água', 'Pão'],
+        'Categoria': ['Bebidas', 'Padaria'],
+        'Preço': [2.5, 1.0],
+        'Unidade': ['un', 'un'],
+        'Estoque_Minimo': [5, 5],
+        'Imagem': ['http://exemplo/agua.png', ''],
+        'Codigo': ['7891234567890', ''],
+    }
+    base.update(colunas)
+    return pd.DataFrame(base)
+
+
+def test_celulas_apagadas_contam_como_alteracao():
+    original = catalogo()
+    editado = catalogo(Imagem=[None, ''], Codigo=[np.nan, ''])
+    
+    alteracoes = app.alteracoes_catalogo(original, editado)
+    
+    assert sorted(alteracoes['Coluna']) == ['Codigo', 'Imagem']
+    assert alteracoes['Depois'].tolist() == ['', '']
+    validas, recusadas = app.validar_alteracoes_catalogo(alteracoes, original)
+    assert len(validas) == 2 and recusadas.empty
+
+
+def test_texto_vazio_nos_dois_lados_nao_muda():
+    original = catalogo(Imagem=['', np.nan])
+    editado = catalogo(Imagem=[None, ''])
+    assert app.alteracoes_catalogo(original, editado).empty
+
+
+def test_preco_apagado_e_recusado():
+    alteracoes = app.alteracoes_catalogo(catalogo(), catalogo(Preço=[np.nan, 1.0]))
+    
+    assert alteracoes['Coluna'].tolist() == ['Preço']
+    validas, recusadas = app.validar_alteracoes_catalogo(alteracoes)
+    assert validas.empty and recusadas['ID'].tolist() == ['PROD0001']
+
+
+def test_numeros_ilegiveis_e_zero():
+    original = catalogo(Estoque_Minimo=['abc', np.nan])
+    
+    # Ilegível antes e 0 depois é alteração; vazio dos dois lados não é
+    alteracoes = app.alteracoes_catalogo(original, catalogo(Estoque_Minimo=[0, None]))
+    assert alteracoes[['ID', 'Coluna']].values.tolist() == [['PROD0001', 'Estoque_Minimo']]
+    assert alteracoes['Depois'].tolist() == [0]
+
+
+def test_gravar_celulas_apagadas(banco):
+    assert app.adicionar_produto(banco, 'Água', 'Bebidas', 2.5, 'un', 0, 5, 'http://exemplo/agua.png',
+                                 '7891234567890')
+    original = app._ler_produtos(banco)
+    editado = original.assign(Imagem=[None], Codigo=[''])
+    
+    alteracoes = app.alteracoes_catalogo(original, editado)
+    assert app.gravar_alteracoes_catalogo(banco, alteracoes) == 2
+    
+    produto = app._ler_produtos(banco).iloc[0]
+    assert produto['Imagem'] == '' and produto['Codigo'] == ''
+
+
+def test_reajuste_com_ids_repetidos_e_ilegiveis(banco):
+    for nome, preco in [('A', 1.0), ('B', 2.0), ('C', 3.0)]:
+        assert app.adicionar_produto(banco, nome, 'Outros', preco, 'un', 0, 5)
+    coluna_id = app.ESQUEMA_ABAS['Produtos'].index('ID') + 1
+    # Planilha antiga: C com o ID de B e A com um ID ilegível
+    banco.gravar_celulas('Produtos', [(4, coluna_id, 2), (2, coluna_id, 'x')])
+    app.invalidar_indice_produtos(banco)
+    
+    original = app._ler_produtos(banco)
+    alteracoes = app.alteracoes_catalogo(original, app.reajustar_precos(original, 10))
+    assert alteracoes['Linha'].tolist() == [2, 3, 4]
+    assert app.gravar_alteracoes_catalogo(banco, alteracoes) == 3
+    
+    produtos = app._ler_produtos(banco)
+    assert list(zip(produtos['Nome'], produtos['Preço'])) == [('A', 1.1), ('B', 2.2), ('C', 3.3)]
+
+
+def test_codigo_repetido_entre_produtos_com_o_mesmo_id():
+    original = catalogo(ID=['PROD0001', 'PROD0001'])
+    alteracoes = app.alteracoes_catalogo(original, catalogo(ID=['PROD0001', 'PROD0001'], Codigo=['', '7891234567890']))
+    
+    # O código sai de um produto e entra no outro: não fica repetido
+    assert alteracoes[['Linha', 'Coluna']].values.tolist() == [[2, 'Codigo'], [3, 'Codigo']]
+    validas, recusadas = app.validar_alteracoes_catalogo(alteracoes, original)
+    assert len(validas) == 2 and recusadas.empty
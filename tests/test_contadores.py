@@ -0,0 +1,109 @@
+import contextlib
+import threading
+import time
+
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol
+
+import app
+
+
+def reservar_em_paralelo(bancos, pedidos, vezes):
+    """Cada banco reserva `vezes` em sua própria thread; retorna {chave: [números emitidos]}"""
+    emitidos = {chave: [] for chave in pedidos}
+    lock = threading.Lock()
+    
+    def reservar(banco):
+        for _ in range(vezes):
+            primeiros = banco.reservar_numeros(pedidos)
+            with lock:
+                for chave, qtd in pedidos.items():
+                    emitidos[chave].extend(range(primeiros[chave], primeiros[chave] + qtd))
+    
+    threads = [threading.Thread(target=reservar, args=(banco,)) for banco in bancos]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return emitidos
+
+
+def test_reservas_concorrentes_sqlite_nao_repetem(banco, tmp_path):
+    # Duas conexões no mesmo arquivo fazem o papel de dois processos
+    outro = app.ArmazenamentoSQLite(banco.caminho)
+    emitidos = reservar_em_paralelo([banco, outro, banco], {'Compras': 1, 'Movimentacoes': 3}, 30)
+    outro._conexao.close()
+    
+    assert sorted(emitidos['Compras']) == list(range(1, 91))
+    assert sorted(emitidos['Movimentacoes']) == list(range(1, 271))
+
+
+def test_alocar_ids_continua_a_numeracao_existente(banco):
+    banco.anexar_linhas('Compras', [['CMP0041', '', 'Água', 1, 1, 1, 'Pix', '']])
+    
+    ids = app.alocar_ids(banco, {'Compras': 2, 'Movimentacoes': 1})
+    
+    assert ids == {'Compras': ['CMP0042', 'CMP0043'], 'Movimentacoes': ['MOV00001']}
+
+
+class AbaFalsa:
+    """Aba do Google Sheets em memória, com as chamadas usadas na reserva de IDs"""
+    
+    def __init__(self, titulo, cabecalho):
+        self.titulo = titulo
+        self.linhas = [list(cabecalho)]
+        self.lock = threading.Lock()
+    
+    def get_values(self, faixa, **kwargs):
+        time.sleep(0.001)  # dá vez às outras instâncias entre a reserva e a leitura
+        grade = a1_range_to_grid_range(faixa)
+        with self.lock:
+            linhas = self.linhas[grade.get('startRowIndex', 0):grade.get('endRowIndex')]
+            return [list(linha[grade.get('startColumnIndex', 0):grade.get('endColumnIndex')]) for linha in linhas]
+    
+    def col_values(self, coluna, **kwargs):
+        with self.lock:
+            return [linha[coluna - 1] if len(linha) >= coluna else '' for linha in self.linhas]
+    
+    def append_rows(self, linhas, **kwargs):
+        time.sleep(0.001)
+        with self.lock:
+            inicio = len(self.linhas) + 1
+            self.linhas.extend(list(linha) for linha in linhas)
+            return {'updates': {'updatedRange': f"{self.titulo}!A{inicio}:C{len(self.linhas)}"}}
+    
+    def gravar(self, linha, coluna, valor):
+        with self.lock:
+            while len(self.linhas[linha - 1]) < coluna:
+                self.linhas[linha - 1].append('')
+            self.linhas[linha - 1][coluna - 1] = valor
+
+
+class PlanilhaFalsa:
+    id = 'planilha-falsa'
+    
+    def __init__(self):
+        self.abas = {aba: AbaFalsa(aba, colunas) for aba, colunas in app.ESQUEMA_ABAS.items()}
+    
+    def worksheet(self, aba):
+        return self.abas[aba]
+    
+    def values_batch_update(self, corpo):
+        for dado in corpo['data']:
+            aba, celula = dado['range'].rsplit('!', 1)
+            self.abas[aba.strip("'")].gravar(*a1_to_rowcol(celula), dado['values'][0][0])
+
+
+def test_reservas_concorrentes_sheets_nao_repetem(monkeypatch):
+    planilha = PlanilhaFalsa()
+    planilha.abas['Compras'].append_rows([['CMP0007']])
+    # Sem o lock do processo: cada armazenamento faz o papel de uma instância diferente
+    monkeypatch.setattr(app, '_lock_contadores', contextlib.nullcontext())
+    instancias = [app.ArmazenamentoSheets(planilha) for _ in range(4)]
+    
+    emitidos = reservar_em_paralelo(instancias, {'Compras': 2, 'Movimentacoes': 5}, 25)
+    
+    assert sorted(emitidos['Compras']) == list(range(8, 208))
+    assert sorted(emitidos['Movimentacoes']) == list(range(1, 501))
+    
+    # Uma instância nova parte do ponto gravado e continua depois do último bloco
+    assert app.ArmazenamentoSheets(planilha).reservar_numeros({'Compras': 1}) == {'Compras': 208}
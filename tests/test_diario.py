@@ -0,0 +1,73 @@
+import os
+import time
+
+import app
+
+
+def esperar_envio(diario, limite=5):
+    inicio = time.monotonic()
+    while diario.pendentes() and time.monotonic() - inicio < limite:
+        time.sleep(0.01)
+    assert diario.pendentes() == 0
+
+
+def lancamento_venda(id_compra, id_mov, produto, quantidade):
+    return [
+        ('anexar', 'Compras', [[id_compra, '2024-01-01 10:00:00', produto, quantidade, 2.5, quantidade * 2.5, 'Pix', '']]),
+        ('anexar', 'Movimentacoes', [[id_mov, '2024-01-01 10:00:00', 'Saída', produto, quantidade, 'Venda', '']]),
+    ]
+
+
+def linhas(banco, aba):
+    """(ID, Produto, Lancamento) de cada linha da aba"""
+    chave = app.ESQUEMA_ABAS[aba][0]
+    return [(r[chave], r['Produto'], r['Lancamento']) for r in banco.ler_registros(aba)]
+
+
+def test_reenvio_nao_duplica_lancamento_ja_gravado(banco, tmp_path):
+    caminho = str(tmp_path / 'diario.jsonl')
+    diario = app.DiarioGravacao(banco, caminho)
+    seq = diario.registrar(lancamento_venda('CMP0001', 'MOV00001', 'Água', 2))
+    esperar_envio(diario)
+    
+    # Queda depois de gravar e antes de confirmar: o lançamento volta como pendente
+    os.remove(caminho + '.ok')
+    reaberto = app.DiarioGravacao(banco, caminho)
+    esperar_envio(reaberto)
+    
+    marca = diario.marca(seq)
+    assert linhas(banco, 'Compras') == [('CMP0001', 'Água', marca)]
+    assert linhas(banco, 'Movimentacoes') == [('MOV00001', 'Água', marca)]
+
+
+def test_reenvio_grava_linha_de_outra_instancia_com_o_mesmo_id(banco, tmp_path):
+    # Outra instância já gravou uma venda diferente com o mesmo ID
+    banco.anexar_linhas('Compras', [['CMP0001', '2024-01-01 09:00:00', 'Pão', 1, 1.0, 1.0, 'Pix', '', 'outra-1']])
+    
+    caminho = str(tmp_path / 'diario.jsonl')
+    diario = app.DiarioGravacao(banco, caminho)
+    diario._em_duvida = True  # força a conferência das linhas já gravadas
+    seq = diario.registrar(lancamento_venda('CMP0001', 'MOV00001', 'Água', 2))
+    esperar_envio(diario)
+    
+    assert linhas(banco, 'Compras') == [('CMP0001', 'Pão', 'outra-1'), ('CMP0001', 'Água', diario.marca(seq))]
+    assert [r['Produto'] for r in banco.ler_registros('Movimentacoes')] == ['Água']
+
+
+def test_reenvio_parcial_grava_so_o_que_falta(banco, tmp_path):
+    caminho = str(tmp_path / 'diario.jsonl')
+    diario = app.DiarioGravacao(banco, caminho)
+    primeiro = diario.registrar(lancamento_venda('CMP0001', 'MOV00001', 'Água', 2))
+    esperar_envio(diario)
+    
+    # O segundo lançamento caiu só com a venda gravada, sem a movimentação
+    segundo = lancamento_venda('CMP0002', 'MOV00002', 'Suco', 1)
+    with open(caminho, 'a', encoding='utf-8') as f:
+        f.write(app.json.dumps({'seq': primeiro + 1, 'lancamento': segundo}) + '\n')
+    app.aplicar_lancamento(banco, [('anexar', 'Compras', diario._marcar(segundo[0][2], 'Compras', diario.marca(primeiro + 1)))])
+    
+    reaberto = app.DiarioGravacao(banco, caminho)
+    esperar_envio(reaberto)
+    
+    assert [r['ID_Compra'] for r in banco.ler_registros('Compras')] == ['CMP0001', 'CMP0002']
+    assert [r['ID_Mov'] for r in banco.ler_registros('Movimentacoes')] == ['MOV00001', 'MOV00002']